@@ -8,20 +8,36 @@ Key Features:
 - Singleton class.
 - Sets the connection string for the database.
 - Connects to the database.
+- Optionally shares a pool of connections between concurrent handlers.
 - Executes a database query and returns the result.
+- Runs the queries of the handlers as server-side prepared statements,
+  cached per connection, and returns their rows as named tuples.
+- Streams large results in batches through server-side cursors.
+- Records query durations and pool wait times in the metrics.
+- Asynchronous counterpart with a pool of asyncio connections.
 
 Classes:
 ----------
 - DBManager:
+- AsyncDBManager:
 """
-from typing import Optional
+import asyncio
+import time
+from contextlib import contextmanager, asynccontextmanager
+from threading import Lock
+from typing import AsyncIterator, Iterator, Optional, Sequence, Union
 
 import psycopg
 from dotenv import load_dotenv
 from loguru import logger
 from psycopg import connect
+from psycopg.rows import namedtuple_row
+from psycopg_pool import AsyncConnectionPool, ConnectionPool, PoolTimeout
 
-from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, \
+    DB_POOL_ENABLED, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, \
+    DB_POOL_MAX_IDLE, DB_POOL_CHECK, DB_PREPARED_MAX
+from metrics import DB_QUERY_DURATION, DB_POOL_WAIT, DB_POOL_TIMEOUTS
 from singleton import SingletonMeta
 
 
@@ -44,8 +60,12 @@ class DBManager(metaclass=SingletonMeta):
     :type conn_str: Optional[str]
     :ivar conn: Active connection object to the database.
     :type conn: Optional[psycopg.Connection]
+    :ivar pooled: Whether queries are served from a shared connection pool.
+    :type pooled: bool
+    :ivar pool: Connection pool shared by all handlers, opened on first use.
+    :type pool: Optional[psycopg_pool.ConnectionPool]
     """
-    def __init__(self, env_file='../.env'):
+    def __init__(self, env_file='../.env', pooled=DB_POOL_ENABLED):
         load_dotenv(env_file)
         self.db_name = DB_NAME
         self.db_user = DB_USER
@@ -55,7 +75,11 @@ class DBManager(metaclass=SingletonMeta):
         self.conn_str = None
         self.set_conn_str()
         self.conn = None
-        self.conn = self.connect()
+        self.pooled = pooled
+        self.pool = None
+        self._pool_lock = Lock()
+        if not self.pooled:
+            self.conn = self.connect()
 
     def set_conn_str(self) -> None:
         """
@@ -80,29 +104,189 @@ class DBManager(metaclass=SingletonMeta):
         """
         try:
             self.conn = connect(self.conn_str)
+            self.configure_connection(self.conn)
             return self.conn
         except psycopg.Error as e:
             logger.error(f'Database connection error: {e}')
 
-    def execute_query(self, query: str) -> None:
+    def open_pool(self) -> ConnectionPool:
+        """
+        Opens the shared connection pool unless it is already open.
+
+        The pool keeps ``DB_POOL_MIN_SIZE`` connections ready, grows up to
+        ``DB_POOL_MAX_SIZE``, closes connections idle for longer than
+        ``DB_POOL_MAX_IDLE`` seconds and, if ``DB_POOL_CHECK`` is set,
+        health-checks every connection before handing it out.
+
+        :return: The open connection pool.
+        :rtype: psycopg_pool.ConnectionPool
+        """
+        with self._pool_lock:
+            if self.pool is None:
+                logger.info(f'Opening connection pool '
+                            f'({DB_POOL_MIN_SIZE}..{DB_POOL_MAX_SIZE})')
+                self.pool = ConnectionPool(
+                    self.conn_str,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    check=ConnectionPool.check_connection
+                    if DB_POOL_CHECK else None,
+                    configure=self.configure_connection,
+                    name='images',
+                    open=True,
+                )
+            return self.pool
+
+    @staticmethod
+    def configure_connection(conn: psycopg.Connection) -> None:
+        """
+        Makes a new connection return rows as named tuples and keep up to
+        ``DB_PREPARED_MAX`` prepared statements.
+
+        :param conn: The new connection.
+        :type conn: psycopg.Connection
+        :return: None
+        """
+        conn.row_factory = namedtuple_row
+        conn.prepared_max = DB_PREPARED_MAX
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg.Connection]:
+        """
+        Provides a database connection for the duration of a ``with`` block.
+
+        In pooled mode the connection is checked out of the shared pool,
+        waiting at most ``DB_POOL_TIMEOUT`` seconds, and returned to it
+        afterwards. Otherwise a new connection is opened and closed on exit.
+
+        :return: A context manager yielding a database connection.
+        :rtype: Iterator[psycopg.Connection]
+        :raises psycopg.Error: If no connection can be obtained.
+        """
+        if not self.pooled:
+            with self.connect() as conn:
+                yield conn
+            return
+
+        pool = self.pool or self.open_pool()
+        started = time.perf_counter()
+        try:
+            with pool.connection() as conn:
+                DB_POOL_WAIT.observe(time.perf_counter() - started)
+                yield conn
+        except PoolTimeout as e:
+            DB_POOL_TIMEOUTS.inc()
+            logger.error(f'Connection pool timeout: {e}')
+            raise
+
+    def execute(self, query: str, params: Sequence = None) -> bool:
+        """
+        Executes a single statement as a prepared statement and commits it.
+
+        The statement is prepared on the first execution on a connection
+        and reused by later executions on it, so Postgres parses and plans
+        it once per connection.
+
+        :param query: The SQL statement, with ``%s`` placeholders.
+        :type query: str
+        :param params: Values bound to the placeholders.
+        :type params: Sequence, optional
+        :return: True if the statement was committed, False if it failed.
+        :rtype: bool
+        """
+        try:
+            with self.connection() as conn:
+                started = time.perf_counter()
+                conn.execute(query, params, prepare=True)
+                conn.commit()
+                DB_QUERY_DURATION.observe(time.perf_counter() - started,
+                                          'execute')
+            return True
+        except psycopg.Error as e:
+            logger.error(f'Database query error: {e}')
+            return False
+
+    def fetch(self, query: str, params: Sequence = None) -> Optional[list]:
+        """
+        Executes a single statement as a prepared statement and returns
+        all the rows it produced.
+
+        :param query: The SQL statement, with ``%s`` placeholders.
+        :type query: str
+        :param params: Values bound to the placeholders.
+        :type params: Sequence, optional
+        :return: The rows as named tuples, or None if the query failed.
+        :rtype: Optional[list]
+        """
+        try:
+            with self.connection() as conn:
+                started = time.perf_counter()
+                rows = conn.execute(query, params, prepare=True).fetchall()
+                DB_QUERY_DURATION.observe(time.perf_counter() - started,
+                                          'fetch')
+                return rows
+        except psycopg.Error as e:
+            logger.error(f'Database fetch error: {e}')
+
+    def stream(self, query: str, params: Union[Sequence, dict] = None,
+               batch_size: int = 1000) -> Iterator[list]:
+        """
+        Runs a query through a named server-side cursor and yields its
+        rows in batches, so memory is bounded by one batch whatever the
+        size of the result. A connection is held until the iterator is
+        exhausted or closed.
+
+        :param query: The SQL query, with ``%s`` or ``%(name)s``
+                      placeholders.
+        :type query: str
+        :param params: Values bound to the placeholders.
+        :type params: Union[Sequence, dict], optional
+        :param batch_size: Number of rows fetched at a time.
+        :type batch_size: int, optional
+        :return: An iterator over the batches of rows, as named tuples.
+        :rtype: Iterator[list]
+        :raises psycopg.Error: If the query fails.
+        """
+        with self.connection() as conn:
+            with conn.cursor(name='stream') as cursor:
+                started = time.perf_counter()
+                cursor.execute(query, params)
+                DB_QUERY_DURATION.observe(time.perf_counter() - started,
+                                          'stream')
+                while rows := cursor.fetchmany(batch_size):
+                    yield rows
+
+    def execute_query(self, query: str, params: Sequence = None) -> bool:
         """
         Executes a given SQL query within a database connection context.
+        Unlike `execute`, the query may hold several statements, as it is
+        not prepared.
 
         :param query: The SQL query to be executed.
         :type query: str
-        :return: None
-        :rtype: None
-        :raises psycopg.Error:
+        :param params: Optional values bound to the ``%s`` placeholders
+                        of the query.
+        :type params: Sequence, optional
+        :return: True if the query was committed, False if it failed.
+        :rtype: bool
         """
         try:
-            with self.connect() as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute(query)
+                    started = time.perf_counter()
+                    cursor.execute(query, params)
                     conn.commit()
+                    DB_QUERY_DURATION.observe(time.perf_counter() - started,
+                                              'execute')
+            return True
         except psycopg.Error as e:
             logger.error(f'Database query error: {e}')
+            return False
 
-    def execute_fetch_query(self, query: str, n: int = None) -> Optional[list]:
+    def execute_fetch_query(self, query: str, n: int = None,
+                            params: Sequence = None) -> Optional[list]:
         """
         Executes a database query to fetch data and returns the results.
         Fetches all records if `n` is not specified;
@@ -113,16 +297,21 @@ class DBManager(metaclass=SingletonMeta):
         :param n: Optional number of rows to be fetched.
                     If not provided, all rows will be fetched.
         :type n: int, optional
+        :param params: Optional values bound to the ``%s`` placeholders
+                        of the query.
+        :type params: Sequence, optional
         :return: A list of fetched database rows or None if the query fails.
         :rtype: Optional[list]
         """
         try:
-            with self.connect() as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute(query)
-                    if not n:
-                        return cursor.fetchall()
-                    return cursor.fetchmany(n)
+                    started = time.perf_counter()
+                    cursor.execute(query, params)
+                    rows = cursor.fetchall() if not n else cursor.fetchmany(n)
+                    DB_QUERY_DURATION.observe(time.perf_counter() - started,
+                                              'fetch')
+                    return rows
         except psycopg.Error as e:
             logger.error(f'Database fetch error: {e}')
 
@@ -147,9 +336,187 @@ class DBManager(metaclass=SingletonMeta):
 
     def close(self) -> None:
         """
-        Closes the active database connection
+        Closes the active database connection and the connection pool.
+
+        A closed pool is reopened by the next query, which lets a forked
+        worker process build its own pool instead of sharing the parent's.
+
+        :return: None
+        """
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        with self._pool_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+
+
+class AsyncDBManager(metaclass=SingletonMeta):
+    """
+    Runs database queries from asyncio code without blocking the event
+    loop. Acts as a singleton.
+
+    Connections always come from a pool sized by the ``DB_POOL_*``
+    settings. The pool belongs to the event loop that opened it and must
+    be closed before that loop ends.
+
+    :ivar conn_str: Connection string formatted for database connectivity.
+    :type conn_str: str
+    :ivar pool: Connection pool, opened on first use.
+    :type pool: Optional[psycopg_pool.AsyncConnectionPool]
+    """
+    def __init__(self, env_file='../.env'):
+        load_dotenv(env_file)
+        self.conn_str = (f"dbname={DB_NAME} user={DB_USER} "
+                         f"password={DB_PASSWORD} host={DB_HOST} "
+                         f"port={DB_PORT}")
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def open_pool(self) -> AsyncConnectionPool:
+        """
+        Opens the connection pool unless it is already open.
+
+        :return: The open connection pool.
+        :rtype: psycopg_pool.AsyncConnectionPool
+        """
+        async with self._pool_lock:
+            if self.pool is None:
+                logger.info(f'Opening async connection pool '
+                            f'({DB_POOL_MIN_SIZE}..{DB_POOL_MAX_SIZE})')
+                pool = AsyncConnectionPool(
+                    self.conn_str,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    check=AsyncConnectionPool.check_connection
+                    if DB_POOL_CHECK else None,
+                    configure=self.configure_connection,
+                    name='images-async',
+                    open=False,
+                )
+                await pool.open()
+                self.pool = pool
+            return self.pool
+
+    @staticmethod
+    async def configure_connection(conn: psycopg.AsyncConnection) -> None:
+        """
+        Makes a new connection return rows as named tuples and keep up to
+        ``DB_PREPARED_MAX`` prepared statements.
+
+        :param conn: The new connection.
+        :type conn: psycopg.AsyncConnection
+        :return: None
+        """
+        conn.row_factory = namedtuple_row
+        conn.prepared_max = DB_PREPARED_MAX
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[psycopg.AsyncConnection]:
+        """
+        Checks a connection out of the pool for the duration of an
+        ``async with`` block. The transaction is committed on exit, or
+        rolled back if the block raises.
+
+        :return: A context manager yielding a database connection.
+        :rtype: AsyncIterator[psycopg.AsyncConnection]
+        :raises psycopg.Error: If no connection can be obtained.
+        """
+        pool = self.pool or await self.open_pool()
+        started = time.perf_counter()
+        try:
+            async with pool.connection() as conn:
+                DB_POOL_WAIT.observe(time.perf_counter() - started)
+                yield conn
+        except PoolTimeout as e:
+            DB_POOL_TIMEOUTS.inc()
+            logger.error(f'Connection pool timeout: {e}')
+            raise
+
+    async def execute(self, query: str, params: Sequence = None) -> bool:
+        """
+        Executes a single statement as a prepared statement and commits it.
+
+        :param query: The SQL query to be executed.
+        :type query: str
+        :param params: Optional values bound to the ``%s`` placeholders
+                        of the query.
+        :type params: Sequence, optional
+        :return: True if the query was committed, False if it failed.
+        :rtype: bool
+        """
+        try:
+            async with self.connection() as conn:
+                started = time.perf_counter()
+                await conn.execute(query, params, prepare=True)
+                await conn.commit()
+                DB_QUERY_DURATION.observe(time.perf_counter() - started,
+                                          'execute')
+            return True
+        except psycopg.Error as e:
+            logger.error(f'Database query error: {e}')
+            return False
+
+    async def fetch(self, query: str, params: Sequence = None) \
+            -> Optional[list]:
+        """
+        Executes a single statement as a prepared statement and returns
+        all the rows it produced.
+
+        :param query: The SQL query to be executed.
+        :type query: str
+        :param params: Optional values bound to the ``%s`` placeholders
+                        of the query.
+        :type params: Sequence, optional
+        :return: The rows as named tuples, or None if the query failed.
+        :rtype: Optional[list]
+        """
+        try:
+            async with self.connection() as conn:
+                started = time.perf_counter()
+                cursor = await conn.execute(query, params, prepare=True)
+                rows = await cursor.fetchall()
+                DB_QUERY_DURATION.observe(time.perf_counter() - started,
+                                          'fetch')
+                return rows
+        except psycopg.Error as e:
+            logger.error(f'Database fetch error: {e}')
+
+    async def stream(self, query: str, params: Union[Sequence, dict] = None,
+                     batch_size: int = 1000) -> AsyncIterator[list]:
+        """
+        Asynchronous version of `DBManager.stream`.
+
+        :param query: The SQL query, with ``%s`` or ``%(name)s``
+                      placeholders.
+        :type query: str
+        :param params: Values bound to the placeholders.
+        :type params: Union[Sequence, dict], optional
+        :param batch_size: Number of rows fetched at a time.
+        :type batch_size: int, optional
+        :return: An iterator over the batches of rows, as named tuples.
+        :rtype: AsyncIterator[list]
+        :raises psycopg.Error: If the query fails.
+        """
+        async with self.connection() as conn:
+            async with conn.cursor(name='stream') as cursor:
+                started = time.perf_counter()
+                await cursor.execute(query, params)
+                DB_QUERY_DURATION.observe(time.perf_counter() - started,
+                                          'stream')
+                while rows := await cursor.fetchmany(batch_size):
+                    yield rows
+
+    async def close(self) -> None:
+        """
+        Closes the connection pool; the next query opens a new one.
 
         :return: None
         """
-        self.conn.close()
-        self.conn = None
\ No newline at end of file
+        async with self._pool_lock:
+            if self.pool is not None:
+                await self.pool.close()
+                self.pool = None
@@ -7,23 +7,63 @@ as well as maintaining specific request routes.
 
 Key Features:
 - HTTP route management for GET, POST, and DELETE requests.
+- Image metadata kept in Postgres or in an embedded SQLite database.
 - Image retrieval by individual image or count.
-- Support for file uploads.
-- Image deletion functionality.
+- Keyset (cursor) pagination of the image listing.
+- In-process cache of the encoded listing pages.
+- Support for file uploads, streamed to disk in chunks.
+- Bulk uploads of many files in one multipart/form-data request, stored
+  with one batched insert.
+- Optional content-addressed storage of uploads with identical content.
+- Background generation of image thumbnails.
+- Image deletion functionality, one image at a time or in bulk.
+- Streaming export of the image metadata as NDJSON or CSV.
+- Zero-copy serving of the stored images with range and conditional
+  requests.
+- Prometheus metrics of the server.
+- Native asyncio versions of the handlers for the asyncio server engine.
 
 Classes:
 ----------
 - ImageHostingHttpRequestHandler:
+- AsyncImageHostingHttpRequestHandler:
 """
+import asyncio
+import hashlib
+import json
+import mimetypes
 import os
+from datetime import datetime
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Optional
+from urllib.parse import urlsplit
 from uuid import uuid4
 
+import psycopg
 from loguru import logger
 
-from DB_Manager import DBManager
-from adv_http_request_handler import AdvancedHTTPRequestHandler
-from settings import IMAGES_PATH, MAX_FILE_SIZE, \
-    ALLOWED_EXTENSIONS, PAGE_LIMIT, ERROR_FILE
+from DB_Manager import DBManager, AsyncDBManager
+from adv_http_request_handler import AdvancedHTTPRequestHandler, \
+    RequestBodyError, RequestBodyTooLarge
+from async_server import AsyncRequestHandlerMixin
+from blobs import acquire_blob, acquire_blob_async
+from bulk_delete import MAX_REQUEST_SIZE, bulk_delete, bulk_delete_async, \
+    parse_criteria, remove_image
+from bulk_upload import BulkUpload
+from export import EXPORT_FORMATS, EXPORT_QUERY, export_header, \
+    encode_rows, parse_export_request
+from image_files import resolve_image, file_etag, last_modified, \
+    parse_range
+from listing_cache import ListingCache
+from metadata_store import INSERT_IMAGE_QUERY, metadata_store
+from metrics import render as render_metrics
+from multipart import MultipartParser, parse_boundary
+from pagination import encode_cursor, decode_cursor
+from settings import IMAGES_PATH, MAX_FILE_SIZE, MAX_BULK_UPLOAD_SIZE, \
+    ALLOWED_EXTENSIONS, PAGE_LIMIT, ERROR_FILE, DEDUP_ENABLED, \
+    EXPORT_BATCH_SIZE
+from storage import remove_file, store_file
+from thumbnails import ThumbnailQueue, thumbnail_name
 
 
 class ImageHostingHttpRequestHandler(AdvancedHTTPRequestHandler):
@@ -45,66 +85,361 @@ class ImageHostingHttpRequestHandler(AdvancedHTTPRequestHandler):
         get_images_count: Retrieves the count of images in the database.
         get_images: Retrieves images from the database.
         post_upload: Uploads a new image to the database.
+        post_bulk_upload: Uploads many images in one multipart request.
         delete_image: Deletes an image by ID from the database.
+        post_bulk_delete: Deletes images by file names or by a filter.
+        get_thumbnails_state: Reports the state of the thumbnail queue.
+        get_export: Streams the metadata of all images.
+        get_image: Serves a stored image file.
+        get_metrics: Reports the metrics in the Prometheus text format.
     """
 
     server_version = 'Image Hosting Server v1.0'
 
     def get_images_count(self) -> None:
-        count = DBManager().execute_fetch_query('SELECT COUNT(*) FROM '
-                                                'images;')[0][0]
-        logger.info('Count: ' + str(count))
+        count = metadata_store().count()
+        if count is None:
+            self.send_html(ERROR_FILE, 500)
+            return
+        logger.debug('Count: {}', count)
         self.send_json({
             'count': count
         })
 
     def get_images(self) -> None:
-        page = self.headers.get('Page')
-        logger.info(f'Page: {page}')
-        query = (f"SELECT * FROM images ORDER BY upload_time DESC"
-                 f" LIMIT {PAGE_LIMIT} OFFSET {(int(page) - 1) * PAGE_LIMIT};")
-        logger.info(f'Query: {query}')
-        images = DBManager().execute_fetch_query(query)
+        key = self.listing_key()
+        body, generation = ListingCache().get(key)
+        if body is None:
+            position = self.listing_position()
+            if position is None:
+                return
+            images = metadata_store().list_images(*position)
+            body = self.encode_images(images)
+            if images is not None:
+                ListingCache().put(key, body, generation)
+        self.send_json(body)
+
+    def listing_key(self) -> tuple[str, str]:
+        """
+        Identifies the requested page of the image listing in the cache.
+
+        :return: The ``Cursor`` or else the ``Page`` request header.
+        :rtype: tuple[str, str]
+        """
+        cursor = self.headers.get('Cursor')
+        if cursor:
+            return 'cursor', cursor
+        return 'page', self.headers.get('Page') or '1'
+
+    def listing_position(self) \
+            -> Optional[tuple[Optional[tuple[datetime, int]], int]]:
+        """
+        Reads the position of the requested page of the image listing from
+        the ``Cursor`` or ``Page`` request header. An invalid header is
+        answered with 400 Bad Request.
+
+        :return: The ``(upload_time, id)`` pair the page starts after, or
+                 None without a cursor, and the number of rows skipped
+                 instead; None if the request was rejected.
+        :rtype: Optional[tuple[Optional[tuple[datetime, int]], int]]
+        """
+        cursor = self.headers.get('Cursor')
+        if cursor:
+            try:
+                after = decode_cursor(cursor)
+            except ValueError as e:
+                logger.warning(str(e))
+                self.send_html(ERROR_FILE, 400)
+                return None
+            logger.debug('Cursor: {}', cursor)
+            return after, 0
+
+        page = self.headers.get('Page') or '1'
+        if not page.isdigit() or int(page) < 1:
+            logger.warning(f'Invalid page: {page}')
+            self.send_html(ERROR_FILE, 400)
+            return None
+        logger.debug('Page: {}', page)
+        return None, (int(page) - 1) * PAGE_LIMIT
+
+    @staticmethod
+    def encode_images(images: Optional[list]) -> bytes:
+        """
+        Encodes a page of the image listing together with the cursor of the
+        next page.
+
+        :param images: Rows of the ``images`` table on the page.
+        :type images: Optional[list]
+        :return: The JSON response body.
+        :rtype: bytes
+        """
         if not images:
-            return self.send_json({'images': []})
+            return json.dumps({'images': [], 'next_cursor': None}).encode()
 
         to_json_images = []
         for image in images:
+            stored_name = image.blob_name or \
+                image.filename + (image.file_type or '')
             to_json_images.append({
-                'filename': image[1],
-                'original_name': image[2],
-                'size': image[3],
-                'upload_time': image[4].strftime('%Y-%m-%d %H:%M:%S'),
-                'file_type': image[5]
+                'filename': image.filename,
+                'original_name': image.original_name,
+                'size': image.size,
+                'upload_time': image.upload_time.strftime('%Y-%m-%d %H:%M:%S'),
+                'file_type': image.file_type,
+                'url': f'/{IMAGES_PATH}{stored_name}',
+                'thumbnail': f'/{IMAGES_PATH}{thumbnail_name(stored_name)}'
             })
-        self.send_json({
-            'images': to_json_images
-        })
+        next_cursor = None
+        if len(images) == PAGE_LIMIT:
+            next_cursor = encode_cursor(images[-1].upload_time,
+                                        images[-1].id)
+        return json.dumps({
+            'images': to_json_images,
+            'next_cursor': next_cursor
+        }).encode()
 
     def post_upload(self) -> None:
-        length = int(self.headers.get('Content-Length'))
-        if length > MAX_FILE_SIZE:
-            logger.warning('File is too large')
-            self.send_html(ERROR_FILE, 413)
+        orig_filename = self.headers.get('Filename') or ''
+        ext = self.upload_extension(orig_filename)
+        if ext is None:
             return
 
-        data = self.rfile.read(length)
-        orig_filename = self.headers.get('Filename')
-        _, ext = os.path.splitext(orig_filename)
         image_id = uuid4()
+        temp_path = None
+        digest = hashlib.sha256() if DEDUP_ENABLED else None
+        try:
+            with NamedTemporaryFile(dir=IMAGES_PATH, prefix='.upload-',
+                                    suffix='.part', delete=False) as file:
+                temp_path = file.name
+                for chunk in self.iter_body(MAX_FILE_SIZE):
+                    file.write(chunk)
+                    if digest:
+                        digest.update(chunk)
+                size = file.tell()
+            os.chmod(temp_path, 0o644)
+        except (RequestBodyError, OSError) as e:
+            self.reject_upload(e, temp_path)
+            return
+
+        stored = metadata_store().add_image(
+            str(image_id), orig_filename, size, ext,
+            digest.hexdigest() if digest else None,
+            lambda stored_name: store_file(temp_path, stored_name))
+        self.finish_upload(image_id, temp_path, stored)
+
+    def finish_upload(self, image_id, temp_path: str,
+                      stored: Optional[tuple[str, Optional[str]]]) -> None:
+        """
+        Answers an upload recorded by the metadata store. Its file is
+        queued for a thumbnail if it was stored, and dropped if the upload
+        failed or shares the file of an identical upload.
+
+        :param image_id: Identifier of the new image.
+        :type image_id: UUID
+        :param temp_path: Path of the uploaded file.
+        :type temp_path: str
+        :param stored: Result of `MetadataStore.add_image`.
+        :type stored: Optional[tuple[str, Optional[str]]]
+        :return: None
+        """
+        if stored is None:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.send_html(ERROR_FILE, 500)
+            return
+        stored_name, path = stored
+        if path:
+            ThumbnailQueue().submit(stored_name, source=path)
+        else:
+            logger.info(f'Upload {image_id} shares blob {stored_name}')
+            os.remove(temp_path)
+        ListingCache().invalidate()
+        self.send_html('upload_success.html', headers={
+            'Location': f'http://localhost/{IMAGES_PATH}{stored_name}'})
+
+    def upload_extension(self, orig_filename: str) -> Optional[str]:
+        """
+        Checks the extension of an uploaded file before its body is read.
+        A file type that is not allowed is answered with 400 Bad Request.
+
+        :param orig_filename: File name given by the client.
+        :type orig_filename: str
+        :return: The extension, or None if the upload was rejected.
+        :rtype: Optional[str]
+        """
+        _, ext = os.path.splitext(orig_filename)
         if ext not in ALLOWED_EXTENSIONS:
             logger.warning('File type is not allowed')
+            self.close_connection = True
             self.send_html(ERROR_FILE, 400)
+            return None
+        return ext
+
+    def reject_upload(self, error: Exception, temp_path) -> None:
+        """
+        Answers an upload whose body could not be stored: 413 if it is too
+        large, 400 otherwise.
+
+        :param error: The error raised while storing the body.
+        :type error: Exception
+        :param temp_path: Path of the temporary file, if it was created.
+        :type temp_path: Optional[str]
+        :return: None
+        """
+        self.discard_upload(temp_path)
+        if isinstance(error, RequestBodyTooLarge):
+            logger.warning('File is too large')
+            self.send_html(ERROR_FILE, 413)
+        else:
+            logger.warning(f'Upload failed: {error}')
+            self.send_html(ERROR_FILE, 400)
+
+    def post_bulk_upload(self) -> None:
+        parser = self.multipart_parser()
+        if parser is None:
             return
-        DBManager().execute_query(
-            f"INSERT INTO images (filename, original_name, size, file_type) "
-            f"VALUES ('{image_id}', '{orig_filename}',"
-            f" {length}, '{ext}');"
-        )
-        with open(IMAGES_PATH + f'{image_id}{ext}', 'wb') as file:
-            file.write(data)
-        self.send_html('upload_success.html', headers={
-            'Location': f'http://localhost/{IMAGES_PATH}{image_id}{ext}'})
+
+        upload = BulkUpload()
+        try:
+            for chunk in self.iter_body(MAX_BULK_UPLOAD_SIZE):
+                upload.handle(parser.feed(chunk))
+            parser.close()
+        except (RequestBodyError, OSError) as e:
+            upload.discard()
+            self.reject_upload(e, None)
+            return
+
+        stored = self.store_uploads(upload.accepted())
+        upload.discard()
+        self.send_bulk_result(upload, stored)
+
+    @staticmethod
+    def store_uploads(files: list) -> bool:
+        """
+        Records the accepted files of a bulk upload in one transaction,
+        inserting all their rows in one batch, and moves them into place.
+        With deduplication, files whose content is already stored are
+        recorded as references to the existing blob.
+
+        :param files: The accepted files.
+        :type files: list[bulk_upload.UploadedFile]
+        :return: True if the files were stored, False if none was.
+        :rtype: bool
+        """
+        if not files:
+            return True
+        new_files = []
+        stored = []
+        try:
+            with DBManager().connection() as conn:
+                rows = []
+                for upload in files:
+                    upload.image_id = uuid4()
+                    blob_name, created = None, True
+                    if upload.digest:
+                        blob_name, created = acquire_blob(
+                            conn, upload.digest.hexdigest(), upload.size,
+                            upload.ext)
+                    upload.stored_name = blob_name or \
+                        f'{upload.image_id}{upload.ext}'
+                    if created:
+                        new_files.append(upload)
+                    rows.append((str(upload.image_id), upload.original_name,
+                                 upload.size, upload.ext, blob_name))
+                with conn.cursor() as cursor:
+                    cursor.executemany(INSERT_IMAGE_QUERY, rows)
+                ImageHostingHttpRequestHandler.move_uploads(new_files, stored)
+        except (psycopg.Error, OSError) as e:
+            logger.error(f'Bulk upload not stored: {e}')
+            ImageHostingHttpRequestHandler.unstore_uploads(files, stored)
+            return False
+
+        ListingCache().invalidate()
+        for stored_name, path in stored:
+            ThumbnailQueue().submit(stored_name, source=path)
+        return True
+
+    @staticmethod
+    def move_uploads(files: list, stored: list) -> None:
+        """
+        Moves the temporary files of new images into place.
+
+        :param files: The files to move.
+        :type files: list[bulk_upload.UploadedFile]
+        :param stored: Collects the stored name and path of every file
+                       moved, so a failed upload can be undone.
+        :type stored: list[tuple[str, str]]
+        :return: None
+        :raises OSError: If a file cannot be moved.
+        """
+        for upload in files:
+            stored.append((upload.stored_name,
+                           store_file(upload.temp_path, upload.stored_name)))
+            upload.temp_path = None
+
+    @staticmethod
+    def unstore_uploads(files: list, stored: list) -> None:
+        """
+        Removes the files of a bulk upload whose transaction failed.
+
+        :param files: The files of the upload.
+        :type files: list[bulk_upload.UploadedFile]
+        :param stored: Stored names and paths of the files already moved.
+        :type stored: list[tuple[str, str]]
+        :return: None
+        """
+        for stored_name, _ in stored:
+            remove_file(stored_name)
+        for upload in files:
+            upload.image_id = None
+
+    def multipart_parser(self) -> Optional[MultipartParser]:
+        """
+        Creates the parser of a ``multipart/form-data`` request body. Any
+        other content type is answered with 400 Bad Request.
+
+        :return: The parser, or None if the request was rejected.
+        :rtype: Optional[multipart.MultipartParser]
+        """
+        boundary = parse_boundary(self.headers.get('Content-Type', ''))
+        if boundary is None:
+            logger.warning('Bulk upload is not multipart/form-data')
+            self.close_connection = True
+            self.send_html(ERROR_FILE, 400)
+            return None
+        return MultipartParser(boundary)
+
+    def send_bulk_result(self, upload: BulkUpload, stored: bool) -> None:
+        """
+        Reports the outcome of every file of a bulk upload.
+
+        :param upload: The bulk upload.
+        :type upload: bulk_upload.BulkUpload
+        :param stored: Whether the accepted files were stored.
+        :type stored: bool
+        :return: None
+        """
+        results = [file.result() for file in upload.files]
+        accepted = sum('error' not in result for result in results)
+        logger.info(f'Bulk upload: {accepted} of {len(results)} files stored')
+        self.send_json({
+            'files': results,
+            'stored': accepted,
+            'rejected': len(results) - accepted
+        }, 200 if stored else 500)
+
+    def discard_upload(self, temp_path) -> None:
+        """
+        Removes a partially written upload and drops the connection, since
+        the rest of the request body is left unread.
+
+        :param temp_path: Path of the temporary file, if it was created.
+        :type temp_path: Optional[str]
+        :return: None
+        """
+        self.close_connection = True
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
 
     def delete_image(self, image_id) -> None:
         full_filename = image_id
@@ -113,14 +448,438 @@ class ImageHostingHttpRequestHandler(AdvancedHTTPRequestHandler):
             self.send_html(ERROR_FILE, 404)
             return
 
-        filename, _ = os.path.splitext(full_filename)
-        image_path = IMAGES_PATH + full_filename
-        if not os.path.exists(image_path):
+        found = metadata_store().delete_image(full_filename,
+                                              self.remove_image_files)
+        self.finish_delete(found)
+
+    def finish_delete(self, found: Optional[bool]) -> None:
+        """
+        Answers a deletion by the metadata store.
+
+        :param found: Result of `MetadataStore.delete_image`.
+        :type found: Optional[bool]
+        :return: None
+        """
+        if found is None:
+            self.send_html(ERROR_FILE, 500)
+            return
+        if not found:
             logger.warning('Image not found')
             self.send_html(ERROR_FILE, 404)
             return
+        ListingCache().invalidate()
+        self.send_json({'Success': 'Image deleted'})
+
+    @staticmethod
+    def remove_image_files(stored_name: str) -> bool:
+        """
+        Removes a stored image together with its thumbnail.
+
+        :param stored_name: File name the image is stored under.
+        :type stored_name: str
+        :return: True if the image was removed, False if it was not stored.
+        :rtype: bool
+        """
+        return remove_image(stored_name)
+
+    def post_bulk_delete(self) -> None:
+        try:
+            body = b''.join(self.iter_body(MAX_REQUEST_SIZE))
+        except RequestBodyError as e:
+            self.reject_upload(e, None)
+            return
+        criteria = self.bulk_delete_criteria(body)
+        if criteria is None:
+            return
+
+        self.start_chunked_response('application/x-ndjson')
+        for progress in bulk_delete(criteria):
+            ListingCache().invalidate()
+            self.write_json_line(progress)
+        self.end_chunked_response()
+
+    def bulk_delete_criteria(self, body: bytes) -> Optional[dict]:
+        """
+        Reads the images selected by a bulk delete request. An invalid
+        body is answered with 400 Bad Request.
+
+        :param body: The JSON body of the request.
+        :type body: bytes
+        :return: The criteria, or None if the request was rejected.
+        :rtype: Optional[dict]
+        """
+        try:
+            return parse_criteria(json.loads(body))
+        except ValueError as e:
+            logger.warning(f'Invalid bulk delete: {e}')
+            self.send_json({'error': str(e)}, 400)
+            return None
+
+    def get_export(self) -> None:
+        export = self.export_request()
+        if export is None:
+            return
+        export_format, filters = export
 
-        os.remove(image_path)
-        DBManager().execute_query(f"DELETE FROM images WHERE filename = '"
-                                  f"{filename}';")
-        self.send_json({'Success': 'Image deleted'})
\ No newline at end of file
+        batches = DBManager().stream(EXPORT_QUERY, filters, EXPORT_BATCH_SIZE)
+        try:
+            try:
+                rows = next(batches, [])
+            except psycopg.Error as e:
+                logger.error(f'Export failed: {e}')
+                self.send_html(ERROR_FILE, 500)
+                return
+            self.start_export(export_format)
+            while rows:
+                self.write_chunk(encode_rows(rows, export_format))
+                rows = next(batches, [])
+        except psycopg.Error as e:
+            logger.error(f'Export interrupted: {e}')
+            self.close_connection = True
+            return
+        except ConnectionError:
+            logger.warning('Export aborted by the client')
+            self.close_connection = True
+            return
+        finally:
+            batches.close()
+        self.end_chunked_response()
+
+    def export_request(self) -> Optional[tuple[str, dict]]:
+        """
+        Reads the format and filters of an export from the query string.
+        Invalid parameters are answered with 400 Bad Request.
+
+        :return: The format and the query parameters, or None if the
+                 request was rejected.
+        :rtype: Optional[tuple[str, dict]]
+        """
+        try:
+            return parse_export_request(urlsplit(self.path).query)
+        except ValueError as e:
+            logger.warning(f'Invalid export: {e}')
+            self.send_json({'error': str(e)}, 400)
+            return None
+
+    def start_export(self, export_format: str) -> None:
+        """
+        Starts the streamed response of an export. A failure after this
+        point drops the connection, so the client sees the export end
+        without its final chunk.
+
+        :param export_format: ``ndjson`` or ``csv``.
+        :type export_format: str
+        :return: None
+        """
+        self.start_chunked_response(EXPORT_FORMATS[export_format], headers={
+            'Content-Disposition':
+                f'attachment; filename="images.{export_format}"'})
+        self.write_chunk(export_header(export_format))
+
+    def get_image(self, filename) -> None:
+        image = self.start_image_response(filename)
+        if image is None:
+            return
+        file, offset, count = image
+        with file:
+            try:
+                if count:
+                    self.connection.sendfile(file, offset, count)
+            except ConnectionError:
+                logger.debug('Image download aborted by the client')
+                self.close_connection = True
+
+    def start_image_response(self, filename: str) \
+            -> Optional[tuple[BinaryIO, int, int]]:
+        """
+        Answers the conditions of a request for a stored image and sends
+        the headers of the response. The body is left to the caller, to
+        be sent from the file with ``sendfile``.
+
+        A missing image is answered with 404 Not Found, a current copy of
+        the client with 304 Not Modified and a range beyond the end of the
+        file with 416 Range Not Satisfiable.
+
+        :param filename: File name of the image, with extension.
+        :type filename: str
+        :return: The open file, the offset and the number of bytes to
+                 send, or None if the response is complete.
+        :rtype: Optional[tuple[BinaryIO, int, int]]
+        """
+        path = resolve_image(filename)
+        try:
+            file = open(path, 'rb') if path else None
+        except OSError:
+            file = None
+        if file is None:
+            self.default_response()
+            return None
+
+        stat = os.fstat(file.fileno())
+        etag = file_etag(stat)
+        headers = {'ETag': etag, 'Last-Modified': last_modified(stat),
+                   'Accept-Ranges': 'bytes'}
+        if self.is_not_modified(etag, stat.st_mtime):
+            file.close()
+            self.send_response(304)
+            self.send_headers(headers)
+            return None
+        try:
+            byte_range = parse_range(self.headers.get('Range'),
+                                     self.headers.get('If-Range'), stat)
+        except ValueError:
+            file.close()
+            self.send_response(416)
+            self.send_headers({'Content-Range': f'bytes */{stat.st_size}',
+                               'Content-Length': '0'})
+            return None
+
+        first, last = byte_range or (0, stat.st_size - 1)
+        self.send_response(206 if byte_range else 200)
+        headers['Content-type'] = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        headers['Content-Length'] = str(last - first + 1)
+        if byte_range:
+            headers['Content-Range'] = f'bytes {first}-{last}/{stat.st_size}'
+        self.send_headers(headers)
+        return file, first, last - first + 1
+
+    def send_headers(self, headers: dict) -> None:
+        """
+        Sends the headers of a response and finishes them.
+
+        :param headers: The headers, by name.
+        :type headers: dict
+        :return: None
+        """
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_response_headers()
+
+    def get_thumbnails_state(self) -> None:
+        self.send_json(ThumbnailQueue().state())
+
+    def get_metrics(self) -> None:
+        self.send_text(render_metrics(),
+                       content_type='text/plain; version=0.0.4; '
+                                    'charset=utf-8')
+
+
+class AsyncImageHostingHttpRequestHandler(AsyncRequestHandlerMixin,
+                                          ImageHostingHttpRequestHandler):
+    """
+    Image hosting handler for the asyncio server engine.
+
+    The listing, upload and deletion handlers are coroutines querying the
+    metadata store; uploads are written to disk in
+    worker threads while the next chunk is received. Other handlers are
+    inherited and run in threads.
+    """
+
+    async def get_images_count(self) -> None:
+        count = await metadata_store().count_async()
+        if count is None:
+            self.send_html(ERROR_FILE, 500)
+            return
+        logger.debug('Count: {}', count)
+        self.send_json({
+            'count': count
+        })
+
+    async def get_images(self) -> None:
+        key = self.listing_key()
+        body, generation = ListingCache().get(key)
+        if body is None:
+            position = self.listing_position()
+            if position is None:
+                return
+            images = await metadata_store().list_images_async(*position)
+            body = self.encode_images(images)
+            if images is not None:
+                ListingCache().put(key, body, generation)
+        self.send_json(body)
+
+    async def post_upload(self) -> None:
+        orig_filename = self.headers.get('Filename') or ''
+        ext = self.upload_extension(orig_filename)
+        if ext is None:
+            return
+
+        image_id = uuid4()
+        temp_path = None
+        digest = hashlib.sha256() if DEDUP_ENABLED else None
+        try:
+            file = await asyncio.to_thread(
+                NamedTemporaryFile, dir=IMAGES_PATH, prefix='.upload-',
+                suffix='.part', delete=False)
+            temp_path = file.name
+            writing = None
+            try:
+                async for chunk in self.aiter_body(MAX_FILE_SIZE):
+                    if writing:
+                        await writing
+                    writing = asyncio.ensure_future(
+                        asyncio.to_thread(file.write, chunk))
+                    if digest:
+                        digest.update(chunk)
+                if writing:
+                    await writing
+                size = file.tell()
+            finally:
+                if writing:
+                    await asyncio.gather(writing, return_exceptions=True)
+                await asyncio.to_thread(file.close)
+            os.chmod(temp_path, 0o644)
+        except (RequestBodyError, OSError) as e:
+            self.reject_upload(e, temp_path)
+            return
+
+        stored = await metadata_store().add_image_async(
+            str(image_id), orig_filename, size, ext,
+            digest.hexdigest() if digest else None,
+            lambda stored_name: store_file(temp_path, stored_name))
+        self.finish_upload(image_id, temp_path, stored)
+
+    async def post_bulk_upload(self) -> None:
+        parser = self.multipart_parser()
+        if parser is None:
+            return
+
+        upload = BulkUpload()
+        try:
+            async for chunk in self.aiter_body(MAX_BULK_UPLOAD_SIZE):
+                events = parser.feed(chunk)
+                if events:
+                    await asyncio.to_thread(upload.handle, events)
+            parser.close()
+        except (RequestBodyError, OSError) as e:
+            await asyncio.to_thread(upload.discard)
+            self.reject_upload(e, None)
+            return
+
+        stored = await self.store_uploads_async(upload.accepted())
+        await asyncio.to_thread(upload.discard)
+        self.send_bulk_result(upload, stored)
+
+    @staticmethod
+    async def store_uploads_async(files: list) -> bool:
+        """
+        Asynchronous version of ``store_uploads``.
+
+        :param files: The accepted files.
+        :type files: list[bulk_upload.UploadedFile]
+        :return: True if the files were stored, False if none was.
+        :rtype: bool
+        """
+        if not files:
+            return True
+        new_files = []
+        stored = []
+        try:
+            async with AsyncDBManager().connection() as conn:
+                rows = []
+                for upload in files:
+                    upload.image_id = uuid4()
+                    blob_name, created = None, True
+                    if upload.digest:
+                        blob_name, created = await acquire_blob_async(
+                            conn, upload.digest.hexdigest(), upload.size,
+                            upload.ext)
+                    upload.stored_name = blob_name or \
+                        f'{upload.image_id}{upload.ext}'
+                    if created:
+                        new_files.append(upload)
+                    rows.append((str(upload.image_id), upload.original_name,
+                                 upload.size, upload.ext, blob_name))
+                async with conn.cursor() as cursor:
+                    await cursor.executemany(INSERT_IMAGE_QUERY, rows)
+                await asyncio.to_thread(
+                    ImageHostingHttpRequestHandler.move_uploads, new_files,
+                    stored)
+        except (psycopg.Error, OSError) as e:
+            logger.error(f'Bulk upload not stored: {e}')
+            await asyncio.to_thread(
+                ImageHostingHttpRequestHandler.unstore_uploads, files, stored)
+            return False
+
+        ListingCache().invalidate()
+        for stored_name, path in stored:
+            ThumbnailQueue().submit(stored_name, source=path)
+        return True
+
+    async def delete_image(self, image_id) -> None:
+        full_filename = image_id
+        if not full_filename:
+            logger.warning('No filename is provided')
+            self.send_html(ERROR_FILE, 404)
+            return
+
+        found = await metadata_store().delete_image_async(
+            full_filename, self.remove_image_files)
+        self.finish_delete(found)
+
+    async def post_bulk_delete(self) -> None:
+        try:
+            body = b''.join([chunk async for chunk
+                             in self.aiter_body(MAX_REQUEST_SIZE)])
+        except RequestBodyError as e:
+            self.reject_upload(e, None)
+            return
+        criteria = self.bulk_delete_criteria(body)
+        if criteria is None:
+            return
+
+        self.start_chunked_response('application/x-ndjson')
+        async for progress in bulk_delete_async(criteria):
+            ListingCache().invalidate()
+            self.write_json_line(progress)
+            await self.flush()
+        self.end_chunked_response()
+
+    async def get_export(self) -> None:
+        export = self.export_request()
+        if export is None:
+            return
+        export_format, filters = export
+
+        batches = AsyncDBManager().stream(EXPORT_QUERY, filters,
+                                          EXPORT_BATCH_SIZE)
+        try:
+            try:
+                rows = await anext(batches, [])
+            except psycopg.Error as e:
+                logger.error(f'Export failed: {e}')
+                self.send_html(ERROR_FILE, 500)
+                return
+            self.start_export(export_format)
+            while rows:
+                self.write_chunk(encode_rows(rows, export_format))
+                await self.flush()
+                rows = await anext(batches, [])
+        except psycopg.Error as e:
+            logger.error(f'Export interrupted: {e}')
+            self.close_connection = True
+            return
+        except ConnectionError:
+            logger.warning('Export aborted by the client')
+            self.close_connection = True
+            return
+        finally:
+            await batches.aclose()
+        self.end_chunked_response()
+
+    async def get_image(self, filename) -> None:
+        image = await asyncio.to_thread(self.start_image_response, filename)
+        if image is None:
+            return
+        file, offset, count = image
+        try:
+            await self.flush()
+            if count:
+                await asyncio.get_running_loop().sendfile(
+                    self.writer.transport, file, offset, count)
+        except ConnectionError:
+            logger.debug('Image download aborted by the client')
+            self.close_connection = True
+        finally:
+            file.close()
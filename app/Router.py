@@ -3,27 +3,33 @@ This module provides a Router class for managing HTTP routes.
 
 Key Classes:
 - Router: Handles routing by associating URL paths with handler functions.
+- TrieRouter: Routing engine resolving paths through a segment trie.
+- RegexRouter: Routing engine scanning a list of compiled regexes.
 
 Dependencies:
 - re: Used for compiling and matching regular expressions.
-- loguru: Used for logging purposes.
+- uuid: Used by the ``uuid`` path converter.
 """
 
 import re
+from uuid import UUID
 
-from loguru import logger
-
+from settings import ROUTER_ENGINE
 from singleton import SingletonMeta
 
+PLACEHOLDER = re.compile(r'<(\w+)(?::(\w+))?>')
 
-class Router(metaclass=SingletonMeta):
-    """
-    Handles routing for HTTP methods and paths.
+CONVERTERS = {
+    'str': str,
+    'int': int,
+    'uuid': UUID,
+}
 
-    This class manages a set of routes and provides functionality for adding
-    routes and resolving paths to their corresponding handlers.
-    It supports HTTP methods such as GET, POST, DELETE, and it uses regular
-    expressions for path matching.
+
+class RegexRouter:
+    """
+    Routing engine matching the path against every registered route
+    in turn.
 
     :ivar routes: A dictionary holding routes for each HTTP method.
     The keys
@@ -68,13 +74,6 @@ class Router(metaclass=SingletonMeta):
         Adds a new route to the routing table
         by compiling the given path pattern.
 
-        This method registers a handler function
-        associated with a specific HTTP
-        method and path.
-        The path is converted into a regular expression pattern,
-        and the resulting compiled pattern is added to the routing table under
-        the specified HTTP method.
-
         :param method: The HTTP method (e.g., 'GET', 'POST')
                 to associate with the route.
         :type method: str
@@ -88,16 +87,12 @@ class Router(metaclass=SingletonMeta):
         """
         pattern = self.convert_path(path)
         compiled = re.compile(pattern)
-        self.routes[method][compiled] = handler
+        self.routes.setdefault(method, {})[compiled] = handler
 
     def resolve(self, method, path) -> tuple[callable, dict]:
         """
-        Resolves a method and path to a corresponding handler function
-        and any extracted parameters from the request path.
-        This process matches the path against the available routes
-        for the specified HTTP method and returns the appropriate
-        handler and extracted parameters, if found.
-        If no match is found, it returns `None` and an empty dictionary.
+        Resolves a method and path by matching the path against the
+        registered patterns one after another.
 
         :param method: The HTTP method (e.g., 'GET', 'POST').
         :type method: str
@@ -107,14 +102,235 @@ class Router(metaclass=SingletonMeta):
         and a dictionary with extracted parameters from the path.
         If no match is found, returns (None, {}).
         """
-        logger.info(f'Resolving {method} {path}')
         if method not in self.routes:
             return None, {}
 
         for pattern, handler in self.routes[method].items():
             match = pattern.match(path)
             if match:
-                logger.info(f'Found handler for {method} {path}')
                 kwargs = match.groupdict()
                 return handler, kwargs
-        return None, {}
\ No newline at end of file
+        return None, {}
+
+
+class TrieNode:
+    """
+    A node of the segment trie.
+
+    :ivar static: Children reached through a literal path segment.
+    :type static: dict[str, TrieNode]
+    :ivar params: Children reached through a placeholder, as
+                  ``(name, converter, node)`` tuples in registration order.
+    :type params: list[tuple]
+    :ivar handler: The handler of the route ending at this node.
+    :type handler: Optional[Callable]
+    """
+    __slots__ = ('static', 'params', 'handler')
+
+    def __init__(self) -> None:
+        self.static = {}
+        self.params = []
+        self.handler = None
+
+
+class TrieRouter:
+    """
+    Routing engine resolving paths in O(path length).
+
+    Registered paths are split into segments and stored in a trie per HTTP
+    method. Literal segments are tried before placeholders, and paths
+    without placeholders are additionally kept in a dictionary, so they
+    resolve with a single lookup.
+
+    Placeholders may name a converter, as in ``<image_id:uuid>``;
+    ``str`` (the default), ``int`` and ``uuid`` are available. A segment
+    the converter rejects does not match the placeholder.
+
+    :ivar routes: Root trie node for each HTTP method.
+    :type routes: dict[str, TrieNode]
+    :ivar static_routes: Handlers of placeholder-free paths for each method.
+    :type static_routes: dict[str, dict[str, Callable]]
+    """
+    def __init__(self):
+        self.routes = {}
+        self.static_routes = {}
+
+    def add_route(self, method, path, handler) -> None:
+        """
+        Adds a new route to the trie of the given HTTP method.
+
+        :param method: The HTTP method (e.g., 'GET', 'POST')
+                to associate with the route.
+        :type method: str
+        :param path: The URL path pattern which can include
+                ``<name>`` or ``<name:converter>`` segments.
+        :type path: str
+        :param handler: The function or callable to be executed
+                        when the route matches.
+        :type handler: Callable
+        :return: None
+        :raises ValueError: If a placeholder names an unknown converter.
+        """
+        node = self.routes.setdefault(method, TrieNode())
+        for segment in path.split('/'):
+            placeholder = PLACEHOLDER.fullmatch(segment)
+            if not placeholder:
+                node = node.static.setdefault(segment, TrieNode())
+                continue
+
+            name, converter_name = placeholder.groups()
+            converter = CONVERTERS.get(converter_name or 'str')
+            if converter is None:
+                raise ValueError(f'Unknown converter {converter_name!r} '
+                                 f'in {path}')
+            for param_name, param_converter, child in node.params:
+                if (param_name, param_converter) == (name, converter):
+                    node = child
+                    break
+            else:
+                child = TrieNode()
+                node.params.append((name, converter, child))
+                node = child
+        node.handler = handler
+
+        if not PLACEHOLDER.search(path):
+            self.static_routes.setdefault(method, {})[path] = handler
+
+    def resolve(self, method, path) -> tuple[callable, dict]:
+        """
+        Resolves a method and path to a corresponding handler function
+        and any extracted parameters from the request path.
+        The query string, if any, is ignored.
+        If no match is found, it returns `None` and an empty dictionary.
+
+        :param method: The HTTP method (e.g., 'GET', 'POST').
+        :type method: str
+        :param path: The request path to resolve into a handler.
+        :type path: str
+        :return: A tuple containing the resolved handler (callable)
+        and a dictionary with extracted parameters from the path.
+        If no match is found, returns (None, {}).
+        """
+        path = path.partition('?')[0]
+        handler = self.static_routes.get(method, {}).get(path)
+        if handler:
+            return handler, {}
+
+        root = self.routes.get(method)
+        if root is None:
+            return None, {}
+        params = {}
+        handler = self._match(root, path.split('/'), 0, params)
+        if handler is None:
+            return None, {}
+        return handler, params
+
+    def _match(self, node, segments, index, params):
+        """
+        Walks the trie depth first, preferring literal segments and
+        backtracking into placeholders.
+
+        :param node: The node matched so far.
+        :type node: TrieNode
+        :param segments: The segments of the request path.
+        :type segments: list[str]
+        :param index: Index of the next segment to match.
+        :type index: int
+        :param params: Collects the converted placeholder values.
+        :type params: dict
+        :return: The matched handler or None.
+        :rtype: Optional[Callable]
+        """
+        if index == len(segments):
+            return node.handler
+
+        segment = segments[index]
+        child = node.static.get(segment)
+        if child is not None:
+            handler = self._match(child, segments, index + 1, params)
+            if handler is not None:
+                return handler
+
+        if not segment:
+            return None
+        for name, converter, child in node.params:
+            try:
+                params[name] = converter(segment)
+            except ValueError:
+                continue
+            handler = self._match(child, segments, index + 1, params)
+            if handler is not None:
+                return handler
+            del params[name]
+        return None
+
+
+ROUTER_ENGINES = {
+    'trie': TrieRouter,
+    'regex': RegexRouter,
+}
+
+
+class Router(metaclass=SingletonMeta):
+    """
+    Handles routing for HTTP methods and paths.
+
+    This class manages a set of routes and provides functionality for adding
+    routes and resolving paths to their corresponding handlers.
+    It supports HTTP methods such as GET, POST, DELETE, and it delegates
+    path matching to the engine selected by ``ROUTER_ENGINE``.
+
+    :ivar engine: The routing engine holding the routes.
+    :type engine: TrieRouter | RegexRouter
+    """
+    def __init__(self, engine=ROUTER_ENGINE):
+        self.engine = ROUTER_ENGINES[engine]()
+
+    @property
+    def routes(self) -> dict:
+        """
+        The routing table of the engine, keyed by HTTP method.
+
+        :rtype: dict
+        """
+        return self.engine.routes
+
+    def add_route(self, method, path, handler) -> None:
+        """
+        Adds a new route to the routing table.
+
+        This method registers a handler function
+        associated with a specific HTTP
+        method and path.
+
+        :param method: The HTTP method (e.g., 'GET', 'POST')
+                to associate with the route.
+        :type method: str
+        :param path: The URL path pattern which can include
+                dynamic segments to match.
+        :type path: str
+        :param handler: The function or callable to be executed
+                        when the route matches.
+        :type handler: Callable
+        :return: None
+        """
+        self.engine.add_route(method, path, handler)
+
+    def resolve(self, method, path) -> tuple[callable, dict]:
+        """
+        Resolves a method and path to a corresponding handler function
+        and any extracted parameters from the request path.
+        This process matches the path against the available routes
+        for the specified HTTP method and returns the appropriate
+        handler and extracted parameters, if found.
+        If no match is found, it returns `None` and an empty dictionary.
+
+        :param method: The HTTP method (e.g., 'GET', 'POST').
+        :type method: str
+        :param path: The request path to resolve into a handler.
+        :type path: str
+        :return: A tuple containing the resolved handler (callable)
+        and a dictionary with extracted parameters from the path.
+        If no match is found, returns (None, {}).
+        """
+        return self.engine.resolve(method, path)
@@ -0,0 +1,261 @@
+"""
+Admission Control Module
+
+This module bounds the number of requests of every route class that are
+handled at once, so that when the database slows down requests wait a
+bounded time and are then refused, instead of piling up until clients
+time out after the server has already done the work.
+
+Uploads, listings and deletions each get a budget of their own. A request
+over its budget waits for a slot at most ``ADMISSION_QUEUE_TIMEOUT``
+seconds; if none frees up, or ``ADMISSION_QUEUE_SIZE`` requests of its
+class are waiting already, it is answered 503 with ``Retry-After``
+without touching the database, and an upload is refused before its body
+is read. Routes of no class, such as static images and the metrics, are
+never held back.
+
+On the threaded servers a request holds a pool thread while it waits, so
+the limits default to fractions of ``SERVER_THREADS``: a flood of one
+class fills its slots and its queue, leaving threads for the others.
+
+Key Features:
+- Per-route-class in-flight limits, set by ``ADMISSION_UPLOADS``,
+  ``ADMISSION_LISTINGS`` and ``ADMISSION_DELETES``; 0 lifts a limit.
+- A bounded queue per class and a queue-time deadline after which
+  waiting requests are shed.
+- The queue depth, the requests in flight, the time spent queued and the
+  rejections of every class are exported as metrics.
+- Thread slots for the threaded servers and asyncio slots for the asyncio
+  server.
+
+Classes:
+----------
+- AdmissionBudget:
+- AdmissionControl:
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager, contextmanager
+from threading import Semaphore
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, \
+    ADMISSION_REJECTED, ADMISSION_WAIT
+from settings import ADMISSION_UPLOADS, ADMISSION_LISTINGS, \
+    ADMISSION_DELETES, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+from singleton import SingletonMeta
+
+ROUTE_CLASSES = {
+    'post_upload': 'upload',
+    'post_bulk_upload': 'upload',
+    'get_images': 'listing',
+    'get_images_count': 'listing',
+    'get_export': 'listing',
+    'delete_image': 'delete',
+    'post_bulk_delete': 'delete',
+}
+
+
+class AdmissionBudget:
+    """
+    Slots of one route class.
+
+    The asyncio slots are created on first use, inside the event loop of
+    the asyncio server.
+
+    :ivar route_class: Name of the route class.
+    :type route_class: str
+    :ivar limit: Maximum number of requests handled at once.
+    :type limit: int
+    :ivar queue_size: Maximum number of requests waiting for a slot.
+    :type queue_size: int
+    :ivar timeout: Seconds a request waits for a slot.
+    :type timeout: float
+    """
+    def __init__(self, route_class, limit, queue_size=ADMISSION_QUEUE_SIZE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT) -> None:
+        self.route_class = route_class
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._slots = Semaphore(limit)
+        self._queue = Semaphore(queue_size)
+        self._async_slots = None
+        self._async_waiting = 0
+
+    def acquire(self) -> bool:
+        """
+        Takes a slot, waiting at most ``timeout`` seconds for one unless
+        the queue is full.
+
+        :return: True if a slot was taken, False if the request is shed.
+        :rtype: bool
+        """
+        if self._slots.acquire(blocking=False):
+            return self._admit()
+        if not self._queue.acquire(blocking=False):
+            return self._reject()
+        started = time.perf_counter()
+        ADMISSION_QUEUE_DEPTH.inc(1, self.route_class)
+        try:
+            admitted = self._slots.acquire(timeout=self.timeout)
+        finally:
+            ADMISSION_QUEUE_DEPTH.dec(1, self.route_class)
+            self._queue.release()
+        return self._queued(admitted, started)
+
+    def release(self) -> None:
+        """
+        Returns a slot taken by `acquire`.
+
+        :return: None
+        """
+        ADMISSION_IN_FLIGHT.dec(1, self.route_class)
+        self._slots.release()
+
+    async def acquire_async(self) -> bool:
+        """
+        Takes an asyncio slot, waiting at most ``timeout`` seconds for one
+        unless the queue is full.
+
+        :return: True if a slot was taken, False if the request is shed.
+        :rtype: bool
+        """
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.limit)
+        if not self._async_slots.locked():
+            await self._async_slots.acquire()
+            return self._admit()
+        if self._async_waiting >= self.queue_size:
+            return self._reject()
+        started = time.perf_counter()
+        self._async_waiting += 1
+        ADMISSION_QUEUE_DEPTH.inc(1, self.route_class)
+        try:
+            await asyncio.wait_for(self._async_slots.acquire(), self.timeout)
+            admitted = True
+        except TimeoutError:
+            admitted = False
+        finally:
+            self._async_waiting -= 1
+            ADMISSION_QUEUE_DEPTH.dec(1, self.route_class)
+        return self._queued(admitted, started)
+
+    def release_async(self) -> None:
+        """
+        Returns a slot taken by `acquire_async`.
+
+        :return: None
+        """
+        ADMISSION_IN_FLIGHT.dec(1, self.route_class)
+        self._async_slots.release()
+
+    def _admit(self) -> bool:
+        """
+        Counts a request that took a slot.
+
+        :return: True
+        :rtype: bool
+        """
+        ADMISSION_IN_FLIGHT.inc(1, self.route_class)
+        return True
+
+    def _queued(self, admitted: bool, started: float) -> bool:
+        """
+        Records the wait of a request that had to queue for a slot.
+
+        :param admitted: Whether the request got a slot in time.
+        :type admitted: bool
+        :param started: ``time.perf_counter()`` when the request queued.
+        :type started: float
+        :return: Whether the request got a slot.
+        :rtype: bool
+        """
+        ADMISSION_WAIT.observe(time.perf_counter() - started,
+                               self.route_class)
+        if admitted:
+            return self._admit()
+        return self._reject()
+
+    def _reject(self) -> bool:
+        """
+        Counts a request that is shed.
+
+        :return: False
+        :rtype: bool
+        """
+        ADMISSION_REJECTED.inc(1, self.route_class)
+        return False
+
+
+class AdmissionControl(metaclass=SingletonMeta):
+    """
+    Holds the budgets of the route classes and admits requests to them.
+
+    :ivar budgets: Budget of every limited route class, by name.
+    :type budgets: dict[str, AdmissionBudget]
+    """
+    def __init__(self, limits=None, queue_size=ADMISSION_QUEUE_SIZE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT) -> None:
+        if limits is None:
+            limits = {'upload': ADMISSION_UPLOADS,
+                      'listing': ADMISSION_LISTINGS,
+                      'delete': ADMISSION_DELETES}
+        self.budgets = {route_class: AdmissionBudget(route_class, limit,
+                                                     queue_size, timeout)
+                        for route_class, limit in limits.items() if limit > 0}
+
+    def budget(self, handler: Callable) -> Optional[AdmissionBudget]:
+        """
+        Finds the budget a handler is subject to.
+
+        :param handler: The handler of the request.
+        :type handler: Callable
+        :return: The budget, or None if the route is not limited.
+        :rtype: Optional[AdmissionBudget]
+        """
+        return self.budgets.get(ROUTE_CLASSES.get(handler.__name__))
+
+    @contextmanager
+    def admit(self, handler: Callable) -> Iterator[bool]:
+        """
+        Holds a slot of the budget of a handler while it runs.
+
+        :param handler: The handler of the request.
+        :type handler: Callable
+        :return: A context manager yielding whether the request may be
+                 handled; the slot is returned on exit.
+        :rtype: Iterator[bool]
+        """
+        budget = self.budget(handler)
+        if budget is None:
+            yield True
+        elif not budget.acquire():
+            yield False
+        else:
+            try:
+                yield True
+            finally:
+                budget.release()
+
+    @asynccontextmanager
+    async def admit_async(self, handler: Callable) -> AsyncIterator[bool]:
+        """
+        Holds an asyncio slot of the budget of a handler while it runs.
+
+        :param handler: The handler of the request.
+        :type handler: Callable
+        :return: An asynchronous context manager yielding whether the
+                 request may be handled; the slot is returned on exit.
+        :rtype: AsyncIterator[bool]
+        """
+        budget = self.budget(handler)
+        if budget is None:
+            yield True
+        elif not await budget.acquire_async():
+            yield False
+        else:
+            try:
+                yield True
+            finally:
+                budget.release_async()
@@ -1,20 +1,39 @@
 """
 AdvancedHTTPRequestHandler is a class that handles HTTP requests and
-responses. It provides methods to send HTML and JSON responses and
-is used to handle GET, POST, and DELETE requests.
+responses. It provides methods to send HTML and JSON responses, to stream
+request bodies and responses in chunks and is used to handle GET, POST,
+and DELETE requests over persistent HTTP/1.1 connections.
 
 """
 import json
+import time
+from email.utils import parsedate_to_datetime
 from http.server import BaseHTTPRequestHandler
+from typing import Iterator, Union
 
 from loguru import logger
 
 from Router import Router
-from settings import STATIC_PATH, LOG_PATH, LOG_FILE
+from admission import AdmissionControl
+from log_config import configure_logging, should_log_request
+from metrics import REQUEST_DURATION, REQUESTS_IN_FLIGHT, UPLOAD_BYTES
+from settings import STATIC_PATH, UPLOAD_CHUNK_SIZE, KEEPALIVE_TIMEOUT, \
+    ERROR_FILE, ADMISSION_RETRY_AFTER
+from static_cache import StaticCache, choose_coding
 
-logger.add(LOG_PATH + LOG_FILE,
-           format='[{time:YYYY-MM-DD HH:mm:ss}] {level}: {message}',
-           level='INFO')
+configure_logging()
+
+
+class RequestBodyError(Exception):
+    """
+    Raised when a request body is malformed or ends prematurely.
+    """
+
+
+class RequestBodyTooLarge(RequestBodyError):
+    """
+    Raised as soon as a request body grows beyond the allowed size.
+    """
 
 
 class AdvancedHTTPRequestHandler(BaseHTTPRequestHandler):
@@ -24,6 +43,30 @@ class AdvancedHTTPRequestHandler(BaseHTTPRequestHandler):
     Extends BaseHTTPRequestHandler to provide
     enhanced handling of requests and responses.
 
+    Connections are kept alive between requests (HTTP/1.1) until they stay
+    idle for ``KEEPALIVE_TIMEOUT`` seconds. Every response carries a
+    ``Content-Length`` or is sent chunked, and a connection whose request
+    body was not read to the end is closed, so pipelined requests are never
+    misparsed.
+
+    :cvar protocol_version: The HTTP version of the responses.
+    :type protocol_version: str
+    :cvar disable_nagle_algorithm: Sets ``TCP_NODELAY`` on the connection,
+        so a response written as headers and body is not held back by
+        Nagle's algorithm waiting for a delayed ACK of the client.
+    :type disable_nagle_algorithm: bool
+    :cvar timeout: Idle timeout of the connection socket in seconds.
+    :type timeout: float
+    :ivar body_pending: Whether the request body has not been read yet.
+    :type body_pending: bool
+    :ivar response_status: Status code of the response being sent.
+    :type response_status: Optional[int]
+    :ivar response_chunked: Whether the streamed response is sent with
+                            ``Transfer-Encoding: chunked``.
+    :type response_chunked: bool
+    :ivar parked: Whether the idle connection was left to the server to
+                  watch for its next request.
+    :type parked: bool
     :ivar default_response: A lambda function used to send a 404 HTML response
                             when no handler is found for a request.
     :type default_response: Callable[[], None]
@@ -31,11 +74,67 @@ class AdvancedHTTPRequestHandler(BaseHTTPRequestHandler):
                 and determine appropriate handlers.
     :type router: Router
     """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    timeout = KEEPALIVE_TIMEOUT
+
     def __init__(self, request, client_address, server) -> None:
         self.default_response = lambda: self.send_html('404.html', 404)
         self.router = Router()
+        self.body_pending = False
+        self.response_status = None
+        self.response_chunked = False
+        self.parked = False
         super().__init__(request, client_address, server)
 
+    def handle(self) -> None:
+        """
+        Handles requests until the connection is to be closed.
+
+        If the server watches idle connections, a keep-alive connection
+        whose next request has not arrived yet is parked instead of
+        waiting for it, freeing the thread for other connections.
+
+        :return: None
+        """
+        idle = getattr(self.server, 'idle', None)
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if idle is not None and not self.next_request_ready():
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def next_request_ready(self) -> bool:
+        """
+        Checks without blocking whether the next request of the connection
+        has started to arrive.
+
+        :return: True if request bytes are buffered or readable.
+        :rtype: bool
+        """
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def send_response(self, code, message=None) -> None:
+        """
+        Starts the response, remembering its status code for the metrics.
+
+        :param code: HTTP status code of the response.
+        :type code: int
+        :param message: Reason phrase; the standard one if not given.
+        :type message: str, optional
+        :return: None
+        """
+        self.response_status = code
+        super().send_response(code, message)
+
     def send_html(self, file, code=200, headers=None, file_path=STATIC_PATH) \
             -> None:
 
@@ -44,6 +143,13 @@ class AdvancedHTTPRequestHandler(BaseHTTPRequestHandler):
         The response includes a status code, headers, and the contents
         of the specified HTML file.
 
+        The file is served from the static asset cache, compressed if the
+        client accepts it. A successful GET whose ``If-None-Match`` or
+        ``If-Modified-Since`` validators match the file is answered with
+        304 Not Modified and no body. If the file is missing, a successful
+        response becomes the 404 page, and any other status is sent with
+        the built-in error page.
+
         :param file: Name of the HTML file to be sent as the response body.
         :type file: str
         :param code: HTTP status code to be sent in the response.
@@ -58,24 +164,79 @@ class AdvancedHTTPRequestHandler(BaseHTTPRequestHandler):
         :type file_path: str, optional
         :return: None
         """
+        try:
+            asset = StaticCache().get(file_path + file)
+        except FileNotFoundError:
+            logger.error(f'Static file {file_path + file} not found')
+            if code == 200:
+                self.default_response()
+            else:
+                self.send_error(code)
+            return
+        coding = choose_coding(asset, self.headers.get('Accept-Encoding'))
+        etag = asset.variant_etag(coding)
+        if code == 200 and self.command == 'GET' and \
+                self.is_not_modified(etag, asset.mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', asset.last_modified)
+            self.end_response_headers()
+            return
+
+        body = asset.variants[coding]
         self.send_response(code)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if coding != 'identity':
+            self.send_header('Content-Encoding', coding)
+        if len(asset.variants) > 1:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', asset.last_modified)
         if headers:
             for header, value in headers.items():
                 self.send_header(header, value)
-        self.end_headers()
-        with open(file_path + file, 'rb') as file:
-            self.wfile.write(file.read())
+        self.end_response_headers()
+        self.wfile.write(body)
 
-    def send_json(self, response: dict, code=200, headers=None) -> None:
+    def is_not_modified(self, etag: str, mtime: float) -> bool:
+        """
+        Evaluates the conditional request headers against a resource.
+
+        ``If-None-Match`` takes precedence; ``If-Modified-Since`` is only
+        consulted when it is absent.
+
+        :param etag: Current entity tag of the resource.
+        :type etag: str
+        :param mtime: Modification time of the resource.
+        :type mtime: float
+        :return: True if the copy held by the client is still current.
+        :rtype: bool
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = {tag.strip() for tag in if_none_match.split(',')}
+            return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def send_json(self, response: Union[dict, bytes], code=200,
+                  headers=None) -> None:
         """
         Send a JSON response to the client. This method sets the response code,
         adds the required headers, and writes the JSON-encoded response body
         to the output stream.
 
         :param response: The JSON-serializable dictionary object to
-            send as the response body.
-        :type response: dict
+            send as the response body, or the already encoded body.
+        :type response: Union[dict, bytes]
         :param code: The HTTP status code for the response (default is 200).
         :type code: int, optional
         :param headers: Additional headers to include in the response.
@@ -84,13 +245,217 @@ class AdvancedHTTPRequestHandler(BaseHTTPRequestHandler):
         :type headers: dict, optional
         :return: None
         """
+        body = response if isinstance(response, bytes) else \
+            json.dumps(response).encode('utf-8')
         self.send_response(code)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if headers:
+            for header, value in headers.items():
+                self.send_header(header, value)
+        self.end_response_headers()
+        self.wfile.write(body)
+
+    def send_text(self, body: str, content_type='text/plain; charset=utf-8',
+                  code=200) -> None:
+        """
+        Sends a plain text response to the client.
+
+        :param body: The text of the response.
+        :type body: str
+        :param content_type: Value of the ``Content-type`` header.
+        :type content_type: str, optional
+        :param code: The HTTP status code for the response (default is 200).
+        :type code: int, optional
+        :return: None
+        """
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_response_headers()
+        self.wfile.write(data)
+
+    def start_chunked_response(self, content_type: str, code=200,
+                               headers=None) -> None:
+        """
+        Starts a response whose body is streamed with `write_chunk`, for
+        bodies whose length is not known in advance. HTTP/1.0 clients get
+        the body unframed, ended by closing the connection.
+
+        :param content_type: Value of the ``Content-type`` header.
+        :type content_type: str
+        :param code: The HTTP status code for the response (default is 200).
+        :type code: int, optional
+        :param headers: Additional headers to include in the response.
+        :type headers: dict, optional
+        :return: None
+        """
+        self.response_chunked = self.request_version == 'HTTP/1.1'
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
         if headers:
             for header, value in headers.items():
                 self.send_header(header, value)
+        if self.response_chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_response_headers()
+
+    def write_chunk(self, data: bytes) -> None:
+        """
+        Writes a piece of the body of a streamed response.
+
+        :param data: The piece; empty pieces are skipped.
+        :type data: bytes
+        :return: None
+        """
+        if not data:
+            return
+        if self.response_chunked:
+            self.wfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def write_json_line(self, record: dict) -> None:
+        """
+        Writes a record of a streamed newline-delimited JSON response.
+
+        :param record: The JSON-serializable record.
+        :type record: dict
+        :return: None
+        """
+        self.write_chunk(json.dumps(record, default=str).encode('utf-8')
+                         + b'\n')
+
+    def end_chunked_response(self) -> None:
+        """
+        Ends a streamed response.
+
+        :return: None
+        """
+        if self.response_chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def end_response_headers(self) -> None:
+        """
+        Finishes the response headers, announcing that the connection will
+        be closed if the request body is left unread.
+
+        :return: None
+        """
+        if self.body_pending:
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
         self.end_headers()
-        self.wfile.write(json.dumps(response).encode('utf-8'))
+
+    def request_has_body(self) -> bool:
+        """
+        Checks whether the request announces a body.
+
+        :return: True if the request has a chunked or non-empty body.
+        :rtype: bool
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return True
+        return self.headers.get('Content-Length', '0').strip() not in \
+            ('', '0')
+
+    def iter_body(self, limit: int, chunk_size: int = UPLOAD_CHUNK_SIZE) \
+            -> Iterator[bytes]:
+        """
+        Reads the request body in chunks of at most ``chunk_size`` bytes.
+
+        Both ``Content-Length`` and ``Transfer-Encoding: chunked`` bodies are
+        supported. The size is counted while reading, so the limit holds even
+        if the client declared a wrong ``Content-Length``.
+
+        :param limit: Maximum number of body bytes accepted.
+        :type limit: int
+        :param chunk_size: Maximum size of the yielded chunks.
+        :type chunk_size: int, optional
+        :return: An iterator over the chunks of the body.
+        :rtype: Iterator[bytes]
+        :raises RequestBodyTooLarge: If the body exceeds ``limit`` bytes.
+        :raises RequestBodyError: If the body is malformed or truncated.
+        """
+        encoding = self.headers.get('Transfer-Encoding', '').lower()
+        if 'chunked' in encoding:
+            chunks = self._iter_chunked_body(chunk_size)
+        else:
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                raise RequestBodyError('Invalid Content-Length')
+            if length > limit:
+                raise RequestBodyTooLarge(f'Body of {length} bytes '
+                                          f'is too large')
+            chunks = self._iter_sized_body(length, chunk_size)
+
+        received = 0
+        try:
+            for chunk in chunks:
+                received += len(chunk)
+                if received > limit:
+                    raise RequestBodyTooLarge(f'Body exceeds {limit} bytes')
+                UPLOAD_BYTES.inc(len(chunk))
+                yield chunk
+        except TimeoutError:
+            raise RequestBodyError('Timed out reading request body')
+        self.body_pending = False
+
+    def _iter_sized_body(self, length: int, chunk_size: int) \
+            -> Iterator[bytes]:
+        """
+        Reads exactly ``length`` bytes of body in chunks.
+
+        :param length: Number of bytes to read.
+        :type length: int
+        :param chunk_size: Maximum size of the yielded chunks.
+        :type chunk_size: int
+        :return: An iterator over the chunks of the body.
+        :rtype: Iterator[bytes]
+        :raises RequestBodyError: If the connection closes early.
+        """
+        while length > 0:
+            chunk = self.rfile.read(min(chunk_size, length))
+            if not chunk:
+                raise RequestBodyError('Request body is truncated')
+            length -= len(chunk)
+            yield chunk
+
+    def _iter_chunked_body(self, chunk_size: int) -> Iterator[bytes]:
+        """
+        Decodes a ``Transfer-Encoding: chunked`` body.
+
+        :param chunk_size: Maximum size of the yielded chunks.
+        :type chunk_size: int
+        :return: An iterator over the decoded chunks of the body.
+        :rtype: Iterator[bytes]
+        :raises RequestBodyError: If the chunked framing is invalid.
+        """
+        while True:
+            line = self.rfile.readline(1024)
+            if not line.endswith(b'\n'):
+                raise RequestBodyError('Invalid chunk header')
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise RequestBodyError('Invalid chunk size')
+            if size == 0:
+                break
+            yield from self._iter_sized_body(size, chunk_size)
+            if self.rfile.readline(3) not in (b'\r\n', b'\n'):
+                raise RequestBodyError('Missing chunk terminator')
+
+        while True:
+            trailer = self.rfile.readline(65537)
+            if not trailer:
+                raise RequestBodyError('Request body is truncated')
+            if trailer in (b'\r\n', b'\n'):
+                break
 
     def do_request(self, method) -> None:
         """
@@ -98,18 +463,66 @@ class AdvancedHTTPRequestHandler(BaseHTTPRequestHandler):
         against the router.
 
         If a corresponding handler is found, it is invoked with the resolved
-        parameters. If no handler is found, a default response is returned.
+        parameters once the admission control lets the request in; a
+        request shed by it is answered with `send_overloaded`. If no
+        handler is found, a default response is returned. The time spent
+        is recorded per route, method and status.
 
         :param method: The HTTP method for the incoming request.
         :type method: str
         :return: None
         """
-        logger.info(f'{method} {self.path}')
+        started = time.perf_counter()
+        self.response_status = None
+        self.body_pending = self.request_has_body()
         handler, params = self.router.resolve(method, self.path)
-        if handler:
-            handler(self, **params)
-        else:
-            self.default_response()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            if not handler:
+                self.default_response()
+            else:
+                with AdmissionControl().admit(handler) as admitted:
+                    if admitted:
+                        handler(self, **params)
+                    else:
+                        self.send_overloaded()
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            self.observe_request(handler, method, started)
+
+    def send_overloaded(self) -> None:
+        """
+        Answers a request shed by the admission control with 503 Service
+        Unavailable, asking the client to retry later. The request body is
+        left unread, so the connection is closed.
+
+        :return: None
+        """
+        self.send_html(ERROR_FILE, 503, headers={
+            'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+    def observe_request(self, handler, method, started) -> None:
+        """
+        Records the duration of a handled request and logs its access line,
+        unless the line is sampled out.
+
+        :param handler: The handler of the request, None if none matched.
+        :type handler: Optional[Callable]
+        :param method: The HTTP method of the request.
+        :type method: str
+        :param started: ``time.perf_counter()`` when handling started.
+        :type started: float
+        :return: None
+        """
+        duration = time.perf_counter() - started
+        route = handler.__name__ if handler else 'default'
+        status = self.response_status
+        REQUEST_DURATION.observe(duration, route, method,
+                                 str(status or 'none'))
+        if should_log_request(route, status):
+            logger.info('{method} {path} {status} {duration_ms}ms',
+                        method=method, path=self.path, status=status,
+                        route=route, duration_ms=round(duration * 1000, 2))
 
     def do_GET(self) -> None:
         """
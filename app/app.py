@@ -3,18 +3,20 @@ Image Hosting Server Emulation for local host on 8000
 2nd Project for Python full stack course at JetBrainAcademy
 """
 
-from http.server import HTTPServer
-
 from loguru import logger
 
-from DB_Manager import DBManager
-from Image_Hosting_Handler import ImageHostingHttpRequestHandler
+from Image_Hosting_Handler import ImageHostingHttpRequestHandler, \
+    AsyncImageHostingHttpRequestHandler
 from Router import Router
-from settings import SERVER_ADDRESS
+from async_server import AsyncHTTPServer
+from metadata_store import metadata_store
+from servers import SERVER_CLASSES
+from settings import SERVER_ADDRESS, SERVER_MODE, METADATA_BACKEND
+from static_cache import StaticCache
+from thumbnails import ThumbnailQueue
 
 
-def run(server_class=HTTPServer,
-        handler_class=ImageHostingHttpRequestHandler) -> None:
+def run(server_class=None, handler_class=None) -> None:
     """
     Initialize the image hosting server and start serving requests.
 
@@ -24,21 +26,42 @@ def run(server_class=HTTPServer,
 
     Parameters:
     server_class (type): The server class to instantiate.
-    Defaults to HTTPServer.
+    Defaults to the class registered for SERVER_MODE: HTTPServer for
+    ``single``, ThreadPoolHTTPServer for ``threaded``, PreforkHTTPServer
+    for ``prefork`` and AsyncHTTPServer for ``asyncio``.
     handler_class (type): The request handler class to use.
-    Defaults to ImageHostingHttpRequestHandler.
+    Defaults to AsyncImageHostingHttpRequestHandler for AsyncHTTPServer
+    and to ImageHostingHttpRequestHandler for the other servers.
 
     Routes:
     - GET /api/images/: Retrieves images.
     - GET /api/images_count/: Retrieves the count of images.
     - POST /upload/: Uploads a new image.
+    - POST /upload/bulk/: Uploads many images in one multipart request.
     - DELETE /api/delete/<image_id>: Deletes an image by ID.
+    - POST /api/delete/bulk/: Deletes images by file names or by a filter.
+    - GET /api/thumbnails/: Reports the state of the thumbnail queue.
+    - GET /api/export/: Streams the metadata of all images.
+    - GET /images/<filename>: Serves a stored image or its thumbnail.
+    - GET /metrics: Reports the server metrics in the Prometheus format.
+
+    The bulk upload, bulk delete and export routes query Postgres directly
+    and are only registered if the metadata store offers bulk operations.
 
     The server listens on the address specified in the SERVER_ADDRESS setting.
     It runs indefinitely until interrupted by a keyboard interrupt, at which
     point it shuts down gracefully.
     """
-    DBManager().init_tables()
+    if server_class is None:
+        server_class = SERVER_CLASSES[SERVER_MODE]
+    if handler_class is None:
+        handler_class = AsyncImageHostingHttpRequestHandler \
+            if issubclass(server_class, AsyncHTTPServer) \
+            else ImageHostingHttpRequestHandler
+
+    store = metadata_store()
+    store.init_tables()
+    StaticCache().preload()
     router = Router()
     router.add_route('GET', '/api/images/',
                      handler_class.get_images)
@@ -47,15 +70,30 @@ def run(server_class=HTTPServer,
     router.add_route('POST', '/upload/', handler_class.post_upload)
     router.add_route('DELETE', '/api/delete/<image_id>',
                      handler_class.delete_image)
+    router.add_route('GET', '/api/thumbnails/',
+                     handler_class.get_thumbnails_state)
+    router.add_route('GET', '/images/<filename>', handler_class.get_image)
+    if store.bulk_operations:
+        router.add_route('POST', '/upload/bulk/',
+                         handler_class.post_bulk_upload)
+        router.add_route('POST', '/api/delete/bulk/',
+                         handler_class.post_bulk_delete)
+        router.add_route('GET', '/api/export/', handler_class.get_export)
+    else:
+        logger.warning(f'Bulk upload, bulk delete and export are disabled '
+                       f'with METADATA_BACKEND={METADATA_BACKEND}')
+    router.add_route('GET', '/metrics', handler_class.get_metrics)
 
     httpd = server_class(SERVER_ADDRESS, handler_class)
-    logger.info(f'Serving on http://{SERVER_ADDRESS[0]}:{SERVER_ADDRESS[1]}')
+    logger.info(f'Serving on http://{SERVER_ADDRESS[0]}:{SERVER_ADDRESS[1]} '
+                f'({server_class.__name__})')
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         logger.warning('Keyboard interrupt received, exiting.')
         httpd.server_close()
     finally:
+        ThumbnailQueue().shutdown()
         logger.info('Server stopped.')
 
 
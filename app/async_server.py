@@ -0,0 +1,483 @@
+"""
+Asyncio Server Module
+
+This module implements `AsyncHTTPServer`, an alternative to the servers of
+``http.server`` that serves every connection from a single event loop, so
+idle keep-alive connections and slow clients do not each hold a thread.
+
+The request handler classes written for ``http.server`` are reused through
+`AsyncRequestHandlerMixin`: a request is parsed with the handler's own
+``parse_request`` and routed through the shared `Router`. Handler methods
+that are coroutine functions run on the event loop; plain methods run in a
+thread of the default executor, reading the request body through a bridge
+to the event loop. Responses are assembled in memory by the usual
+``send_html`` and ``send_json`` and written with ``drain()``, so a client
+that reads slowly applies backpressure instead of growing the buffers.
+
+Key Features:
+- Persistent HTTP/1.1 connections with the ``KEEPALIVE_TIMEOUT`` idle limit.
+- Streaming of Content-Length and chunked request bodies.
+- Graceful shutdown on SIGTERM or SIGINT.
+
+Classes:
+----------
+- StreamReaderBridge:
+- AsyncRequestHandlerMixin:
+- AsyncHTTPServer:
+"""
+import asyncio
+import functools
+import inspect
+import io
+import signal
+import time
+from contextlib import suppress
+from typing import AsyncIterator
+
+from loguru import logger
+
+from DB_Manager import AsyncDBManager
+from Router import Router
+from admission import AdmissionControl
+from metrics import REQUESTS_IN_FLIGHT, UPLOAD_BYTES
+from adv_http_request_handler import RequestBodyError, RequestBodyTooLarge
+from settings import UPLOAD_CHUNK_SIZE, KEEPALIVE_TIMEOUT
+
+MAX_LINE = 65536
+MAX_HEADERS = 100
+
+
+class StreamReaderBridge:
+    """
+    File-like reader that lets a handler running in a worker thread read
+    the request body from the event loop.
+
+    :ivar reader: The stream of the connection.
+    :type reader: asyncio.StreamReader
+    :ivar loop: The event loop serving the connection.
+    :type loop: asyncio.AbstractEventLoop
+    :ivar timeout: Seconds to wait for data before raising TimeoutError.
+    :type timeout: float
+    """
+    def __init__(self, reader, loop, timeout=KEEPALIVE_TIMEOUT) -> None:
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads up to ``size`` bytes.
+
+        :param size: Maximum number of bytes to read, -1 for all.
+        :type size: int, optional
+        :return: The bytes read, empty at the end of the stream.
+        :rtype: bytes
+        """
+        return self._wait(self.reader.read(size))
+
+    def readline(self, limit: int = -1) -> bytes:
+        """
+        Reads a line. Lines are bounded by the limit of the stream rather
+        than by ``limit``.
+
+        :param limit: Ignored; kept for compatibility with file objects.
+        :type limit: int, optional
+        :return: The line, including the newline.
+        :rtype: bytes
+        """
+        return self._wait(self.reader.readline())
+
+    def _wait(self, coro) -> bytes:
+        """
+        Runs a read on the event loop and waits for its result.
+
+        :param coro: The read coroutine.
+        :return: The bytes read.
+        :rtype: bytes
+        :raises TimeoutError: If no data arrives in time.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(coro, self.timeout), self.loop).result()
+
+
+class AsyncRequestHandlerMixin:
+    """
+    Serves a connection of `AsyncHTTPServer` with a request handler class
+    of ``http.server``. Must precede that class in the bases.
+
+    :ivar reader: The stream the requests are read from.
+    :type reader: asyncio.StreamReader
+    :ivar writer: The stream the responses are written to.
+    :type writer: asyncio.StreamWriter
+    :ivar idle: Whether the connection waits for the next request.
+    :type idle: bool
+    """
+    def __init__(self, reader, writer, server) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.client_address = writer.get_extra_info('peername') or ('', 0)
+        self.default_response = lambda: self.send_html('404.html', 404)
+        self.router = Router()
+        self.body_pending = False
+        self.response_status = None
+        self.response_chunked = False
+        self.close_connection = True
+        self.idle = True
+        self.wfile = io.BytesIO()
+        self.body_reader = StreamReaderBridge(
+            reader, asyncio.get_running_loop(), self.timeout)
+        self.rfile = self.body_reader
+
+    async def handle(self) -> None:
+        """
+        Serves requests until the connection is to be closed.
+
+        :return: None
+        """
+        self.close_connection = True
+        await self.handle_one_request()
+        while not self.close_connection and not self.server.stopping:
+            await self.handle_one_request()
+
+    async def handle_one_request(self) -> None:
+        """
+        Reads, dispatches and answers a single request.
+
+        :return: None
+        """
+        self.idle = True
+        try:
+            self.raw_requestline = await asyncio.wait_for(
+                self.reader.readline(), self.timeout)
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+            return
+        except ValueError:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            await self.flush()
+            return
+        finally:
+            self.idle = False
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        try:
+            self.rfile = io.BytesIO(await self.read_header_block())
+        except (TimeoutError, ValueError):
+            self.close_connection = True
+            return
+        try:
+            parsed = self.parse_request()
+        finally:
+            self.rfile = self.body_reader
+        await self.flush()
+        if not parsed:
+            return
+        if not hasattr(self, 'do_' + self.command):
+            self.send_error(501, f'Unsupported method ({self.command!r})')
+            await self.flush()
+            return
+
+        try:
+            await self.do_request_async(self.command)
+        except Exception:
+            logger.exception(f'Error handling {self.command} {self.path}')
+            self.close_connection = True
+            if not self.wfile.tell():
+                self.send_error(500)
+        await self.flush()
+
+    async def read_header_block(self) -> bytes:
+        """
+        Reads the header lines of a request up to the empty line.
+
+        At most ``MAX_HEADERS`` + 1 lines are read; ``parse_request``
+        rejects a request with more headers than that.
+
+        :return: The header lines, including the empty line.
+        :rtype: bytes
+        :raises TimeoutError: If the client stops sending.
+        :raises ValueError: If a line is longer than the stream limit.
+        """
+        lines = []
+        while len(lines) <= MAX_HEADERS:
+            line = await asyncio.wait_for(self.reader.readline(),
+                                          self.timeout)
+            lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        return b''.join(lines)
+
+    async def do_request_async(self, method) -> None:
+        """
+        Resolves the request against the router and runs its handler once
+        the admission control lets the request in.
+
+        :param method: The HTTP method of the request.
+        :type method: str
+        :return: None
+        """
+        started = time.perf_counter()
+        self.response_status = None
+        self.body_pending = self.request_has_body()
+        handler, params = self.router.resolve(method, self.path)
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            if not handler:
+                self.default_response()
+            else:
+                async with AdmissionControl().admit_async(handler) \
+                        as admitted:
+                    if not admitted:
+                        self.send_overloaded()
+                    elif inspect.iscoroutinefunction(handler):
+                        await handler(self, **params)
+                    else:
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, functools.partial(handler, self, **params))
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            self.observe_request(handler, method, started)
+
+    async def flush(self) -> None:
+        """
+        Writes the buffered response to the client, waiting while the
+        transport buffer is full.
+
+        :return: None
+        """
+        data = self.wfile.getvalue()
+        if not data:
+            return
+        self.wfile.seek(0)
+        self.wfile.truncate()
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def aiter_body(self, limit: int,
+                         chunk_size: int = UPLOAD_CHUNK_SIZE) \
+            -> AsyncIterator[bytes]:
+        """
+        Reads the request body in chunks of at most ``chunk_size`` bytes,
+        like ``iter_body``.
+
+        :param limit: Maximum number of body bytes accepted.
+        :type limit: int
+        :param chunk_size: Maximum size of the yielded chunks.
+        :type chunk_size: int, optional
+        :return: An asynchronous iterator over the chunks of the body.
+        :rtype: AsyncIterator[bytes]
+        :raises RequestBodyTooLarge: If the body exceeds ``limit`` bytes.
+        :raises RequestBodyError: If the body is malformed or truncated.
+        """
+        encoding = self.headers.get('Transfer-Encoding', '').lower()
+        if 'chunked' in encoding:
+            chunks = self._aiter_chunked_body(chunk_size)
+        else:
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                raise RequestBodyError('Invalid Content-Length')
+            if length > limit:
+                raise RequestBodyTooLarge(f'Body of {length} bytes '
+                                          f'is too large')
+            chunks = self._aiter_sized_body(length, chunk_size)
+
+        received = 0
+        try:
+            async for chunk in chunks:
+                received += len(chunk)
+                if received > limit:
+                    raise RequestBodyTooLarge(f'Body exceeds {limit} bytes')
+                UPLOAD_BYTES.inc(len(chunk))
+                yield chunk
+        except TimeoutError:
+            raise RequestBodyError('Timed out reading request body')
+        self.body_pending = False
+
+    async def _read(self, coro) -> bytes:
+        """
+        Waits for a read from the connection, at most ``timeout`` seconds.
+
+        :param coro: The read coroutine.
+        :return: The bytes read.
+        :rtype: bytes
+        :raises RequestBodyError: If a line exceeds the stream limit.
+        """
+        try:
+            return await asyncio.wait_for(coro, self.timeout)
+        except ValueError:
+            raise RequestBodyError('Chunk header is too long')
+
+    async def _aiter_sized_body(self, length: int, chunk_size: int) \
+            -> AsyncIterator[bytes]:
+        """
+        Reads exactly ``length`` bytes of body in chunks.
+
+        :param length: Number of bytes to read.
+        :type length: int
+        :param chunk_size: Maximum size of the yielded chunks.
+        :type chunk_size: int
+        :return: An asynchronous iterator over the chunks of the body.
+        :rtype: AsyncIterator[bytes]
+        :raises RequestBodyError: If the connection closes early.
+        """
+        while length > 0:
+            chunk = await self._read(
+                self.reader.read(min(chunk_size, length)))
+            if not chunk:
+                raise RequestBodyError('Request body is truncated')
+            length -= len(chunk)
+            yield chunk
+
+    async def _aiter_chunked_body(self, chunk_size: int) \
+            -> AsyncIterator[bytes]:
+        """
+        Decodes a ``Transfer-Encoding: chunked`` body.
+
+        :param chunk_size: Maximum size of the yielded chunks.
+        :type chunk_size: int
+        :return: An asynchronous iterator over the decoded chunks.
+        :rtype: AsyncIterator[bytes]
+        :raises RequestBodyError: If the chunked framing is invalid.
+        """
+        while True:
+            line = await self._read(self.reader.readline())
+            if not line.endswith(b'\n'):
+                raise RequestBodyError('Invalid chunk header')
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise RequestBodyError('Invalid chunk size')
+            if size == 0:
+                break
+            async for chunk in self._aiter_sized_body(size, chunk_size):
+                yield chunk
+            if await self._read(self.reader.readline()) not in \
+                    (b'\r\n', b'\n'):
+                raise RequestBodyError('Missing chunk terminator')
+
+        while True:
+            trailer = await self._read(self.reader.readline())
+            if not trailer:
+                raise RequestBodyError('Request body is truncated')
+            if trailer in (b'\r\n', b'\n'):
+                break
+
+
+class AsyncHTTPServer:
+    """
+    HTTP server running every connection as a task of one event loop.
+
+    It offers the ``serve_forever``, ``shutdown`` and ``server_close``
+    methods of the ``http.server`` servers, so ``app.run()`` can use it in
+    their place. A handler class that does not derive from
+    `AsyncRequestHandlerMixin` is adapted, running all its handler methods
+    in threads.
+
+    :ivar server_address: The address to listen on.
+    :type server_address: tuple
+    :ivar handler_class: The request handler class serving connections.
+    :type handler_class: type
+    :ivar backlog: Length of the queue of connections not yet accepted.
+    :type backlog: int
+    :ivar stopping: Whether the server is shutting down.
+    :type stopping: bool
+    """
+    def __init__(self, server_address, handler_class, backlog=1024) -> None:
+        if not issubclass(handler_class, AsyncRequestHandlerMixin):
+            handler_class = type(f'Async{handler_class.__name__}',
+                                 (AsyncRequestHandlerMixin, handler_class),
+                                 {})
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.backlog = backlog
+        self.stopping = False
+        self._connections = {}
+        self._loop = None
+        self._stop = None
+
+    def serve_forever(self) -> None:
+        """
+        Runs the event loop until SIGTERM, SIGINT or ``shutdown()``.
+
+        :return: None
+        """
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        """
+        Accepts connections until stopped, then lets the requests in
+        flight finish and closes the database pool.
+
+        :return: None
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self._loop.add_signal_handler(signum, self._stop.set)
+
+        server = await asyncio.start_server(
+            self.handle_connection, *self.server_address,
+            backlog=self.backlog, limit=MAX_LINE + 2, reuse_address=True)
+        async with server:
+            await self._stop.wait()
+            self.stopping = True
+
+        for task, handler in list(self._connections.items()):
+            if handler is None or handler.idle:
+                task.cancel()
+        if self._connections:
+            _, pending = await asyncio.wait(list(self._connections),
+                                            timeout=KEEPALIVE_TIMEOUT)
+            for task in pending:
+                task.cancel()
+        await AsyncDBManager().close()
+
+    async def handle_connection(self, reader, writer) -> None:
+        """
+        Serves one client connection.
+
+        :param reader: The stream the requests are read from.
+        :type reader: asyncio.StreamReader
+        :param writer: The stream the responses are written to.
+        :type writer: asyncio.StreamWriter
+        :return: None
+        """
+        task = asyncio.current_task()
+        self._connections[task] = None
+        try:
+            handler = self.handler_class(reader, writer, self)
+            self._connections[task] = handler
+            await handler.handle()
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.exception('Error serving connection')
+        finally:
+            del self._connections[task]
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    def shutdown(self) -> None:
+        """
+        Stops the server; may be called from any thread.
+
+        :return: None
+        """
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    def server_close(self) -> None:
+        """
+        Stops the server if it is still running.
+
+        :return: None
+        """
+        self.shutdown()
@@ -0,0 +1,4 @@
+"""
+Benchmarks for the image hosting server, run from the ``app`` directory
+with ``python -m benchmarks.<name>``.
+"""
@@ -0,0 +1,628 @@
+"""
+Benchmark of the HTTP API under a mixed workload, reporting JSON results
+that can be compared across commits.
+
+A server is started for every mode with ``app.py``, using the SQLite
+metadata store in a working directory of its own as a stand-in for the
+database, after ``images`` was seeded with the given number of rows.
+The given number of clients then send requests over keep-alive
+connections for the given time, each picking the next operation at random
+by the weights of the mix:
+
+- ``list_shallow``: one of the first five pages of the listing;
+- ``list_deep``: one of the last tenth of the pages;
+- ``count``: the image count;
+- ``upload``: a PNG image of one of the upload sizes;
+- ``delete``: an image uploaded by the run, or an upload if none is left.
+
+The random choices are seeded, so runs send the same sequence of
+requests. Images uploaded by a run are deleted afterwards, so a seeded
+working directory can be reused with ``--workdir``.
+
+The report holds the throughput and the latency percentiles of every
+operation and of all requests, and the peak resident set size of the
+server processes, read from ``/proc`` on Linux.
+
+Usage:
+    python -m benchmarks.api_bench [--rows 10000] [--modes threaded]
+        [--concurrency 32] [--duration 30] [--output results.json]
+    python -m benchmarks.api_bench --rows 10000000 --workdir /tmp/bench \\
+        --mix list_deep=1 --env LISTING_CACHE_SIZE=0
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from PIL import Image
+
+from benchmarks.load_test import start_server, stop_server, raise_file_limit
+from settings import SERVER_ADDRESS, PAGE_LIMIT
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_DIR = os.path.join(os.path.dirname(APP_DIR), 'static')
+SCHEMA_FILE = 'init_tables_sqlite.sql'
+DATABASE_FILE = 'db/images.sqlite3'
+
+OPERATIONS = ('list_shallow', 'list_deep', 'count', 'upload', 'delete')
+DEFAULT_MIX = 'list_shallow=40,list_deep=10,count=30,upload=10,delete=10'
+SEED_TIME = datetime(2024, 1, 1)
+SEED_INSERT_QUERY = (
+    "INSERT INTO images (filename, original_name, size, upload_time,"
+    " file_type) VALUES (?, ?, ?, ?, ?);")
+
+
+class Workload:
+    """
+    Requests and results of a run, shared by its clients.
+
+    :ivar host: Host the server is reached at.
+    :type host: str
+    :ivar operations: Names of the operations of the mix.
+    :type operations: list[str]
+    :ivar weights: Relative frequencies of the operations.
+    :type weights: list[float]
+    :ivar pages: Number of pages of the seeded listing.
+    :type pages: int
+    :ivar payloads: Bodies of the uploads.
+    :type payloads: list[bytes]
+    :ivar uploaded: Stored names of the uploaded images not deleted yet.
+    :type uploaded: list[str]
+    :ivar latencies: Seconds taken by the successful requests, per
+                     operation.
+    :type latencies: dict[str, list[float]]
+    :ivar errors: Failed requests, per operation and status or error.
+    :type errors: dict[str, collections.Counter]
+    """
+    def __init__(self, host, mix, rows, payloads) -> None:
+        self.host = host
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.pages = max(1, -(-rows // PAGE_LIMIT))
+        self.payloads = payloads
+        self.uploaded = []
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+
+    def next_request(self, rng: random.Random) \
+            -> tuple[str, list, Optional[str]]:
+        """
+        Picks the next request of a client.
+
+        :param rng: Random generator of the client.
+        :type rng: random.Random
+        :return: The operation, the parts of the request and the name of
+                 the image deleted, if any.
+        :rtype: tuple[str, list[bytes], Optional[str]]
+        """
+        operation = rng.choices(self.operations, self.weights)[0]
+        if operation == 'delete' and not self.uploaded:
+            operation = 'upload'
+        if operation == 'list_shallow':
+            return operation, self.get('/api/images/',
+                                       Page=rng.randint(1, 5)), None
+        if operation == 'list_deep':
+            page = rng.randint(max(1, self.pages * 9 // 10), self.pages)
+            return operation, self.get('/api/images/', Page=page), None
+        if operation == 'count':
+            return operation, self.get('/api/images_count/'), None
+        if operation == 'upload':
+            payload = rng.choice(self.payloads)
+            head = (f'POST /upload/ HTTP/1.1\r\nHost: {self.host}\r\n'
+                    f'Filename: bench.png\r\n'
+                    f'Content-Length: {len(payload)}\r\n\r\n')
+            return operation, [head.encode(), payload], None
+        name = self.uploaded.pop(rng.randrange(len(self.uploaded)))
+        return operation, self.request('DELETE', f'/api/delete/{name}'), name
+
+    def get(self, path: str, **headers) -> list:
+        """
+        Builds a GET request.
+
+        :param path: Requested path.
+        :type path: str
+        :param headers: Further request headers.
+        :return: The parts of the request.
+        :rtype: list[bytes]
+        """
+        return self.request('GET', path, **headers)
+
+    def request(self, method: str, path: str, **headers) -> list:
+        """
+        Builds a request without a body.
+
+        :param method: The request method.
+        :type method: str
+        :param path: Requested path.
+        :type path: str
+        :param headers: Further request headers.
+        :return: The parts of the request.
+        :rtype: list[bytes]
+        """
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        return [('\r\n'.join(lines) + '\r\n\r\n').encode()]
+
+    def record(self, operation: str, elapsed: float, status: int,
+               headers: dict) -> None:
+        """
+        Records an answered request.
+
+        :param operation: The operation.
+        :type operation: str
+        :param elapsed: Seconds until the response was read.
+        :type elapsed: float
+        :param status: Status code of the response.
+        :type status: int
+        :param headers: Headers of the response, by lowercase name.
+        :type headers: dict
+        :return: None
+        """
+        if status >= 400:
+            self.errors[operation][str(status)] += 1
+            return
+        self.latencies[operation].append(elapsed)
+        if operation == 'upload' and 'location' in headers:
+            self.uploaded.append(headers['location'].rsplit('/', 1)[-1])
+
+
+async def send(reader, writer, request: list) -> tuple[int, dict]:
+    """
+    Sends a request and reads its response, discarding the body.
+
+    :param reader: The stream of the connection.
+    :type reader: asyncio.StreamReader
+    :param writer: The stream of the connection.
+    :type writer: asyncio.StreamWriter
+    :param request: The parts of the request.
+    :type request: list[bytes]
+    :return: The status code and the headers, by lowercase name.
+    :rtype: tuple[int, dict]
+    :raises asyncio.IncompleteReadError: If the connection closes early.
+    """
+    writer.writelines(request)
+    await writer.drain()
+    status = int((await reader.readuntil(b'\r\n')).split()[1])
+    headers = {}
+    while (line := await reader.readuntil(b'\r\n')) != b'\r\n':
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        while size := int((await reader.readuntil(b'\r\n')).split(b';')[0],
+                          16):
+            await reader.readexactly(size + 2)
+        await reader.readuntil(b'\r\n')
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers
+
+
+async def client(port, workload, rng, deadline, timeout) -> None:
+    """
+    Sends requests of the workload over one persistent connection until
+    the deadline, reconnecting when the server closes it.
+
+    :param port: Port of the server.
+    :type port: int
+    :param workload: The workload of the run.
+    :type workload: Workload
+    :param rng: Random generator of the client.
+    :type rng: random.Random
+    :param deadline: Monotonic time to stop at.
+    :type deadline: float
+    :param timeout: Seconds to wait for a response.
+    :type timeout: float
+    :return: None
+    """
+    reader = writer = None
+    while time.monotonic() < deadline:
+        operation, request, _ = workload.next_request(rng)
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(workload.host, port), timeout)
+            status, headers = await asyncio.wait_for(
+                send(reader, writer, request), timeout)
+        except (OSError, asyncio.IncompleteReadError, TimeoutError,
+                ValueError) as e:
+            workload.errors[operation][type(e).__name__] += 1
+            headers = {'connection': 'close'}
+        else:
+            workload.record(operation, time.perf_counter() - started,
+                            status, headers)
+        if headers.get('connection', '').lower() == 'close' \
+                and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_workload(port, workload, concurrency, duration, timeout,
+                       seed) -> float:
+    """
+    Runs ``concurrency`` clients for ``duration`` seconds.
+
+    :param port: Port of the server.
+    :type port: int
+    :param workload: The workload of the run.
+    :type workload: Workload
+    :param concurrency: Number of concurrent clients.
+    :type concurrency: int
+    :param duration: Seconds to send requests for.
+    :type duration: float
+    :param timeout: Seconds to wait for a response.
+    :type timeout: float
+    :param seed: Seed of the random generators of the clients.
+    :type seed: int
+    :return: Seconds the run took.
+    :rtype: float
+    """
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(port, workload, random.Random(f'{seed}-{index}'), deadline,
+               timeout)
+        for index in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def delete_uploaded(port, workload, timeout) -> None:
+    """
+    Deletes the images uploaded by a run and not deleted by it.
+
+    :param port: Port of the server.
+    :type port: int
+    :param workload: The workload of the run.
+    :type workload: Workload
+    :param timeout: Seconds to wait for a response.
+    :type timeout: float
+    :return: None
+    """
+    reader, writer = await asyncio.open_connection(workload.host, port)
+    try:
+        for name in workload.uploaded:
+            await asyncio.wait_for(send(reader, writer, workload.request(
+                'DELETE', f'/api/delete/{name}')), timeout)
+    finally:
+        writer.close()
+    workload.uploaded.clear()
+
+
+def prepare_workdir(workdir: str) -> None:
+    """
+    Prepares the working directory of the server: empty image and log
+    directories, the static files and the SQLite schema.
+
+    :param workdir: The working directory.
+    :type workdir: str
+    :return: None
+    """
+    for name in ('images', 'logs', os.path.dirname(DATABASE_FILE)):
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+    links = {'static': STATIC_DIR,
+             SCHEMA_FILE: os.path.join(APP_DIR, SCHEMA_FILE)}
+    for name, target in links.items():
+        if not os.path.lexists(os.path.join(workdir, name)):
+            os.symlink(target, os.path.join(workdir, name))
+
+
+def seed_database(path: str, rows: int, seed: int) -> float:
+    """
+    Creates the SQLite database with ``rows`` rows in ``images``, unless
+    it holds that many already. Seeded rows have no files, so they are
+    listed and counted but never deleted.
+
+    :param path: Path of the database file.
+    :type path: str
+    :param rows: Number of rows.
+    :type rows: int
+    :param seed: Seed of the random sizes of the rows.
+    :type seed: int
+    :return: Seconds spent seeding.
+    :rtype: float
+    """
+    started = time.perf_counter()
+    if os.path.exists(path):
+        with sqlite3.connect(path) as conn:
+            count = conn.execute(
+                'SELECT images_count FROM images_stats;').fetchone()
+        if count and count[0] == rows:
+            return 0.0
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        with open(os.path.join(APP_DIR, SCHEMA_FILE)) as file:
+            conn.executescript(file.read())
+        conn.execute('PRAGMA journal_mode = WAL;')
+        conn.execute('PRAGMA synchronous = OFF;')
+        rng = random.Random(seed)
+        conn.execute('BEGIN;')
+        conn.executemany(SEED_INSERT_QUERY, (
+            (f'seed-{index:09d}', f'seed-{index}.png',
+             rng.randint(10_000, 5_000_000),
+             (SEED_TIME - timedelta(seconds=index)).isoformat(
+                 ' ', 'milliseconds'), '.png')
+            for index in range(rows)))
+        conn.execute('COMMIT;')
+    finally:
+        conn.close()
+    return time.perf_counter() - started
+
+
+def make_payloads(sizes: list, seed: int) -> list:
+    """
+    Encodes PNG images of random pixels, which compress poorly, so every
+    image is about as large as its size.
+
+    :param sizes: Approximate sizes of the images in bytes.
+    :type sizes: list[int]
+    :param seed: Seed of the pixels.
+    :type seed: int
+    :return: The encoded images.
+    :rtype: list[bytes]
+    """
+    rng = random.Random(seed)
+    payloads = []
+    for size in sizes:
+        side = max(1, int((size / 3) ** 0.5))
+        image = Image.frombytes('RGB', (side, side),
+                                rng.randbytes(side * side * 3))
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG', compress_level=1)
+        payloads.append(buffer.getvalue())
+    return payloads
+
+
+def peak_rss(pid: int) -> Optional[int]:
+    """
+    Returns the peak resident set size of a process and its descendants,
+    such as pre-forked workers and thumbnail workers.
+
+    :param pid: ID of the process.
+    :type pid: int
+    :return: The sum of the peaks in KiB, or None without ``/proc``.
+    :rtype: Optional[int]
+    """
+    children = defaultdict(list)
+    try:
+        entries = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return None
+    for entry in entries:
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                parent = int(file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children[parent].append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        process = pending.pop()
+        pending.extend(children[process])
+        try:
+            with open(f'/proc/{process}/status') as file:
+                for line in file:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    """
+    Computes the throughput and the latency percentiles of requests.
+
+    :param latencies: Seconds taken by the successful requests.
+    :type latencies: list[float]
+    :param errors: Number of failed requests.
+    :type errors: int
+    :param elapsed: Seconds the run took.
+    :type elapsed: float
+    :return: Numbers of requests and errors, requests per second and the
+             latency percentiles in milliseconds.
+    :rtype: dict
+    """
+    result = {'requests': len(latencies), 'errors': errors,
+              'rps': round(len(latencies) / elapsed, 1)}
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100,
+                                           method='inclusive')
+        result.update({name: round(percentiles[index] * 1000, 3)
+                       for name, index in (('p50_ms', 49), ('p95_ms', 94),
+                                           ('p99_ms', 98))})
+        result['max_ms'] = round(max(latencies) * 1000, 3)
+    return result
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    Parses the weights of the operations, given as ``name=weight`` pairs
+    separated by commas.
+
+    :param mix: The weights.
+    :type mix: str
+    :return: The positive weights, by operation.
+    :rtype: dict[str, float]
+    :raises argparse.ArgumentTypeError: If the mix is invalid.
+    """
+    weights = {}
+    for pair in mix.split(','):
+        name, _, weight = pair.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'Unknown operation: {name}')
+        try:
+            weights[name.strip()] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Invalid weight: {pair}')
+    weights = {name: weight for name, weight in weights.items() if weight > 0}
+    if not weights:
+        raise argparse.ArgumentTypeError('No operation in the mix')
+    return weights
+
+
+def parse_size(size: str) -> int:
+    """
+    Parses a size in bytes with an optional ``k`` or ``m`` suffix.
+
+    :param size: The size.
+    :type size: str
+    :return: The size in bytes.
+    :rtype: int
+    :raises argparse.ArgumentTypeError: If the size is invalid.
+    """
+    units = {'k': 1024, 'm': 1024 * 1024}
+    size = size.strip().lower()
+    try:
+        if size[-1:] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid size: {size}')
+
+
+def git_commit() -> Optional[str]:
+    """
+    Returns the commit the benchmarked code is checked out at.
+
+    :return: The abbreviated commit hash, or None outside a git checkout.
+    :rtype: Optional[str]
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=APP_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints or writes the JSON report.
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='HTTP API benchmark')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='rows seeded into the images table')
+    parser.add_argument('--modes', nargs='+', default=['threaded'],
+                        help='server modes to run')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds every mode is run for')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help=f'weights of the operations '
+                             f'(default: {DEFAULT_MIX})')
+    parser.add_argument('--upload-sizes', default='16k,256k,2m',
+                        type=lambda sizes: [parse_size(size) for size
+                                            in sizes.split(',')],
+                        help='sizes of the uploaded images')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed of the random choices')
+    parser.add_argument('--env', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='environment variable of the server')
+    parser.add_argument('--workdir',
+                        help='working directory of the server, kept to '
+                             'reuse the seeded database (default: a '
+                             'temporary directory)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=SERVER_ADDRESS[1])
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for a response')
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args()
+    raise_file_limit(args.concurrency)
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(
+        prefix='api-bench-'))
+    prepare_workdir(workdir)
+    database = os.path.join(workdir, DATABASE_FILE)
+    env = dict(variable.split('=', 1) for variable in args.env)
+    env.update(METADATA_BACKEND='sqlite', SQLITE_PATH=database)
+
+    print(f'Seeding {args.rows} rows in {workdir}', file=sys.stderr)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'rows': args.rows,
+        'seed_seconds': round(seed_database(database, args.rows,
+                                            args.seed), 1),
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'mix': args.mix,
+        'upload_sizes': args.upload_sizes,
+        'seed': args.seed,
+        'env': env,
+        'runs': [],
+    }
+    payloads = make_payloads(args.upload_sizes, args.seed)
+    try:
+        for mode in args.modes:
+            print(f'Running {mode} for {args.duration:.0f}s', file=sys.stderr)
+            workload = Workload(args.host, args.mix, args.rows, payloads)
+            process = start_server(mode, args.host, args.port, env, workdir)
+            try:
+                elapsed = asyncio.run(run_workload(
+                    args.port, workload, args.concurrency, args.duration,
+                    args.timeout, args.seed))
+                rss = peak_rss(process.pid)
+                asyncio.run(delete_uploaded(args.port, workload,
+                                            args.timeout))
+            finally:
+                stop_server(process)
+            operations = {
+                operation: summarize(workload.latencies[operation],
+                                     sum(workload.errors[operation].values()),
+                                     elapsed)
+                for operation in OPERATIONS if operation in args.mix
+                or operation in workload.latencies}
+            for operation, errors in workload.errors.items():
+                if errors:
+                    operations[operation]['error_kinds'] = dict(errors)
+            report['runs'].append({
+                'mode': mode,
+                'elapsed': round(elapsed, 3),
+                'total': summarize(
+                    [latency for latencies in workload.latencies.values()
+                     for latency in latencies],
+                    sum(sum(errors.values())
+                        for errors in workload.errors.values()), elapsed),
+                'operations': operations,
+                'peak_rss_kb': rss,
+            })
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Router micro-benchmark comparing the trie engine with the regex scan.
+
+Each table has the given number of routes, half of them literal paths and
+half ending with a placeholder, and is queried with the first and the last
+registered route, a placeholder route and a path that does not match.
+Every route has a handler of its own, and both engines must resolve each
+path to the same handler and parameters before it is timed. Literal and
+placeholder routes have different prefixes, because the regex engine
+matches prefixes and would otherwise resolve a placeholder path on a
+literal route.
+
+Usage:
+    python -m benchmarks.bench_router [--repeat N]
+"""
+import argparse
+import timeit
+
+from Router import RegexRouter, TrieRouter
+
+ROUTE_COUNTS = (10, 100, 1000)
+
+
+def make_handler(path):
+    """
+    Creates a distinct placeholder handler for a benchmarked route.
+
+    :param path: The route the handler is registered for.
+    :type path: str
+    :return: The handler.
+    :rtype: Callable
+    """
+    def handler(*args, **kwargs) -> None:
+        """
+        Placeholder handler registered for the route.
+        """
+    handler.__name__ = f'handler {path}'
+    return handler
+
+
+def routes(count) -> list:
+    """
+    Returns the routes of a table of ``count`` routes with their handlers.
+
+    :param count: Number of routes to register.
+    :type count: int
+    :return: ``(path, handler)`` pairs in registration order.
+    :rtype: list[tuple]
+    """
+    paths = []
+    for i in range(count // 2):
+        paths.append(f'/api/resource{i}/')
+        paths.append(f'/api/item{i}/<item_id>')
+    return [(path, make_handler(path)) for path in paths]
+
+
+def build(engine_class, table):
+    """
+    Creates an engine holding the routes of a table.
+
+    :param engine_class: The routing engine class.
+    :type engine_class: type
+    :param table: The routes, as returned by `routes`.
+    :type table: list[tuple]
+    :return: The populated engine.
+    """
+    engine = engine_class()
+    for path, handler in table:
+        engine.add_route('GET', path, handler)
+    return engine
+
+
+def lookups(count) -> dict:
+    """
+    Returns the paths looked up for a table of ``count`` routes.
+
+    :param count: Number of routes in the table.
+    :type count: int
+    :return: Paths keyed by the name of the case.
+    :rtype: dict[str, str]
+    """
+    last = count // 2 - 1
+    return {
+        'first': '/api/resource0/',
+        'last': f'/api/resource{last}/',
+        'param': f'/api/item{last}/0b5f6c1e.png',
+        'miss': '/api/missing/',
+    }
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints the time per lookup in microseconds.
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Router micro-benchmark')
+    parser.add_argument('--repeat', type=int, default=20000,
+                        help='lookups per case')
+    args = parser.parse_args()
+
+    print(f'{"routes":>6} {"case":>6} {"regex us":>10} {"trie us":>10} '
+          f'{"speedup":>8}')
+    for count in ROUTE_COUNTS:
+        table = routes(count)
+        engines = {engine_class: build(engine_class, table)
+                   for engine_class in (RegexRouter, TrieRouter)}
+        for case, path in lookups(count).items():
+            results = [engine.resolve('GET', path)
+                       for engine in engines.values()]
+            assert results[0] == results[1], \
+                f'Engines disagree on {path}: {results}'
+            timings = []
+            for engine in engines.values():
+                seconds = min(timeit.repeat(
+                    lambda: engine.resolve('GET', path),
+                    number=args.repeat, repeat=3))
+                timings.append(seconds / args.repeat * 1e6)
+            regex_us, trie_us = timings
+            print(f'{count:>6} {case:>6} {regex_us:>10.2f} {trie_us:>10.2f} '
+                  f'{regex_us / trie_us:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Load test comparing the latency of the server modes under many concurrent
+keep-alive connections.
+
+For every mode a server is started with ``SERVER_MODE`` set accordingly,
+the given number of clients connect at once and each sends its requests
+one after another over its connection. The first request of a client
+includes the time to connect, so connections waiting in the listen backlog
+count against the server. The database configured for the server must be
+reachable.
+
+Usage:
+    python -m benchmarks.load_test [--modes threaded asyncio]
+        [--connections 1000] [--requests 5] [--path /api/images_count/]
+    python -m benchmarks.load_test --no-spawn    # against a running server
+"""
+import argparse
+import asyncio
+import os
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from settings import SERVER_ADDRESS
+
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'app.py')
+
+
+async def client(host, port, path, requests, timeout, latencies,
+                 errors) -> None:
+    """
+    Sends ``requests`` GET requests over one persistent connection,
+    reconnecting when the server closes it.
+
+    :param host: Host of the server.
+    :type host: str
+    :param port: Port of the server.
+    :type port: int
+    :param path: Requested path.
+    :type path: str
+    :param requests: Number of requests to send.
+    :type requests: int
+    :param timeout: Seconds to wait for a response.
+    :type timeout: float
+    :param latencies: Collects the latency of every answered request.
+    :type latencies: list[float]
+    :param errors: Collects the errors of failed requests.
+    :type errors: list[str]
+    :return: None
+    """
+    request = (f'GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n').encode()
+    reader = writer = None
+    for _ in range(requests):
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), timeout)
+            writer.write(request)
+            await writer.drain()
+            keep_alive = await asyncio.wait_for(read_response(reader),
+                                                timeout)
+        except (OSError, asyncio.IncompleteReadError, TimeoutError) as e:
+            errors.append(type(e).__name__)
+            keep_alive = False
+        else:
+            latencies.append(time.perf_counter() - started)
+        if not keep_alive and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def read_response(reader) -> bool:
+    """
+    Reads one response and discards its body.
+
+    :param reader: The stream of the connection.
+    :type reader: asyncio.StreamReader
+    :return: Whether the server keeps the connection open.
+    :rtype: bool
+    :raises asyncio.IncompleteReadError: If the connection closes early.
+    """
+    status = await reader.readuntil(b'\r\n')
+    if not status.startswith(b'HTTP/1.1 2'):
+        raise OSError(f'Unexpected status {status.strip()!r}')
+    length = 0
+    keep_alive = True
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        if line == b'\r\n':
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection' and value.strip().lower() == 'close':
+            keep_alive = False
+    await reader.readexactly(length)
+    return keep_alive
+
+
+async def run_load(host, port, path, connections, requests,
+                   timeout) -> dict:
+    """
+    Runs ``connections`` clients at once.
+
+    :param host: Host of the server.
+    :type host: str
+    :param port: Port of the server.
+    :type port: int
+    :param path: Requested path.
+    :type path: str
+    :param connections: Number of concurrent clients.
+    :type connections: int
+    :param requests: Requests sent by every client.
+    :type requests: int
+    :param timeout: Seconds to wait for a response.
+    :type timeout: float
+    :return: Latency percentiles in milliseconds, throughput and errors.
+    :rtype: dict
+    """
+    latencies, errors = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(host, port, path, requests, timeout, latencies, errors)
+        for _ in range(connections)))
+    elapsed = time.perf_counter() - started
+
+    result = {'ok': len(latencies), 'errors': len(errors),
+              'rps': len(latencies) / elapsed}
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100)
+        result.update(p50=percentiles[49] * 1000, p99=percentiles[98] * 1000,
+                      max=max(latencies) * 1000)
+    return result
+
+
+def start_server(mode, host, port, env=None, cwd=None,
+                 command=None) -> subprocess.Popen:
+    """
+    Starts ``app.py`` in the given mode, listening on ``port``, and waits
+    until it accepts connections.
+
+    :param mode: Value of ``SERVER_MODE``.
+    :type mode: str
+    :param host: Host the server is reached at.
+    :type host: str
+    :param port: Port of the server.
+    :type port: int
+    :param env: Further environment variables of the server.
+    :type env: dict, optional
+    :param cwd: Working directory of the server; the current directory by
+                default.
+    :type cwd: str, optional
+    :param command: Arguments of the Python interpreter running the
+                    server; ``app.py`` by default.
+    :type command: list[str], optional
+    :return: The server process.
+    :rtype: subprocess.Popen
+    :raises RuntimeError: If the server does not come up.
+    """
+    process = subprocess.Popen([sys.executable,
+                                *(command or [APP_SCRIPT])],
+                               env={**os.environ, **(env or {}),
+                                    'SERVER_MODE': mode,
+                                    'SERVER_PORT': str(port)},
+                               cwd=cwd,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'Server in {mode} mode did not start')
+
+
+def stop_server(process) -> None:
+    """
+    Stops a server started by `start_server`.
+
+    :param process: The server process.
+    :type process: subprocess.Popen
+    :return: None
+    """
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def raise_file_limit(connections) -> None:
+    """
+    Raises the limit of open files so all client sockets fit.
+
+    :param connections: Number of concurrent clients.
+    :type connections: int
+    :return: None
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections * 2 + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def main() -> None:
+    """
+    Runs the load test and prints the latency of every mode.
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Server load test')
+    parser.add_argument('--modes', nargs='+',
+                        default=['threaded', 'asyncio'],
+                        help='server modes to compare')
+    parser.add_argument('--connections', type=int, default=1000,
+                        help='concurrent connections')
+    parser.add_argument('--requests', type=int, default=5,
+                        help='requests per connection')
+    parser.add_argument('--path', default='/api/images_count/',
+                        help='requested path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=SERVER_ADDRESS[1])
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for a response')
+    parser.add_argument('--no-spawn', action='store_true',
+                        help='test the server already running')
+    args = parser.parse_args()
+    raise_file_limit(args.connections)
+
+    print(f'{args.connections} connections x {args.requests} requests '
+          f'of {args.path}')
+    print(f'{"mode":>10} {"ok":>7} {"errors":>7} {"req/s":>9} '
+          f'{"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for mode in ['server'] if args.no_spawn else args.modes:
+        process = None if args.no_spawn else \
+            start_server(mode, args.host, args.port)
+        try:
+            result = asyncio.run(run_load(
+                args.host, args.port, args.path, args.connections,
+                args.requests, args.timeout))
+        finally:
+            if process is not None:
+                stop_server(process)
+        print(f'{mode:>10} {result["ok"]:>7} {result["errors"]:>7} '
+              f'{result["rps"]:>9.0f} {result.get("p50", 0):>9.1f} '
+              f'{result.get("p99", 0):>9.1f} {result.get("max", 0):>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
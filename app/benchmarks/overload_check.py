@@ -0,0 +1,185 @@
+"""
+Overload check of the admission control.
+
+For every mode a server is started whose image count query is slowed down
+by ``--delay`` seconds, standing in for a database that stopped keeping
+up. A flood of concurrent count requests is sent, and an upload while the
+flood is in progress. The check passes if the flood is shed with 503 and
+``Retry-After`` while the upload still succeeds; the uploaded image is
+deleted afterwards. The database configured for the server must be
+reachable.
+
+Usage:
+    python -m benchmarks.overload_check [--modes threaded asyncio]
+        [--threads 8] [--listings 40] [--delay 2]
+"""
+import argparse
+import asyncio
+import http.client
+import io
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from benchmarks.load_test import start_server, stop_server
+from settings import SERVER_ADDRESS
+
+
+def serve(delay: float) -> None:
+    """
+    Runs the server with the count query of the metadata store slowed
+    down.
+
+    :param delay: Seconds added to every count query.
+    :type delay: float
+    :return: None
+    """
+    import app
+    from metadata_store import METADATA_STORES
+    from settings import METADATA_BACKEND
+
+    store_class = METADATA_STORES[METADATA_BACKEND]
+    count = store_class.count
+
+    def slow_count(self):
+        time.sleep(delay)
+        return count(self)
+
+    async def slow_count_async(self):
+        await asyncio.sleep(delay)
+        return await asyncio.to_thread(count, self)
+
+    store_class.count = slow_count
+    store_class.count_async = slow_count_async
+    app.run()
+
+
+def request(host, port, method, path, body=None, headers=None,
+            timeout=60) -> tuple:
+    """
+    Sends one request over a new connection.
+
+    :param host: Host of the server.
+    :type host: str
+    :param port: Port of the server.
+    :type port: int
+    :param method: HTTP method.
+    :type method: str
+    :param path: Requested path.
+    :type path: str
+    :param body: Request body.
+    :type body: bytes, optional
+    :param headers: Request headers.
+    :type headers: dict, optional
+    :param timeout: Seconds to wait for the response.
+    :type timeout: float, optional
+    :return: The status and the headers of the response.
+    :rtype: tuple[int, http.client.HTTPMessage]
+    """
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        response.read()
+        return response.status, response.headers
+    finally:
+        conn.close()
+
+
+def png() -> bytes:
+    """
+    Returns a small PNG image to upload.
+
+    :return: The encoded image.
+    :rtype: bytes
+    """
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), (200, 40, 40)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def check(host, port, listings) -> dict:
+    """
+    Floods the server with count requests and uploads an image meanwhile.
+
+    :param host: Host of the server.
+    :type host: str
+    :param port: Port of the server.
+    :type port: int
+    :param listings: Number of concurrent count requests.
+    :type listings: int
+    :return: The statuses of the flood, the status and duration of the
+             upload and whether the check passed.
+    :rtype: dict
+    """
+    with ThreadPoolExecutor(max_workers=listings) as executor:
+        flood = [executor.submit(request, host, port, 'GET',
+                                  '/api/images_count/')
+                 for _ in range(listings)]
+        time.sleep(0.3)
+        started = time.perf_counter()
+        upload_status, upload_headers = request(
+            host, port, 'POST', '/upload/', png(), {'Filename': 'check.png'})
+        upload_seconds = time.perf_counter() - started
+        results = [future.result() for future in flood]
+
+    location = upload_headers.get('Location') or ''
+    if location:
+        request(host, port, 'DELETE',
+                '/api/delete/' + location.rsplit('/', 1)[-1])
+    statuses = Counter(status for status, _ in results)
+    shed = [headers for status, headers in results if status == 503]
+    passed = upload_status == 200 and bool(shed) and \
+        all(headers.get('Retry-After') for headers in shed)
+    return {'statuses': dict(statuses), 'upload': upload_status,
+            'upload_seconds': upload_seconds, 'passed': passed}
+
+
+def main() -> None:
+    """
+    Runs the check in every mode and exits with status 1 if any failed.
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Admission control check')
+    parser.add_argument('--modes', nargs='+',
+                        default=['threaded', 'asyncio'],
+                        help='server modes to check')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='SERVER_THREADS of the server')
+    parser.add_argument('--listings', type=int, default=40,
+                        help='concurrent count requests of the flood')
+    parser.add_argument('--delay', type=float, default=2,
+                        help='seconds added to every count query')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=SERVER_ADDRESS[1])
+    parser.add_argument('--serve', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.delay)
+        return
+
+    env = {'SERVER_THREADS': str(args.threads), 'LISTING_CACHE_SIZE': '0'}
+    command = ['-m', 'benchmarks.overload_check', '--serve',
+               '--delay', str(args.delay)]
+    failed = False
+    for mode in args.modes:
+        process = start_server(mode, args.host, args.port, env,
+                               command=command)
+        try:
+            result = check(args.host, args.port, args.listings)
+        finally:
+            stop_server(process)
+        failed = failed or not result['passed']
+        print(f'{mode:>10} flood {result["statuses"]} upload '
+              f'{result["upload"]} in {result["upload_seconds"]:.3f}s '
+              f'{"ok" if result["passed"] else "FAILED"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Content-Addressed Blobs Module
+
+This module keeps track of the blobs of the deduplicating storage. When
+``DEDUP_ENABLED`` is set, an uploaded file is stored under the SHA-256
+digest of its content, as ``<digest><ext>``, and identical uploads share
+one stored file.
+
+The ``blobs`` table counts the ``images`` rows referencing every blob.
+Both functions work inside the caller's transaction and lock the blob row,
+so an upload and a deletion of the same content are serialized: a blob is
+stored by the transaction creating its row and removed by the one dropping
+its last reference, each before committing.
+
+Functions:
+----------
+- acquire_blob:
+- release_blob:
+- release_blobs:
+- acquire_blob_async:
+- release_blob_async:
+- release_blobs_async:
+"""
+import os
+
+import psycopg
+
+ACQUIRE_QUERY = (
+    "INSERT INTO blobs (hash, size, file_type) VALUES (%s, %s, %s)"
+    " ON CONFLICT (hash) DO UPDATE SET refcount = blobs.refcount + 1"
+    " RETURNING refcount, file_type;")
+RELEASE_QUERY = ("UPDATE blobs SET refcount = refcount - 1 WHERE hash = %s"
+                 " RETURNING refcount;")
+DELETE_QUERY = "DELETE FROM blobs WHERE hash = %s;"
+RELEASE_MANY_QUERY = (
+    "UPDATE blobs SET refcount = blobs.refcount - released.n"
+    " FROM (SELECT hash, COUNT(*) AS n FROM unnest(%s::text[]) AS hash"
+    " GROUP BY hash) AS released"
+    " WHERE blobs.hash = released.hash RETURNING blobs.hash, blobs.refcount;")
+DELETE_MANY_QUERY = ("DELETE FROM blobs WHERE hash = ANY(%s::text[])"
+                     " AND refcount = 0;")
+
+
+def acquire_blob(conn: psycopg.Connection, digest: str, size: int,
+                 ext: str) -> tuple[str, bool]:
+    """
+    Adds a reference to the blob with the given digest, creating it if it
+    does not exist yet.
+
+    :param conn: Connection with an open transaction.
+    :type conn: psycopg.Connection
+    :param digest: Hex SHA-256 digest of the content.
+    :type digest: str
+    :param size: Size of the content in bytes.
+    :type size: int
+    :param ext: Extension of the uploaded file, used if the blob is new.
+    :type ext: str
+    :return: File name of the blob and whether it was created, in which
+             case the caller must store the file.
+    :rtype: tuple[str, bool]
+    """
+    refcount, file_type = conn.execute(
+        ACQUIRE_QUERY, (digest, size, ext), prepare=True).fetchone()
+    return f'{digest}{file_type}', refcount == 1
+
+
+def release_blob(conn: psycopg.Connection, blob_name: str) -> bool:
+    """
+    Drops a reference to a blob, deleting its row with the last one.
+
+    :param conn: Connection with an open transaction.
+    :type conn: psycopg.Connection
+    :param blob_name: File name of the blob.
+    :type blob_name: str
+    :return: True if no reference is left and the caller must remove the
+             file, False if the blob is still referenced.
+    :rtype: bool
+    """
+    digest, _ = os.path.splitext(blob_name)
+    row = conn.execute(RELEASE_QUERY, (digest,), prepare=True).fetchone()
+    if row is not None and row.refcount > 0:
+        return False
+    conn.execute(DELETE_QUERY, (digest,), prepare=True)
+    return True
+
+
+def release_blobs(conn: psycopg.Connection, blob_names: list) -> list:
+    """
+    Drops one reference per item of ``blob_names`` in a single statement,
+    deleting the rows of the blobs left without references.
+
+    :param conn: Connection with an open transaction.
+    :type conn: psycopg.Connection
+    :param blob_names: File names of the blobs, once per dropped reference.
+    :type blob_names: list[str]
+    :return: File names of the blobs whose files the caller must remove.
+    :rtype: list[str]
+    """
+    names = {os.path.splitext(name)[0]: name for name in blob_names}
+    rows = conn.execute(RELEASE_MANY_QUERY, (
+        [os.path.splitext(name)[0] for name in blob_names],),
+        prepare=True).fetchall()
+    released = [row.hash for row in rows if row.refcount <= 0]
+    if released:
+        conn.execute(DELETE_MANY_QUERY, (released,), prepare=True)
+    return [names[digest] for digest in released]
+
+
+async def acquire_blob_async(conn: psycopg.AsyncConnection, digest: str,
+                             size: int, ext: str) -> tuple[str, bool]:
+    """
+    Asynchronous version of `acquire_blob`.
+
+    :param conn: Connection with an open transaction.
+    :type conn: psycopg.AsyncConnection
+    :param digest: Hex SHA-256 digest of the content.
+    :type digest: str
+    :param size: Size of the content in bytes.
+    :type size: int
+    :param ext: Extension of the uploaded file, used if the blob is new.
+    :type ext: str
+    :return: File name of the blob and whether it was created.
+    :rtype: tuple[str, bool]
+    """
+    cursor = await conn.execute(ACQUIRE_QUERY, (digest, size, ext),
+                                prepare=True)
+    refcount, file_type = await cursor.fetchone()
+    return f'{digest}{file_type}', refcount == 1
+
+
+async def release_blob_async(conn: psycopg.AsyncConnection,
+                             blob_name: str) -> bool:
+    """
+    Asynchronous version of `release_blob`.
+
+    :param conn: Connection with an open transaction.
+    :type conn: psycopg.AsyncConnection
+    :param blob_name: File name of the blob.
+    :type blob_name: str
+    :return: True if no reference is left and the caller must remove the
+             file, False if the blob is still referenced.
+    :rtype: bool
+    """
+    digest, _ = os.path.splitext(blob_name)
+    cursor = await conn.execute(RELEASE_QUERY, (digest,), prepare=True)
+    row = await cursor.fetchone()
+    if row is not None and row.refcount > 0:
+        return False
+    await conn.execute(DELETE_QUERY, (digest,), prepare=True)
+    return True
+
+
+async def release_blobs_async(conn: psycopg.AsyncConnection,
+                              blob_names: list) -> list:
+    """
+    Asynchronous version of `release_blobs`.
+
+    :param conn: Connection with an open transaction.
+    :type conn: psycopg.AsyncConnection
+    :param blob_names: File names of the blobs, once per dropped reference.
+    :type blob_names: list[str]
+    :return: File names of the blobs whose files the caller must remove.
+    :rtype: list[str]
+    """
+    names = {os.path.splitext(name)[0]: name for name in blob_names}
+    cursor = await conn.execute(RELEASE_MANY_QUERY, (
+        [os.path.splitext(name)[0] for name in blob_names],), prepare=True)
+    released = [row.hash for row in await cursor.fetchall()
+                if row.refcount <= 0]
+    if released:
+        await conn.execute(DELETE_MANY_QUERY, (released,), prepare=True)
+    return [names[digest] for digest in released]
@@ -0,0 +1,283 @@
+"""
+Bulk Delete Module
+
+This module deletes many images at once, selected either by a list of
+file names or by a filter on the upload time and file type.
+
+The images are deleted in batches of ``BULK_DELETE_BATCH_SIZE``. Every
+batch is one transaction: a single ``DELETE ... RETURNING`` statement
+removes the rows and the blob references of the batch are released in one
+statement. The files are unlinked by a pool of ``BULK_DELETE_WORKERS``
+threads: those of the blobs left without references before the commit,
+as an upload may take a blob over as soon as its row is gone, and those
+stored by a single image after the commit.
+
+A batch that fails before its commit leaves its rows in place, but the
+files of its released blobs may already be removed; until the request is
+sent again, which finishes the job, a deduplicated upload may reuse such
+a blob. If unlinking fails after the commit, the files left without rows
+are removed by the storage reconciler.
+
+Key Features:
+- Deletion by file names or by ``older_than``/``file_type`` filters.
+- Progress reported after every batch.
+- Native asyncio version for the asyncio server engine.
+
+Classes:
+----------
+- BulkDelete:
+
+Functions:
+----------
+- parse_criteria:
+- remove_images:
+- bulk_delete:
+- bulk_delete_async:
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import AsyncIterator, Iterator, Optional
+
+import psycopg
+from loguru import logger
+
+from DB_Manager import DBManager, AsyncDBManager
+from blobs import release_blobs, release_blobs_async
+from settings import BULK_DELETE_BATCH_SIZE, BULK_DELETE_WORKERS
+from storage import remove_file
+from thumbnails import thumbnail_name
+
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+DELETE_BY_NAME_QUERY = ("DELETE FROM images WHERE filename = ANY(%s::text[])"
+                        " RETURNING filename, file_type, blob_name;")
+DELETE_BY_FILTER_QUERY = (
+    "DELETE FROM images WHERE id IN (SELECT id FROM images"
+    " WHERE (%(older_than)s::timestamp IS NULL"
+    " OR upload_time < %(older_than)s::timestamp)"
+    " AND (%(file_type)s::text IS NULL OR file_type = %(file_type)s::text)"
+    " ORDER BY id LIMIT %(limit)s FOR UPDATE SKIP LOCKED)"
+    " RETURNING filename, file_type, blob_name;")
+
+
+def parse_criteria(data) -> dict:
+    """
+    Validates the body of a bulk delete request: either ``filenames``, a
+    list of image file names with or without their extension, or a filter
+    of ``older_than``, an ISO 8601 upload time, and/or ``file_type``.
+
+    :param data: The decoded JSON body.
+    :type data: object
+    :return: ``filenames`` without extensions, or ``older_than`` and
+             ``file_type``.
+    :rtype: dict
+    :raises ValueError: If the body selects no images or is malformed.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+
+    filenames = data.get('filenames')
+    if filenames is not None:
+        if not isinstance(filenames, list) or \
+                not all(isinstance(name, str) for name in filenames):
+            raise ValueError('filenames must be a list of strings')
+        return {'filenames': list(dict.fromkeys(
+            os.path.splitext(name)[0] for name in filenames))}
+
+    older_than = data.get('older_than')
+    file_type = data.get('file_type')
+    if older_than is None and file_type is None:
+        raise ValueError('Expected filenames, older_than or file_type')
+    if older_than is not None:
+        if not isinstance(older_than, str):
+            raise ValueError('older_than must be an ISO 8601 time')
+        older_than = datetime.fromisoformat(older_than)
+    if file_type is not None:
+        if not isinstance(file_type, str) or not file_type.strip('.'):
+            raise ValueError('file_type must be a file extension')
+        file_type = '.' + file_type.strip('.').lower()
+    return {'older_than': older_than, 'file_type': file_type}
+
+
+class BulkDelete:
+    """
+    Splits a bulk delete into batches and counts its progress.
+
+    :ivar criteria: The criteria returned by `parse_criteria`.
+    :type criteria: dict
+    :ivar batches: Number of batches completed.
+    :type batches: int
+    :ivar deleted: Number of images deleted.
+    :type deleted: int
+    :ivar files_removed: Number of stored files removed.
+    :type files_removed: int
+    :ivar done: Whether no images are left to delete.
+    :type done: bool
+    """
+    def __init__(self, criteria: dict) -> None:
+        self.criteria = criteria
+        self.batches = 0
+        self.deleted = 0
+        self.files_removed = 0
+        self.done = False
+
+    def next_batch(self) -> Optional[tuple[str, object]]:
+        """
+        Returns the query deleting the next batch.
+
+        :return: The query and its parameters, or None when done.
+        :rtype: Optional[tuple[str, object]]
+        """
+        if self.done:
+            return None
+        filenames = self.criteria.get('filenames')
+        if filenames is None:
+            return DELETE_BY_FILTER_QUERY, {**self.criteria,
+                                            'limit': BULK_DELETE_BATCH_SIZE}
+        start = self.batches * BULK_DELETE_BATCH_SIZE
+        names = filenames[start:start + BULK_DELETE_BATCH_SIZE]
+        if not names:
+            self.done = True
+            return None
+        return DELETE_BY_NAME_QUERY, (names,)
+
+    def record(self, deleted: int, files_removed: int) -> dict:
+        """
+        Counts a completed batch.
+
+        :param deleted: Number of images deleted by the batch.
+        :type deleted: int
+        :param files_removed: Number of files removed by the batch.
+        :type files_removed: int
+        :return: The progress after the batch.
+        :rtype: dict
+        """
+        self.batches += 1
+        self.deleted += deleted
+        self.files_removed += files_removed
+        filenames = self.criteria.get('filenames')
+        if filenames is None:
+            self.done = deleted < BULK_DELETE_BATCH_SIZE
+        else:
+            self.done = self.batches * BULK_DELETE_BATCH_SIZE >= len(filenames)
+        return self.progress()
+
+    def progress(self) -> dict:
+        """
+        Reports the progress of the bulk delete.
+
+        :return: Batches completed, images deleted, files removed and
+                 whether the bulk delete is done.
+        :rtype: dict
+        """
+        return {'batches': self.batches, 'deleted': self.deleted,
+                'files_removed': self.files_removed, 'done': self.done}
+
+
+def stored_names(rows: list) -> tuple[list, list]:
+    """
+    Splits deleted rows into the files they stored on their own and the
+    blobs they referenced.
+
+    :param rows: Rows returned by a delete query.
+    :type rows: list
+    :return: The stored file names and the blob names.
+    :rtype: tuple[list[str], list[str]]
+    """
+    files = [row.filename + (row.file_type or '') for row in rows
+             if not row.blob_name]
+    blobs = [row.blob_name for row in rows if row.blob_name]
+    return files, blobs
+
+
+def remove_image(stored_name: str) -> bool:
+    """
+    Removes a stored image together with its thumbnail.
+
+    :param stored_name: File name the image is stored under.
+    :type stored_name: str
+    :return: True if the image was removed, False if it was not stored.
+    :rtype: bool
+    """
+    if not remove_file(stored_name):
+        return False
+    remove_file(thumbnail_name(stored_name))
+    return True
+
+
+def remove_images(stored_names: list, executor: ThreadPoolExecutor) -> int:
+    """
+    Removes stored images using the threads of ``executor``.
+
+    :param stored_names: File names the images are stored under.
+    :type stored_names: list[str]
+    :param executor: The pool unlinking the files.
+    :type executor: ThreadPoolExecutor
+    :return: Number of images removed.
+    :rtype: int
+    :raises OSError: If a file cannot be removed.
+    """
+    return sum(executor.map(remove_image, stored_names))
+
+
+def bulk_delete(criteria: dict) -> Iterator[dict]:
+    """
+    Deletes the selected images batch by batch.
+
+    :param criteria: The criteria returned by `parse_criteria`.
+    :type criteria: dict
+    :return: An iterator over the progress after every batch. If a batch
+             fails, the last progress carries an ``error``.
+    :rtype: Iterator[dict]
+    """
+    job = BulkDelete(criteria)
+    with ThreadPoolExecutor(BULK_DELETE_WORKERS,
+                            thread_name_prefix='bulk-delete') as executor:
+        while (batch := job.next_batch()) is not None:
+            try:
+                with DBManager().connection() as conn:
+                    rows = conn.execute(*batch, prepare=True).fetchall()
+                    files, blobs = stored_names(rows)
+                    released = release_blobs(conn, blobs) if blobs else []
+                    removed = remove_images(released, executor)
+                removed += remove_images(files, executor)
+            except (psycopg.Error, OSError) as e:
+                logger.error(f'Bulk delete failed: {e}')
+                yield {**job.progress(), 'error': 'Bulk delete failed'}
+                return
+            yield job.record(len(rows), removed)
+    logger.info(f'Bulk delete: {job.deleted} images deleted')
+
+
+async def bulk_delete_async(criteria: dict) -> AsyncIterator[dict]:
+    """
+    Asynchronous version of `bulk_delete`.
+
+    :param criteria: The criteria returned by `parse_criteria`.
+    :type criteria: dict
+    :return: An iterator over the progress after every batch.
+    :rtype: AsyncIterator[dict]
+    """
+    job = BulkDelete(criteria)
+    with ThreadPoolExecutor(BULK_DELETE_WORKERS,
+                            thread_name_prefix='bulk-delete') as executor:
+        while (batch := job.next_batch()) is not None:
+            try:
+                async with AsyncDBManager().connection() as conn:
+                    cursor = await conn.execute(*batch, prepare=True)
+                    rows = await cursor.fetchall()
+                    files, blobs = stored_names(rows)
+                    released = await release_blobs_async(conn, blobs) \
+                        if blobs else []
+                    removed = await asyncio.to_thread(remove_images,
+                                                      released, executor)
+                removed += await asyncio.to_thread(remove_images, files,
+                                                   executor)
+            except (psycopg.Error, OSError) as e:
+                logger.error(f'Bulk delete failed: {e}')
+                yield {**job.progress(), 'error': 'Bulk delete failed'}
+                return
+            yield job.record(len(rows), removed)
+    logger.info(f'Bulk delete: {job.deleted} images deleted')
@@ -0,0 +1,200 @@
+"""
+Bulk Upload Module
+
+This module writes the files of a ``multipart/form-data`` bulk upload to
+temporary files in IMAGES_PATH while the request body is parsed, so that
+their metadata can then be stored in one batch.
+
+Key Features:
+- Files are validated against ``ALLOWED_EXTENSIONS`` and
+  ``MAX_FILE_SIZE`` part by part; a rejected file is reported and skipped
+  without failing the other files.
+- At most ``MAX_BULK_UPLOAD_FILES`` files per request.
+- Content is hashed while it is written when ``DEDUP_ENABLED`` is set.
+
+Classes:
+----------
+- UploadedFile:
+- BulkUpload:
+"""
+import hashlib
+import os
+from tempfile import NamedTemporaryFile
+from typing import Optional
+
+from adv_http_request_handler import RequestBodyTooLarge
+from multipart import PART_START, PART_DATA
+from settings import IMAGES_PATH, ALLOWED_EXTENSIONS, MAX_FILE_SIZE, \
+    MAX_BULK_UPLOAD_FILES, DEDUP_ENABLED
+
+
+class UploadedFile:
+    """
+    A file of a bulk upload.
+
+    :ivar original_name: File name given by the client.
+    :type original_name: str
+    :ivar ext: Extension of the file.
+    :type ext: str
+    :ivar size: Number of bytes received.
+    :type size: int
+    :ivar temp_path: Path of the temporary file holding the content.
+    :type temp_path: Optional[str]
+    :ivar digest: SHA-256 of the content, if uploads are deduplicated.
+    :ivar image_id: Identifier of the stored image.
+    :type image_id: Optional[UUID]
+    :ivar stored_name: File name the image is stored under.
+    :type stored_name: Optional[str]
+    :ivar error: Why the file was not stored, None if it was.
+    :type error: Optional[str]
+    """
+    def __init__(self, original_name: str) -> None:
+        self.original_name = original_name
+        self.ext = os.path.splitext(original_name)[1]
+        self.size = 0
+        self.temp_path = None
+        self.digest = hashlib.sha256() if DEDUP_ENABLED else None
+        self.image_id = None
+        self.stored_name = None
+        self.error = None
+
+    def result(self) -> dict:
+        """
+        Reports the outcome of the file to the client.
+
+        :return: The original name and either the stored image or the error.
+        :rtype: dict
+        """
+        if self.error or self.image_id is None:
+            return {'original_name': self.original_name,
+                    'error': self.error or 'Not stored'}
+        return {'original_name': self.original_name,
+                'filename': str(self.image_id),
+                'file_type': self.ext,
+                'size': self.size,
+                'url': f'/{IMAGES_PATH}{self.stored_name}'}
+
+
+class BulkUpload:
+    """
+    Collects the files of a multipart body from the events of a
+    `multipart.MultipartParser`. Parts without a file name are ignored.
+
+    :ivar files: Every file part received, in order.
+    :type files: list[UploadedFile]
+    """
+    def __init__(self) -> None:
+        self.files = []
+        self._current = None
+        self._file = None
+
+    def handle(self, events: list) -> None:
+        """
+        Writes the parts reported by the parser.
+
+        :param events: Events returned by `MultipartParser.feed`.
+        :type events: list[tuple[str, object]]
+        :return: None
+        :raises RequestBodyTooLarge: If there are too many files.
+        :raises OSError: If a file cannot be written.
+        """
+        for event, value in events:
+            if event == PART_START:
+                self.start_file(value[1])
+            elif event == PART_DATA:
+                self.write(value)
+            else:
+                self.end_file()
+
+    def start_file(self, filename: Optional[str]) -> None:
+        """
+        Starts the next part, opening a temporary file if it is an image
+        with an allowed extension.
+
+        :param filename: File name of the part, None for a plain field.
+        :type filename: Optional[str]
+        :return: None
+        :raises RequestBodyTooLarge: If there are too many files.
+        """
+        self.end_file()
+        if filename is None:
+            return
+        if len(self.files) >= MAX_BULK_UPLOAD_FILES:
+            raise RequestBodyTooLarge(f'More than {MAX_BULK_UPLOAD_FILES} '
+                                      f'files')
+        upload = UploadedFile(filename)
+        self.files.append(upload)
+        if upload.ext not in ALLOWED_EXTENSIONS:
+            upload.error = 'File type is not allowed'
+            return
+        self._file = NamedTemporaryFile(dir=IMAGES_PATH, prefix='.upload-',
+                                        suffix='.part', delete=False)
+        upload.temp_path = self._file.name
+        self._current = upload
+
+    def write(self, data: bytes) -> None:
+        """
+        Appends content to the current file. A file growing beyond
+        ``MAX_FILE_SIZE`` is rejected and its content dropped.
+
+        :param data: The content.
+        :type data: bytes
+        :return: None
+        """
+        upload = self._current
+        if upload is None:
+            return
+        upload.size += len(data)
+        if upload.size > MAX_FILE_SIZE:
+            upload.error = 'File is too large'
+            self._close_file()
+            os.remove(upload.temp_path)
+            upload.temp_path = None
+            self._current = None
+            return
+        self._file.write(data)
+        if upload.digest:
+            upload.digest.update(data)
+
+    def end_file(self) -> None:
+        """
+        Completes the current file.
+
+        :return: None
+        """
+        if self._file is not None:
+            self._close_file()
+            os.chmod(self._current.temp_path, 0o644)
+        self._current = None
+
+    def _close_file(self) -> None:
+        """
+        Closes the temporary file of the current part.
+
+        :return: None
+        """
+        self._file.close()
+        self._file = None
+
+    def accepted(self) -> list:
+        """
+        Returns the files that passed validation.
+
+        :return: The accepted files, in order.
+        :rtype: list[UploadedFile]
+        """
+        return [upload for upload in self.files if upload.error is None]
+
+    def discard(self) -> None:
+        """
+        Removes the temporary files left, e.g. after the body failed.
+
+        :return: None
+        """
+        if self._file is not None:
+            self._close_file()
+        self._current = None
+        for upload in self.files:
+            if upload.temp_path and os.path.exists(upload.temp_path):
+                os.remove(upload.temp_path)
+            upload.temp_path = None
@@ -0,0 +1,115 @@
+"""
+Export Module
+
+This module formats the metadata of the ``images`` table for the export
+route, which streams every row as newline-delimited JSON or CSV.
+
+Rows are read through a server-side cursor in batches of
+``EXPORT_BATCH_SIZE`` and every batch is encoded into one chunk of the
+response, so memory stays bounded by one batch whatever the size of the
+table.
+
+Key Features:
+- NDJSON and CSV output.
+- Optional ``since`` (upload time) and ``file_type`` filters.
+
+Functions:
+----------
+- parse_export_request:
+- export_header:
+- encode_rows:
+- row_values:
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from urllib.parse import parse_qs
+
+EXPORT_COLUMNS = ('id', 'filename', 'original_name', 'size', 'upload_time',
+                  'file_type', 'blob_name')
+EXPORT_QUERY = (
+    f"SELECT {', '.join(EXPORT_COLUMNS)} FROM images"
+    " WHERE (%(since)s::timestamp IS NULL"
+    " OR upload_time >= %(since)s::timestamp)"
+    " AND (%(file_type)s::text IS NULL OR file_type = %(file_type)s::text)"
+    " ORDER BY id;")
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def parse_export_request(query_string: str) -> tuple[str, dict]:
+    """
+    Reads the format and the filters of an export from the query string:
+    ``format`` (``ndjson`` or ``csv``), ``since``, an ISO 8601 upload
+    time, and ``file_type``.
+
+    :param query_string: The query string of the request.
+    :type query_string: str
+    :return: The format and the parameters of ``EXPORT_QUERY``.
+    :rtype: tuple[str, dict]
+    :raises ValueError: If a parameter is invalid.
+    """
+    query = {name: values[-1] for name, values
+             in parse_qs(query_string, keep_blank_values=True).items()}
+    export_format = query.get('format') or 'ndjson'
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown format {export_format}')
+
+    since = query.get('since') or None
+    if since is not None:
+        since = datetime.fromisoformat(since)
+    file_type = query.get('file_type') or None
+    if file_type is not None:
+        file_type = '.' + file_type.strip('.').lower()
+    return export_format, {'since': since, 'file_type': file_type}
+
+
+def export_header(export_format: str) -> bytes:
+    """
+    Returns what precedes the rows of an export.
+
+    :param export_format: ``ndjson`` or ``csv``.
+    :type export_format: str
+    :return: The CSV header line, nothing for NDJSON.
+    :rtype: bytes
+    """
+    if export_format == 'csv':
+        return (','.join(EXPORT_COLUMNS) + '\r\n').encode('utf-8')
+    return b''
+
+
+def encode_rows(rows: list, export_format: str) -> bytes:
+    """
+    Encodes a batch of rows.
+
+    :param rows: Rows of ``EXPORT_QUERY``, as named tuples.
+    :type rows: list
+    :param export_format: ``ndjson`` or ``csv``.
+    :type export_format: str
+    :return: The encoded rows.
+    :rtype: bytes
+    """
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(row_values(row).values() for row in rows)
+        return buffer.getvalue().encode('utf-8')
+    return ''.join(json.dumps(row_values(row)) + '\n'
+                   for row in rows).encode('utf-8')
+
+
+def row_values(row) -> dict:
+    """
+    Converts a row into JSON-serializable values.
+
+    :param row: A row of ``EXPORT_QUERY``.
+    :type row: NamedTuple
+    :return: The values by column name, with the upload time in ISO 8601.
+    :rtype: dict
+    """
+    values = row._asdict()
+    if values['upload_time'] is not None:
+        values['upload_time'] = values['upload_time'].isoformat()
+    return values
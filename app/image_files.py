@@ -0,0 +1,147 @@
+"""
+Image Files Module
+
+This module supports serving the stored images from the app itself, for
+deployments without nginx in front of it: it finds the file of a
+requested name, describes it with HTTP validators and parses byte ranges.
+
+Only plain file names of allowed image types are looked up, in either
+storage layout, and the resolved path must lie inside IMAGES_PATH, so a
+request cannot reach any other file. As with nginx, a thumbnail not
+generated yet is answered with the original image.
+
+Key Features:
+- Path traversal safe lookup of stored images and thumbnails.
+- ETag and Last-Modified validators derived from ``os.stat``.
+- Single byte range requests, including suffix ranges and ``If-Range``.
+
+Functions:
+----------
+- resolve_image:
+- file_etag:
+- last_modified:
+- parse_range:
+- if_range_matches:
+"""
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+
+from settings import IMAGES_PATH, ALLOWED_EXTENSIONS
+from storage import locate_image
+from thumbnails import THUMBNAIL_SUFFIX
+
+BYTE_RANGE = re.compile(r'bytes=(\d*)-(\d*)', re.ASCII)
+
+
+def resolve_image(filename: str) -> Optional[str]:
+    """
+    Finds the file of a requested image.
+
+    :param filename: The file name from the request path.
+    :type filename: str
+    :return: The real path of the file, or None if the name is not one of
+             a stored image.
+    :rtype: Optional[str]
+    """
+    stem, ext = os.path.splitext(filename)
+    if not stem or filename.startswith('.') or ext not in ALLOWED_EXTENSIONS \
+            or any(char in filename for char in '/\\\0'):
+        return None
+    path = locate_image(filename)
+    if path is None and stem.endswith(THUMBNAIL_SUFFIX):
+        path = locate_image(stem[:-len(THUMBNAIL_SUFFIX)] + ext)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    if os.path.commonpath((path, os.path.realpath(IMAGES_PATH))) != \
+            os.path.realpath(IMAGES_PATH):
+        return None
+    return path
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """
+    Returns the entity tag of a file, which changes whenever the file is
+    rewritten.
+
+    :param stat: The status of the file.
+    :type stat: os.stat_result
+    :return: The strong entity tag.
+    :rtype: str
+    """
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def last_modified(stat: os.stat_result) -> str:
+    """
+    Returns the modification time of a file as an HTTP date.
+
+    :param stat: The status of the file.
+    :type stat: os.stat_result
+    :return: The HTTP date.
+    :rtype: str
+    """
+    return formatdate(stat.st_mtime, usegmt=True)
+
+
+def parse_range(header: Optional[str], if_range: Optional[str],
+                stat: os.stat_result) -> Optional[tuple[int, int]]:
+    """
+    Parses the ``Range`` header of a request for a file.
+
+    Only a single range of bytes is served; a header asking for several
+    ranges, a malformed one or one whose ``If-Range`` validator does not
+    match the file is ignored, and the whole file is sent instead.
+
+    :param header: Value of the ``Range`` header.
+    :type header: Optional[str]
+    :param if_range: Value of the ``If-Range`` header.
+    :type if_range: Optional[str]
+    :param stat: The status of the file.
+    :type stat: os.stat_result
+    :return: The first and last byte of the range, or None to send the
+             whole file.
+    :rtype: Optional[tuple[int, int]]
+    :raises ValueError: If the range cannot be satisfied.
+    """
+    match = BYTE_RANGE.fullmatch(header.strip()) if header else None
+    if match is None or not any(match.groups()):
+        return None
+    if if_range and not if_range_matches(if_range, stat):
+        return None
+
+    first, last = (int(value) if value else None for value in match.groups())
+    size = stat.st_size
+    if first is None:
+        if last == 0 or size == 0:
+            raise ValueError('Empty suffix range')
+        return max(0, size - last), size - 1
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        raise ValueError('Range starts beyond the end of the file')
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+def if_range_matches(if_range: str, stat: os.stat_result) -> bool:
+    """
+    Checks the ``If-Range`` validator, an entity tag or an HTTP date,
+    against a file.
+
+    :param if_range: Value of the ``If-Range`` header.
+    :type if_range: str
+    :param stat: The status of the file.
+    :type stat: os.stat_result
+    :return: True if the file is unchanged.
+    :rtype: bool
+    """
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == file_etag(stat)
+    try:
+        return parsedate_to_datetime(if_range).timestamp() == \
+            int(stat.st_mtime)
+    except (TypeError, ValueError):
+        return False
@@ -0,0 +1,286 @@
+"""
+Image Import Module
+
+This module registers image files that exist on disk but have no row in
+the ``images`` table, for example after a node was restored from a file
+backup.
+
+Files are found with ``os.scandir`` in a fixed, sorted order and checked
+in a pool of worker processes: the extension must be allowed, the size
+within ``MAX_FILE_SIZE`` and the content a readable image. The rows of
+every batch are loaded with ``COPY`` into a temporary staging table and
+inserted from there, skipping files already registered, in one
+transaction per batch.
+
+Files found in IMAGES_PATH are registered in place, under their own
+names. Files of another directory are copied into IMAGES_PATH first,
+named by a UUID derived from their path relative to that directory, so
+importing the same tree again yields the same names.
+
+After every batch the last imported path is written to a checkpoint
+file, and an interrupted import resumes after it. Since rows are only
+inserted for files not registered yet, an import can also safely be
+repeated from the start.
+
+Functions:
+----------
+- iter_files:
+- inspect_file:
+- import_images:
+"""
+import itertools
+import os
+import re
+import shutil
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from tempfile import NamedTemporaryFile
+from typing import Iterator, Optional
+
+from PIL import Image, UnidentifiedImageError
+from loguru import logger
+
+from DB_Manager import DBManager
+from settings import IMAGES_PATH, ALLOWED_EXTENSIONS, MAX_FILE_SIZE
+from storage import store_file, locate_image, read_checkpoint, \
+    write_checkpoint
+from thumbnails import THUMBNAIL_SUFFIX
+
+IMPORT_NAMESPACE = uuid.UUID('88194872-e781-41d5-a7fe-dffb942272dc')
+BLOB_NAME = re.compile(r'[0-9a-f]{64}')
+CHECKPOINT_FILE = '.import-checkpoint'
+
+CREATE_STAGING_QUERY = (
+    "CREATE TEMP TABLE IF NOT EXISTS images_import ("
+    " filename VARCHAR(255), original_name VARCHAR(255), size INTEGER,"
+    " file_type VARCHAR(10), upload_time TIMESTAMP) ON COMMIT DELETE ROWS;")
+COPY_QUERY = ("COPY images_import (filename, original_name, size, file_type,"
+              " upload_time) FROM STDIN")
+INSERT_QUERY = (
+    "INSERT INTO images (filename, original_name, size, file_type,"
+    " upload_time)"
+    " SELECT DISTINCT ON (s.filename) s.filename, s.original_name, s.size,"
+    " s.file_type, s.upload_time FROM images_import s"
+    " WHERE NOT EXISTS (SELECT 1 FROM images i"
+    " WHERE i.filename = s.filename);")
+
+
+def iter_files(directory: str, after: Optional[str] = None) -> Iterator[str]:
+    """
+    Iterates over the image files below a directory in sorted order.
+
+    Hidden files and thumbnails are skipped. Entries are visited depth
+    first in name order, so the relative paths come in the order of their
+    components and everything up to ``after`` can be skipped, including
+    whole directories.
+
+    :param directory: The directory to walk.
+    :type directory: str
+    :param after: Relative path of the last file already imported.
+    :type after: Optional[str]
+    :return: An iterator over the paths relative to ``directory``.
+    :rtype: Iterator[str]
+    """
+    after_parts = tuple(after.split('/')) if after else ()
+
+    def walk(path, parts):
+        with os.scandir(path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            entry_parts = parts + (entry.name,)
+            if entry.is_dir(follow_symlinks=False):
+                if entry_parts >= after_parts[:len(entry_parts)]:
+                    yield from walk(entry.path, entry_parts)
+            elif entry.is_file() and entry_parts > after_parts and \
+                    not os.path.splitext(entry.name)[0].endswith(
+                        THUMBNAIL_SUFFIX):
+                yield '/'.join(entry_parts)
+
+    yield from walk(directory, ())
+
+
+def inspect_file(source: str, target: Optional[str]) -> tuple:
+    """
+    Checks a file and, when importing from another directory, copies it
+    into IMAGES_PATH. Runs in a worker process.
+
+    :param source: Path of the file.
+    :type source: str
+    :param target: File name to store a copy under, None to register the
+                   file in place.
+    :type target: Optional[str]
+    :return: The error if the file was rejected, else None, followed by
+             the size and modification time of the file.
+    :rtype: tuple[Optional[str], int, float]
+    """
+    try:
+        stat = os.stat(source)
+        if not 0 < stat.st_size <= MAX_FILE_SIZE:
+            return 'size', stat.st_size, stat.st_mtime
+        with Image.open(source) as image:
+            image.verify()
+        if target and locate_image(target) is None:
+            with NamedTemporaryFile(dir=IMAGES_PATH, prefix='.import-',
+                                    suffix='.part', delete=False) as file:
+                with open(source, 'rb') as original:
+                    shutil.copyfileobj(original, file)
+            os.chmod(file.name, 0o644)
+            store_file(file.name, target)
+    except UnidentifiedImageError:
+        return 'invalid', 0, 0.0
+    except OSError:
+        return 'unreadable', 0, 0.0
+    except Exception:
+        # PIL raises a variety of errors for corrupt images.
+        return 'invalid', 0, 0.0
+    return None, stat.st_size, stat.st_mtime
+
+
+def import_images(directory: str = IMAGES_PATH, workers: int = None,
+                  batch_size: int = 5000, checkpoint: str = None,
+                  restart: bool = False) -> Counter:
+    """
+    Registers the image files of a directory in the ``images`` table.
+
+    :param directory: The directory holding the files.
+    :type directory: str, optional
+    :param workers: Number of worker processes; one per CPU by default.
+    :type workers: int, optional
+    :param batch_size: Number of files loaded per transaction.
+    :type batch_size: int, optional
+    :param checkpoint: Path of the checkpoint file; by default
+                       ``.import-checkpoint`` in ``directory``.
+    :type checkpoint: str, optional
+    :param restart: Whether to ignore an existing checkpoint.
+    :type restart: bool, optional
+    :return: Numbers of files ``imported``, already ``registered`` and
+             rejected per reason.
+    :rtype: collections.Counter
+    """
+    in_place = os.path.abspath(directory) == os.path.abspath(IMAGES_PATH)
+    checkpoint = checkpoint or os.path.join(directory, CHECKPOINT_FILE)
+    state = {} if restart else read_checkpoint(checkpoint)
+    after = state.get('last') \
+        if state.get('directory') == os.path.abspath(directory) else None
+    if after:
+        logger.info(f'Resuming import after {after}')
+
+    workers = workers or os.cpu_count()
+    results = Counter()
+    started = time.monotonic()
+    paths = iter_files(directory, after)
+    with ProcessPoolExecutor(workers) as executor, \
+            DBManager().connection() as conn:
+        conn.execute(CREATE_STAGING_QUERY)
+        conn.commit()
+        pending = None
+        while batch := list(itertools.islice(paths, batch_size)):
+            files = [path for path in batch
+                     if os.path.splitext(path)[1] in ALLOWED_EXTENSIONS]
+            results['extension'] += len(batch) - len(files)
+            names = [import_name(path, in_place) for path in files]
+            # Inspect the next batch while the current one is loaded.
+            inspected = executor.map(
+                inspect_file,
+                [os.path.join(directory, path) for path in files],
+                [None if in_place else name for name in names],
+                chunksize=max(1, len(files) // (4 * workers)))
+            if pending:
+                load_batch(conn, *pending[1:], results)
+                write_checkpoint(checkpoint, {
+                    'directory': os.path.abspath(directory),
+                    'last': pending[0]})
+                report(results, started)
+            pending = batch[-1], files, names, inspected
+        if pending:
+            load_batch(conn, *pending[1:], results)
+            report(results, started)
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    elapsed = time.monotonic() - started
+    total = sum(results.values())
+    logger.info(f'Import finished: {dict(results)} in {elapsed:.1f}s '
+                f'({total / max(elapsed, 1e-9):.0f} files/s)')
+    return results
+
+
+def import_name(path: str, in_place: bool) -> Optional[str]:
+    """
+    Returns the file name an imported file is stored under.
+
+    :param path: Path of the file relative to the imported directory.
+    :type path: str
+    :param in_place: Whether the directory is IMAGES_PATH.
+    :type in_place: bool
+    :return: The stored file name, None for a blob of the deduplicating
+             storage, which is registered in the ``blobs`` table instead.
+    :rtype: Optional[str]
+    """
+    name = os.path.basename(path)
+    stem, ext = os.path.splitext(name)
+    if in_place:
+        return None if BLOB_NAME.fullmatch(stem) else name
+    return f'{uuid.uuid5(IMPORT_NAMESPACE, path)}{ext}'
+
+
+def load_batch(conn, batch: list, names: list, inspected,
+               results: Counter) -> None:
+    """
+    Loads the valid files of a batch through the staging table and
+    commits them.
+
+    :param conn: The database connection.
+    :type conn: psycopg.Connection
+    :param batch: Relative paths of the files.
+    :type batch: list[str]
+    :param names: File names the files are stored under.
+    :type names: list[Optional[str]]
+    :param inspected: Results of `inspect_file` for the files.
+    :type inspected: Iterator[tuple]
+    :param results: Collects the numbers of files per outcome.
+    :type results: collections.Counter
+    :return: None
+    """
+    rows = []
+    for path, name, (error, size, mtime) in zip(batch, names, inspected):
+        if name is None:
+            results['blob'] += 1
+        elif error:
+            logger.warning(f'Not imported ({error}): {path}')
+            results[error] += 1
+        else:
+            stem, ext = os.path.splitext(name)
+            rows.append((stem, os.path.basename(path), size, ext,
+                         datetime.fromtimestamp(mtime)))
+
+    with conn.cursor() as cursor:
+        with cursor.copy(COPY_QUERY) as copy:
+            for row in rows:
+                copy.write_row(row)
+        cursor.execute(INSERT_QUERY)
+        inserted = cursor.rowcount
+    conn.commit()
+    results['imported'] += inserted
+    results['registered'] += len(rows) - inserted
+
+
+def report(results: Counter, started: float) -> None:
+    """
+    Logs the progress of an import.
+
+    :param results: Numbers of files per outcome.
+    :type results: collections.Counter
+    :param started: Monotonic time the import started at.
+    :type started: float
+    :return: None
+    """
+    total = sum(results.values())
+    elapsed = time.monotonic() - started
+    logger.info(f'{total} files processed, {results["imported"]} imported '
+                f'({total / max(elapsed, 1e-9):.0f} files/s)')
@@ -5,4 +5,83 @@ CREATE TABLE IF NOT EXISTS images (
         size INTEGER,
         upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         file_type VARCHAR(10)
-);
\ No newline at end of file
+);
+
+ALTER TABLE images ADD COLUMN IF NOT EXISTS blob_name VARCHAR(255);
+
+CREATE TABLE IF NOT EXISTS blobs (
+        hash CHAR(64) PRIMARY KEY,
+        size INTEGER NOT NULL,
+        file_type VARCHAR(10) NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 1 CHECK (refcount >= 0)
+);
+
+CREATE INDEX IF NOT EXISTS images_upload_time_id_idx
+        ON images (upload_time DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS images_filename_idx ON images (filename);
+
+CREATE INDEX IF NOT EXISTS images_stored_name_idx
+        ON images (((filename || COALESCE(file_type, '')) COLLATE "C"))
+        WHERE blob_name IS NULL;
+
+CREATE INDEX IF NOT EXISTS blobs_stored_name_idx
+        ON blobs (((hash || file_type) COLLATE "C"));
+
+CREATE TABLE IF NOT EXISTS images_stats (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        images_count BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO images_stats (images_count)
+SELECT COUNT(*) FROM images
+WHERE NOT EXISTS (SELECT 1 FROM images_stats)
+ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION images_count_inserted() RETURNS TRIGGER AS $$
+BEGIN
+        UPDATE images_stats
+        SET images_count = images_count + (SELECT COUNT(*) FROM inserted);
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION images_count_deleted() RETURNS TRIGGER AS $$
+BEGIN
+        UPDATE images_stats
+        SET images_count = images_count - (SELECT COUNT(*) FROM deleted);
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION images_count_truncated() RETURNS TRIGGER AS $$
+BEGIN
+        UPDATE images_stats SET images_count = 0;
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER images_count_insert
+        AFTER INSERT ON images
+        REFERENCING NEW TABLE AS inserted
+        FOR EACH STATEMENT EXECUTE FUNCTION images_count_inserted();
+
+CREATE OR REPLACE TRIGGER images_count_delete
+        AFTER DELETE ON images
+        REFERENCING OLD TABLE AS deleted
+        FOR EACH STATEMENT EXECUTE FUNCTION images_count_deleted();
+
+CREATE OR REPLACE TRIGGER images_count_truncate
+        AFTER TRUNCATE ON images
+        FOR EACH STATEMENT EXECUTE FUNCTION images_count_truncated();
+
+CREATE OR REPLACE FUNCTION images_notify_changed() RETURNS TRIGGER AS $$
+BEGIN
+        PERFORM pg_notify('images_changed', '');
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER images_notify_change
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON images
+        FOR EACH STATEMENT EXECUTE FUNCTION images_notify_changed();
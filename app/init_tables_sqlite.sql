@@ -0,0 +1,49 @@
+CREATE TABLE IF NOT EXISTS images (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename VARCHAR(255) NOT NULL,
+        original_name VARCHAR(255) NOT NULL,
+        size INTEGER,
+        upload_time TIMESTAMP
+                DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+        file_type VARCHAR(10),
+        blob_name VARCHAR(255)
+);
+
+CREATE TABLE IF NOT EXISTS blobs (
+        hash CHAR(64) PRIMARY KEY,
+        size INTEGER NOT NULL,
+        file_type VARCHAR(10) NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 1 CHECK (refcount >= 0)
+);
+
+CREATE INDEX IF NOT EXISTS images_upload_time_id_idx
+        ON images (upload_time DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS images_filename_idx ON images (filename);
+
+CREATE INDEX IF NOT EXISTS images_stored_name_idx
+        ON images ((filename || COALESCE(file_type, '')) COLLATE BINARY)
+        WHERE blob_name IS NULL;
+
+CREATE INDEX IF NOT EXISTS blobs_stored_name_idx
+        ON blobs ((hash || file_type) COLLATE BINARY);
+
+CREATE TABLE IF NOT EXISTS images_stats (
+        id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+        images_count INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO images_stats (id, images_count)
+SELECT 1, COUNT(*) FROM images;
+
+CREATE TRIGGER IF NOT EXISTS images_count_insert
+        AFTER INSERT ON images
+BEGIN
+        UPDATE images_stats SET images_count = images_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS images_count_delete
+        AFTER DELETE ON images
+BEGIN
+        UPDATE images_stats SET images_count = images_count - 1;
+END;
@@ -0,0 +1,181 @@
+"""
+Listing Cache Module
+
+This module implements the `ListingCache` class, which keeps the encoded
+JSON responses of the image listing in memory, so that the first pages,
+requested by almost every gallery view, are answered without querying
+the database or serializing the rows again.
+
+Responses are kept in LRU order, at most ``LISTING_CACHE_SIZE`` of them,
+for at most ``LISTING_CACHE_TTL`` seconds. Every change of the ``images``
+table clears the cache and bumps its generation: the handlers invalidate
+it after committing an upload or a deletion, and a statement trigger on
+the table notifies the ``images_changed`` channel, which a listener
+thread of every server process waits on; with the SQLite metadata store
+the listener polls the database for commits instead. A response read from
+the database is only cached if the generation did not change meanwhile,
+so an invalidation racing with the query is never undone. While the
+listener is not connected, nothing is cached.
+
+Key Features:
+- Singleton class.
+- LRU eviction with a size limit and a time to live.
+- Invalidation across processes by the changes reported by the metadata
+  store.
+
+Classes:
+----------
+- ListingCache:
+"""
+import os
+import time
+from collections import OrderedDict
+from contextlib import closing
+from threading import Lock, Thread
+from typing import Hashable, Optional
+
+from loguru import logger
+
+from metadata_store import STORE_ERRORS, metadata_store
+from metrics import LISTING_CACHE_REQUESTS
+from settings import LISTING_CACHE_SIZE, LISTING_CACHE_TTL
+from singleton import SingletonMeta
+
+RECONNECT_DELAY = 5
+
+
+class ListingCache(metaclass=SingletonMeta):
+    """
+    LRU cache of encoded image listing responses.
+
+    The listener thread is started on first use, so pre-forked workers
+    each get their own instead of inheriting the state of the parent.
+
+    :ivar max_entries: Maximum number of cached responses; 0 disables the
+                       cache.
+    :type max_entries: int
+    :ivar ttl: Seconds a response is cached for.
+    :type ttl: float
+    :ivar generation: Number of invalidations so far.
+    :type generation: int
+    """
+    def __init__(self, max_entries=LISTING_CACHE_SIZE,
+                 ttl=LISTING_CACHE_TTL) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._listening = False
+        self._listener_pid = None
+
+    def get(self, key: Hashable) -> tuple[Optional[bytes], int]:
+        """
+        Looks up a cached response.
+
+        :param key: Identifies the requested page.
+        :type key: Hashable
+        :return: The response body, or None on a miss, and the generation
+                 to pass to `put` along with the response built instead.
+        :rtype: tuple[Optional[bytes], int]
+        """
+        if not self.max_entries:
+            return None, 0
+        self._start_listener()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    LISTING_CACHE_REQUESTS.inc(1, 'hit')
+                    return entry[1], self.generation
+                del self._entries[key]
+            generation = self.generation
+        LISTING_CACHE_REQUESTS.inc(1, 'miss')
+        return None, generation
+
+    def put(self, key: Hashable, body: bytes, generation: int) -> None:
+        """
+        Caches a response unless the cache was invalidated since it was
+        looked up.
+
+        :param key: Identifies the page.
+        :type key: Hashable
+        :param body: The encoded response.
+        :type body: bytes
+        :param generation: The generation returned by `get`.
+        :type generation: int
+        :return: None
+        """
+        if not self.max_entries:
+            return
+        with self._lock:
+            if not self._listening or generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """
+        Drops every cached response.
+
+        :return: None
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def _start_listener(self) -> None:
+        """
+        Starts the thread listening for changes of the ``images`` table in
+        this process, unless it is running.
+
+        :return: None
+        """
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._lock:
+            if self._listener_pid == pid:
+                return
+            self._listener_pid = pid
+            self._listening = False
+            self._entries.clear()
+        Thread(target=self._listen, name='listing-cache',
+               daemon=True).start()
+
+    def _listen(self) -> None:
+        """
+        Invalidates the cache on every change reported by the metadata
+        store, reconnecting when the connection is lost.
+
+        :return: None
+        """
+        while True:
+            try:
+                changes = metadata_store().changes()
+                with closing(changes):
+                    next(changes)
+                    self._set_listening(True)
+                    for _ in changes:
+                        self.invalidate()
+            except STORE_ERRORS as e:
+                logger.warning(f'Listing cache listener disconnected: {e}')
+            self._set_listening(False)
+            time.sleep(RECONNECT_DELAY)
+
+    def _set_listening(self, listening: bool) -> None:
+        """
+        Records whether changes are being listened for. Changes may have
+        been missed meanwhile, so the cache is invalidated as well.
+
+        :param listening: Whether the listener is connected.
+        :type listening: bool
+        :return: None
+        """
+        with self._lock:
+            self._listening = listening
+            self.generation += 1
+            self._entries.clear()
@@ -0,0 +1,196 @@
+"""
+Logging Configuration Module
+
+This module sets up the loguru sinks of the server and decides which
+request lines are logged.
+
+Key Features:
+- ``LOG_MODE=sync`` writes every line as it is logged; ``LOG_MODE=async``
+  hands lines to a background thread (loguru ``enqueue``) that writes the
+  log file in batches of ``LOG_BATCH_SIZE`` lines, at least every
+  ``LOG_FLUSH_INTERVAL`` seconds.
+- ``LOG_FORMAT=json`` writes the log file as one JSON object per line,
+  with the fields bound to the log call as keys.
+- One access line per request, written after the response. Lines of
+  successful requests are sampled per route; errors are always logged.
+- Lines below ``LOG_LEVEL`` are dropped by loguru before their message is
+  formatted, so debug calls with lazy arguments cost nothing.
+
+Classes:
+----------
+- LogFileSink:
+
+Functions:
+----------
+- configure_logging:
+- should_log_request:
+"""
+import json
+import os
+import random
+import sys
+from threading import Event, Lock, Thread
+
+from loguru import logger
+
+from settings import LOG_PATH, LOG_FILE, LOG_LEVEL, LOG_MODE, LOG_FORMAT, \
+    LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_SAMPLE_RATE, LOG_SAMPLE_ROUTES
+
+FILE_FORMAT = '[{time:YYYY-MM-DD HH:mm:ss}] {level}: {message}'
+
+SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (item.partition('=')
+                           for item in LOG_SAMPLE_ROUTES.split(','))
+    if route.strip()
+}
+
+
+class LogFileSink:
+    """
+    Appends log lines to a file, writing them in batches.
+
+    :ivar path: Path of the log file.
+    :type path: str
+    :ivar batch_size: Number of lines collected before they are written.
+    :type batch_size: int
+    :ivar flush_interval: Maximum seconds a collected line waits.
+    :type flush_interval: float
+    :ivar json_format: Whether lines are written as JSON objects.
+    :type json_format: bool
+    """
+    def __init__(self, path, batch_size=1, flush_interval=1.0,
+                 json_format=False) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.json_format = json_format
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._buffer = []
+        self._lock = Lock()
+        self._stopped = Event()
+        if batch_size > 1:
+            Thread(target=self._flush_periodically, name='log-flush',
+                   daemon=True).start()
+
+    def write(self, message) -> None:
+        """
+        Collects a formatted message, writing the batch when it is full.
+
+        :param message: The message formatted by loguru.
+        :type message: loguru.Message
+        :return: None
+        """
+        line = self.to_json(message.record) if self.json_format \
+            else str(message)
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.batch_size:
+                self._write_buffer()
+
+    def flush_buffer(self) -> None:
+        """
+        Writes the collected lines.
+
+        :return: None
+        """
+        with self._lock:
+            self._write_buffer()
+
+    def _write_buffer(self) -> None:
+        """
+        Writes the collected lines; the caller holds the lock.
+
+        :return: None
+        """
+        if self._buffer and not self._file.closed:
+            self._file.write(''.join(self._buffer))
+            self._file.flush()
+            self._buffer.clear()
+
+    def _flush_periodically(self) -> None:
+        """
+        Writes the collected lines every ``flush_interval`` seconds.
+
+        :return: None
+        """
+        while not self._stopped.wait(self.flush_interval):
+            self.flush_buffer()
+
+    def stop(self) -> None:
+        """
+        Writes the remaining lines and closes the file. Called by loguru
+        when the sink is removed, including at exit.
+
+        :return: None
+        """
+        self._stopped.set()
+        with self._lock:
+            self._write_buffer()
+            self._file.close()
+
+    @staticmethod
+    def to_json(record) -> str:
+        """
+        Converts a log record into a line of JSON.
+
+        :param record: The record of the message.
+        :type record: dict
+        :return: The JSON object followed by a newline.
+        :rtype: str
+        """
+        entry = {
+            'time': record['time'].isoformat(),
+            'level': record['level'].name,
+            'message': record['message'],
+            'module': record['name'],
+            **record['extra'],
+        }
+        if record['exception'] is not None:
+            entry['exception'] = repr(record['exception'].value)
+        return json.dumps(entry, default=str) + '\n'
+
+
+def configure_logging(mode=LOG_MODE, log_format=LOG_FORMAT,
+                      level=LOG_LEVEL) -> None:
+    """
+    Replaces the sinks of the logger with the console and the log file.
+
+    :param mode: ``sync`` or ``async``.
+    :type mode: str, optional
+    :param log_format: Format of the log file, ``text`` or ``json``.
+    :type log_format: str, optional
+    :param level: Minimum level of the logged lines.
+    :type level: str, optional
+    :return: None
+    """
+    enqueue = mode == 'async'
+    logger.remove()
+    logger.add(sys.stderr, level=level, enqueue=enqueue)
+    sink = LogFileSink(LOG_PATH + LOG_FILE,
+                       batch_size=LOG_BATCH_SIZE if enqueue else 1,
+                       flush_interval=LOG_FLUSH_INTERVAL,
+                       json_format=log_format == 'json')
+    logger.add(sink, format=FILE_FORMAT, level=level, enqueue=enqueue)
+
+
+def should_log_request(route: str, status) -> bool:
+    """
+    Decides whether the access line of a request is logged.
+
+    Responses with a status of 400 or more, or without a status, are
+    always logged. Others are kept with the probability configured for
+    their route in ``LOG_SAMPLE_ROUTES``, or ``LOG_SAMPLE_RATE``.
+
+    :param route: Name of the handler of the request.
+    :type route: str
+    :param status: Status code of the response, None if none was sent.
+    :type status: Optional[int]
+    :return: True if the line is to be logged.
+    :rtype: bool
+    """
+    if status is None or status >= 400:
+        return True
+    rate = SAMPLE_RATES.get(route, LOG_SAMPLE_RATE)
+    return rate >= 1 or random.random() < rate
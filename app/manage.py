@@ -0,0 +1,153 @@
+"""
+Maintenance commands for the image hosting server.
+
+Usage:
+    python manage.py reconcile-count
+    python manage.py backfill-thumbnails
+    python manage.py migrate-layout [--layout flat|sharded] [--workers N]
+    python manage.py import-images [DIRECTORY] [--workers N]
+                                   [--batch-size N] [--checkpoint PATH]
+                                   [--restart]
+    python manage.py reconcile-storage [--repair] [--limit N] [--all]
+                                       [--restart]
+
+reconcile-count, import-images and reconcile-storage work on Postgres and
+refuse to run with another metadata store.
+"""
+import argparse
+import os
+
+from loguru import logger
+
+from DB_Manager import DBManager
+from importer import import_images
+from metadata_store import metadata_store
+from reconciler import reconcile
+from settings import ALLOWED_EXTENSIONS, IMAGES_LAYOUT, IMAGES_PATH, \
+    RECONCILE_BATCH_SIZE, METADATA_BACKEND
+from storage import LAYOUTS, iter_stored_files, migrate_layout
+from thumbnails import ThumbnailQueue, thumbnail_name, THUMBNAIL_SUFFIX
+
+BULK_COMMANDS = ('reconcile-count', 'import-images', 'reconcile-storage')
+
+
+def reconcile_count() -> None:
+    """
+    Recomputes the maintained image counter from the ``images`` table.
+
+    The table is locked against writes while counting, so uploads and
+    deletions that happen meanwhile cannot make the counter drift again.
+
+    :return: None
+    """
+    with DBManager().connection() as conn:
+        conn.execute('LOCK TABLE images IN SHARE MODE;')
+        stored = conn.execute('SELECT images_count FROM '
+                              'images_stats;').fetchone()[0]
+        actual = conn.execute('SELECT COUNT(*) FROM images;').fetchone()[0]
+        if stored != actual:
+            conn.execute('UPDATE images_stats SET images_count = %s;',
+                         (actual,))
+    if stored != actual:
+        logger.warning(f'Image counter drifted: {stored} stored, '
+                       f'{actual} actual; fixed')
+    else:
+        logger.info(f'Image counter is up to date: {actual}')
+
+
+def backfill_thumbnails() -> None:
+    """
+    Generates the missing thumbnails of the images stored in IMAGES_PATH,
+    in either storage layout.
+
+    Jobs go through the bounded thumbnail queue, waiting for room when it
+    is full, so memory use does not depend on the number of images.
+
+    :return: None
+    """
+    queue = ThumbnailQueue()
+    for entry in iter_stored_files():
+        stem, ext = os.path.splitext(entry.name)
+        if ext not in ALLOWED_EXTENSIONS or stem.endswith(THUMBNAIL_SUFFIX):
+            continue
+        thumbnail = os.path.join(os.path.dirname(entry.path),
+                                 thumbnail_name(entry.name))
+        if not os.path.exists(thumbnail):
+            queue.submit(entry.name, block=True, source=entry.path)
+    queue.shutdown(wait=True)
+    state = queue.state()
+    logger.info(f'Thumbnails backfilled: {state["completed"]}, '
+                f'failed: {state["failed"]}')
+
+
+def main() -> None:
+    """
+    Parses the command line and runs the selected command.
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('reconcile-count',
+                        help='fix drift of the maintained image counter')
+    commands.add_parser('backfill-thumbnails',
+                        help='generate thumbnails missing for stored images')
+    migrate = commands.add_parser(
+        'migrate-layout', help='move stored images to another layout')
+    migrate.add_argument('--layout', choices=LAYOUTS, default=IMAGES_LAYOUT,
+                         help='target layout (default: IMAGES_LAYOUT)')
+    migrate.add_argument('--workers', type=int, default=8,
+                         help='number of files moved in parallel')
+    importing = commands.add_parser(
+        'import-images', help='register the image files of a directory')
+    importing.add_argument('directory', nargs='?', default=IMAGES_PATH,
+                           help='directory to import (default: IMAGES_PATH)')
+    importing.add_argument('--workers', type=int, default=os.cpu_count(),
+                           help='number of worker processes')
+    importing.add_argument('--batch-size', type=int, default=5000,
+                           help='number of files loaded per transaction')
+    importing.add_argument('--checkpoint',
+                           help='checkpoint file (default: '
+                                'DIRECTORY/.import-checkpoint)')
+    importing.add_argument('--restart', action='store_true',
+                           help='ignore the checkpoint of an earlier run')
+    reconciling = commands.add_parser(
+        'reconcile-storage',
+        help='compare stored files with the database, from the checkpoint')
+    reconciling.add_argument('--repair', action='store_true',
+                             help='delete orphan rows and files')
+    reconciling.add_argument('--limit', type=int,
+                             default=RECONCILE_BATCH_SIZE,
+                             help='number of names compared per run')
+    reconciling.add_argument('--all', action='store_true',
+                             help='run until the pass is complete')
+    reconciling.add_argument('--restart', action='store_true',
+                             help='start the pass over')
+
+    args = parser.parse_args()
+    store = metadata_store()
+    if args.command in BULK_COMMANDS and not store.bulk_operations:
+        parser.error(f'{args.command} needs the postgres metadata store, '
+                     f'not METADATA_BACKEND={METADATA_BACKEND}')
+    store.init_tables()
+    try:
+        if args.command == 'reconcile-count':
+            reconcile_count()
+        elif args.command == 'backfill-thumbnails':
+            backfill_thumbnails()
+        elif args.command == 'migrate-layout':
+            migrate_layout(args.layout, args.workers)
+        elif args.command == 'import-images':
+            import_images(args.directory, args.workers, args.batch_size,
+                          args.checkpoint, args.restart)
+        elif args.command == 'reconcile-storage':
+            restart = args.restart
+            while not reconcile(args.repair, args.limit,
+                                restart=restart)['done'] and args.all:
+                restart = False
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,623 @@
+"""
+Metadata Store Module
+
+This module puts the metadata operations of the request handlers, the
+image count, the pages of the listing, the insertion of an upload and the
+deletion of an image, behind one interface with interchangeable
+backends, chosen by the ``METADATA_BACKEND`` setting:
+
+- ``postgres`` runs them through `DBManager` and `AsyncDBManager`;
+- ``sqlite`` keeps the metadata in an embedded SQLite database at
+  ``SQLITE_PATH``, which spares small single-node deployments a database
+  server and every request the network round trip to it.
+
+The SQLite database runs in WAL mode, so readers never wait for the
+writer. Every thread uses a connection of its own, opened on first use,
+whose compiled statements are cached like the prepared statements of the
+Postgres connections. Its tables and indexes, created from
+``init_tables_sqlite.sql``, mirror those of ``init_tables.sql``.
+
+The bulk uploads and deletions, the export, the importer and the storage
+reconciler work on Postgres only. A backend tells whether it offers them
+by ``bulk_operations``; with one that does not, their routes are not
+registered and their ``manage.py`` commands refuse to run, so the
+metadata is never split between two databases.
+
+Key Features:
+- Singleton classes, one per backend.
+- Deduplicated uploads and deletions in one transaction with the blob
+  references and the stored files; other uploads store their file once
+  the row is committed.
+- Notifications of changes for the listing cache: Postgres LISTEN/NOTIFY,
+  or polling of the SQLite ``data_version``.
+- Asynchronous versions of the operations for the asyncio server engine.
+
+Classes:
+----------
+- MetadataStore:
+- PostgresStore:
+- SQLiteStore:
+
+Functions:
+----------
+- metadata_store:
+"""
+import asyncio
+import os
+import sqlite3
+import time
+from abc import abstractmethod
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from threading import local
+from typing import Callable, Iterator, Optional
+
+import psycopg
+from loguru import logger
+
+from DB_Manager import DBManager, AsyncDBManager
+from blobs import ACQUIRE_QUERY, RELEASE_QUERY, DELETE_QUERY, acquire_blob, \
+    release_blob, acquire_blob_async, release_blob_async
+from metrics import DB_QUERY_DURATION
+from settings import METADATA_BACKEND, SQLITE_PATH, PAGE_LIMIT, \
+    DB_POOL_TIMEOUT, DB_PREPARED_MAX
+from singleton import SingletonABCMeta
+
+CHANNEL = 'images_changed'
+POLL_INTERVAL = 0.5
+STORE_ERRORS = (psycopg.Error, sqlite3.Error)
+
+COUNT_QUERY = "SELECT images_count FROM images_stats;"
+PAGE_QUERY = ("SELECT * FROM images ORDER BY upload_time DESC, id DESC"
+              " LIMIT %s OFFSET %s;")
+CURSOR_PAGE_QUERY = ("SELECT * FROM images WHERE (upload_time, id) < (%s, %s)"
+                     " ORDER BY upload_time DESC, id DESC LIMIT %s;")
+INSERT_IMAGE_QUERY = (
+    "INSERT INTO images (filename, original_name, size, file_type, blob_name)"
+    " VALUES (%s, %s, %s, %s, %s);")
+DELETE_IMAGE_QUERY = ("DELETE FROM images WHERE filename = %s"
+                      " RETURNING blob_name;")
+
+
+class MetadataStore(metaclass=SingletonABCMeta):
+    """
+    Interface of the metadata backends.
+
+    A backend must implement every synchronous operation; creating one
+    that misses any raises TypeError. The synchronous operations report a
+    failure of the database by logging it and returning None. Their
+    asynchronous versions run them in a worker thread unless a backend
+    overrides them.
+
+    :cvar bulk_operations: Whether the bulk uploads and deletions, the
+        export, the importer and the storage reconciler, which query
+        Postgres directly, work on the metadata of this backend.
+    :type bulk_operations: bool
+    """
+    bulk_operations = False
+
+    @abstractmethod
+    def init_tables(self) -> None:
+        """
+        Creates the tables and indexes unless they exist.
+
+        :return: None
+        """
+
+    @abstractmethod
+    def count(self) -> Optional[int]:
+        """
+        Returns the number of images.
+
+        :return: The number, or None if the query failed.
+        :rtype: Optional[int]
+        """
+
+    @abstractmethod
+    def list_images(self, after: Optional[tuple[datetime, int]] = None,
+                    offset: int = 0, limit: int = PAGE_LIMIT) \
+            -> Optional[list]:
+        """
+        Returns a page of images, newest first.
+
+        :param after: The ``(upload_time, id)`` pair of the row the page
+                      starts after, from a cursor; None to skip ``offset``
+                      rows instead.
+        :type after: Optional[tuple[datetime, int]]
+        :param offset: Number of rows skipped without a cursor.
+        :type offset: int, optional
+        :param limit: Maximum number of rows.
+        :type limit: int, optional
+        :return: The rows as named tuples, or None if the query failed.
+        :rtype: Optional[list]
+        """
+
+    @abstractmethod
+    def add_image(self, image_id: str, original_name: str, size: int,
+                  ext: str, digest: Optional[str],
+                  store: Callable[[str], str]) \
+            -> Optional[tuple[str, Optional[str]]]:
+        """
+        Records an upload and stores its file.
+
+        Without a digest, the file is moved into place only after the row
+        is committed, so a failed insert never leaves a stored file behind;
+        a crash in between leaves a row without a file, which the storage
+        reconciler repairs. With a digest, the upload is recorded as a
+        reference to the blob of its content, and the file is only stored,
+        before committing, if the blob is new.
+
+        :param image_id: Identifier of the new image.
+        :type image_id: str
+        :param original_name: File name given by the client.
+        :type original_name: str
+        :param size: Size of the file in bytes.
+        :type size: int
+        :param ext: Extension of the file.
+        :type ext: str
+        :param digest: Hex SHA-256 digest of the content, None without
+                       deduplication.
+        :type digest: Optional[str]
+        :param store: Moves the uploaded file into place under the given
+                      name and returns its path.
+        :type store: Callable[[str], str]
+        :return: The stored name of the image and the path of the file, or
+                 None as path if an identical file was stored before; None
+                 if the upload was not recorded.
+        :rtype: Optional[tuple[str, Optional[str]]]
+        """
+
+    @abstractmethod
+    def delete_image(self, full_filename: str,
+                     remove: Callable[[str], bool]) -> Optional[bool]:
+        """
+        Deletes the row of an image and removes its file before
+        committing. The deletion is rolled back if neither a row nor a
+        file was found.
+
+        :param full_filename: File name of the image, with extension.
+        :type full_filename: str
+        :param remove: Removes the file stored under the given name and
+                       tells whether it existed.
+        :type remove: Callable[[str], bool]
+        :return: True if the image was deleted, False if it was not found,
+                 None if the deletion failed.
+        :rtype: Optional[bool]
+        """
+
+    @abstractmethod
+    def changes(self) -> Iterator[None]:
+        """
+        Waits for changes of the ``images`` table made by any process.
+
+        :return: An iterator yielding once when it starts watching, then
+                 once per change.
+        :rtype: Iterator[None]
+        :raises psycopg.Error: If the connection is lost.
+        :raises sqlite3.Error: If the database cannot be read.
+        """
+
+    @abstractmethod
+    def close(self) -> None:
+        """
+        Closes the connections of the calling process; the next operation
+        opens new ones.
+
+        :return: None
+        """
+
+    async def count_async(self) -> Optional[int]:
+        """
+        Asynchronous version of `count`.
+
+        :return: The number, or None if the query failed.
+        :rtype: Optional[int]
+        """
+        return await asyncio.to_thread(self.count)
+
+    async def list_images_async(
+            self, after: Optional[tuple[datetime, int]] = None,
+            offset: int = 0, limit: int = PAGE_LIMIT) -> Optional[list]:
+        """
+        Asynchronous version of `list_images`.
+
+        :param after: The ``(upload_time, id)`` pair of the row the page
+                      starts after.
+        :type after: Optional[tuple[datetime, int]]
+        :param offset: Number of rows skipped without a cursor.
+        :type offset: int, optional
+        :param limit: Maximum number of rows.
+        :type limit: int, optional
+        :return: The rows as named tuples, or None if the query failed.
+        :rtype: Optional[list]
+        """
+        return await asyncio.to_thread(self.list_images, after, offset, limit)
+
+    async def add_image_async(self, image_id: str, original_name: str,
+                              size: int, ext: str, digest: Optional[str],
+                              store: Callable[[str], str]) \
+            -> Optional[tuple[str, Optional[str]]]:
+        """
+        Asynchronous version of `add_image`.
+
+        :param image_id: Identifier of the new image.
+        :type image_id: str
+        :param original_name: File name given by the client.
+        :type original_name: str
+        :param size: Size of the file in bytes.
+        :type size: int
+        :param ext: Extension of the file.
+        :type ext: str
+        :param digest: Hex SHA-256 digest of the content.
+        :type digest: Optional[str]
+        :param store: Moves the uploaded file into place; run in a thread.
+        :type store: Callable[[str], str]
+        :return: The stored name and the path of the file, or None.
+        :rtype: Optional[tuple[str, Optional[str]]]
+        """
+        return await asyncio.to_thread(self.add_image, image_id,
+                                       original_name, size, ext, digest, store)
+
+    async def delete_image_async(self, full_filename: str,
+                                 remove: Callable[[str], bool]) \
+            -> Optional[bool]:
+        """
+        Asynchronous version of `delete_image`.
+
+        :param full_filename: File name of the image, with extension.
+        :type full_filename: str
+        :param remove: Removes the stored file; run in a thread.
+        :type remove: Callable[[str], bool]
+        :return: True if the image was deleted, False if it was not found,
+                 None if the deletion failed.
+        :rtype: Optional[bool]
+        """
+        return await asyncio.to_thread(self.delete_image, full_filename,
+                                       remove)
+
+
+class PostgresStore(MetadataStore):
+    """
+    Metadata backend querying Postgres through `DBManager`, and through
+    `AsyncDBManager` from asyncio code.
+    """
+    bulk_operations = True
+
+    def init_tables(self) -> None:
+        DBManager().init_tables()
+
+    def count(self) -> Optional[int]:
+        rows = DBManager().fetch(COUNT_QUERY)
+        return rows[0].images_count if rows else None
+
+    def list_images(self, after=None, offset=0, limit=PAGE_LIMIT) \
+            -> Optional[list]:
+        if after:
+            return DBManager().fetch(CURSOR_PAGE_QUERY, (*after, limit))
+        return DBManager().fetch(PAGE_QUERY, (limit, offset))
+
+    def add_image(self, image_id, original_name, size, ext, digest,
+                  store) -> Optional[tuple[str, Optional[str]]]:
+        path = None
+        try:
+            with DBManager().connection() as conn:
+                blob_name, created = acquire_blob(conn, digest, size, ext) \
+                    if digest else (None, True)
+                conn.execute(INSERT_IMAGE_QUERY, (image_id, original_name,
+                                                  size, ext, blob_name),
+                             prepare=True)
+                stored_name = blob_name or f'{image_id}{ext}'
+                if digest and created:
+                    path = store(stored_name)
+            if not digest:
+                path = store(stored_name)
+        except (psycopg.Error, OSError) as e:
+            logger.error(f'Upload not stored: {e}')
+            return None
+        return stored_name, path
+
+    def delete_image(self, full_filename, remove) -> Optional[bool]:
+        filename, _ = os.path.splitext(full_filename)
+        try:
+            with DBManager().connection() as conn:
+                row = conn.execute(DELETE_IMAGE_QUERY, (filename,),
+                                   prepare=True).fetchone()
+                blob_name = row.blob_name if row else None
+                if blob_name:
+                    if release_blob(conn, blob_name):
+                        remove(blob_name)
+                    return True
+                found = remove(full_filename)
+                if not found:
+                    conn.rollback()
+                return found
+        except psycopg.Error as e:
+            logger.error(f'Image not deleted: {e}')
+            return None
+
+    def changes(self) -> Iterator[None]:
+        with psycopg.connect(DBManager().conn_str, autocommit=True) as conn:
+            conn.execute(f'LISTEN {CHANNEL};')
+            yield
+            for _ in conn.notifies():
+                yield
+
+    def close(self) -> None:
+        DBManager().close()
+
+    async def count_async(self) -> Optional[int]:
+        rows = await AsyncDBManager().fetch(COUNT_QUERY)
+        return rows[0].images_count if rows else None
+
+    async def list_images_async(self, after=None, offset=0,
+                                limit=PAGE_LIMIT) -> Optional[list]:
+        if after:
+            return await AsyncDBManager().fetch(CURSOR_PAGE_QUERY,
+                                                (*after, limit))
+        return await AsyncDBManager().fetch(PAGE_QUERY, (limit, offset))
+
+    async def add_image_async(self, image_id, original_name, size, ext,
+                              digest, store) \
+            -> Optional[tuple[str, Optional[str]]]:
+        path = None
+        try:
+            async with AsyncDBManager().connection() as conn:
+                blob_name, created = await acquire_blob_async(
+                    conn, digest, size, ext) if digest else (None, True)
+                await conn.execute(INSERT_IMAGE_QUERY, (
+                    image_id, original_name, size, ext, blob_name),
+                    prepare=True)
+                stored_name = blob_name or f'{image_id}{ext}'
+                if digest and created:
+                    path = await asyncio.to_thread(store, stored_name)
+            if not digest:
+                path = await asyncio.to_thread(store, stored_name)
+        except (psycopg.Error, OSError) as e:
+            logger.error(f'Upload not stored: {e}')
+            return None
+        return stored_name, path
+
+    async def delete_image_async(self, full_filename, remove) \
+            -> Optional[bool]:
+        filename, _ = os.path.splitext(full_filename)
+        try:
+            async with AsyncDBManager().connection() as conn:
+                cursor = await conn.execute(DELETE_IMAGE_QUERY, (filename,),
+                                            prepare=True)
+                row = await cursor.fetchone()
+                blob_name = row.blob_name if row else None
+                if blob_name:
+                    if await release_blob_async(conn, blob_name):
+                        await asyncio.to_thread(remove, blob_name)
+                    return True
+                found = await asyncio.to_thread(remove, full_filename)
+                if not found:
+                    await conn.rollback()
+                return found
+        except psycopg.Error as e:
+            logger.error(f'Image not deleted: {e}')
+            return None
+
+
+class SQLiteStore(MetadataStore):
+    """
+    Metadata backend keeping the metadata in an embedded SQLite database.
+
+    Connections are kept per thread and per process, so a pre-forked
+    worker opens its own instead of using one inherited from the parent.
+    Writes take the database lock when their transaction begins and wait
+    at most ``DB_POOL_TIMEOUT`` seconds for it.
+
+    :ivar path: Path of the database file.
+    :type path: str
+    """
+    def __init__(self, path=SQLITE_PATH) -> None:
+        self.path = path
+        self._local = local()
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the calling thread, opening it on first
+        use.
+
+        :return: The connection, in autocommit mode.
+        :rtype: sqlite3.Connection
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=DB_POOL_TIMEOUT,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=DB_PREPARED_MAX)
+        conn.row_factory = namedtuple_row
+        conn.execute('PRAGMA journal_mode = WAL;')
+        conn.execute('PRAGMA synchronous = NORMAL;')
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Runs the statements of a ``with`` block in a write transaction,
+        committed on exit or rolled back if the block raises.
+
+        :return: A context manager yielding the connection.
+        :rtype: Iterator[sqlite3.Connection]
+        :raises sqlite3.Error: If the database stays locked.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE;')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def fetch(self, query: str, params: tuple = ()) -> Optional[list]:
+        """
+        Executes a single statement and returns all the rows it produced.
+
+        :param query: The SQL statement, with ``%s`` placeholders.
+        :type query: str
+        :param params: Values bound to the placeholders.
+        :type params: tuple, optional
+        :return: The rows as named tuples, or None if the query failed.
+        :rtype: Optional[list]
+        """
+        try:
+            started = time.perf_counter()
+            rows = self.connection().execute(qmark(query), params).fetchall()
+            DB_QUERY_DURATION.observe(time.perf_counter() - started, 'fetch')
+            return rows
+        except sqlite3.Error as e:
+            logger.error(f'Database fetch error: {e}')
+
+    def init_tables(self) -> None:
+        try:
+            with open('init_tables_sqlite.sql', 'r') as file:
+                self.connection().executescript(file.read())
+        except sqlite3.Error as e:
+            logger.error(f'tables init error: {e}')
+
+    def count(self) -> Optional[int]:
+        rows = self.fetch(COUNT_QUERY)
+        return rows[0].images_count if rows else None
+
+    def list_images(self, after=None, offset=0, limit=PAGE_LIMIT) \
+            -> Optional[list]:
+        if after:
+            upload_time, image_id = after
+            return self.fetch(CURSOR_PAGE_QUERY, (
+                upload_time.isoformat(' ', 'milliseconds'), image_id, limit))
+        return self.fetch(PAGE_QUERY, (limit, offset))
+
+    def add_image(self, image_id, original_name, size, ext, digest,
+                  store) -> Optional[tuple[str, Optional[str]]]:
+        path = None
+        try:
+            with self.transaction() as conn:
+                blob_name, created = None, True
+                if digest:
+                    (refcount, file_type), = conn.execute(
+                        qmark(ACQUIRE_QUERY), (digest, size, ext)).fetchall()
+                    blob_name, created = f'{digest}{file_type}', refcount == 1
+                conn.execute(qmark(INSERT_IMAGE_QUERY), (
+                    image_id, original_name, size, ext, blob_name))
+                stored_name = blob_name or f'{image_id}{ext}'
+                if digest and created:
+                    path = store(stored_name)
+            if not digest:
+                path = store(stored_name)
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f'Upload not stored: {e}')
+            return None
+        return stored_name, path
+
+    def delete_image(self, full_filename, remove) -> Optional[bool]:
+        filename, _ = os.path.splitext(full_filename)
+        try:
+            with self.transaction() as conn:
+                rows = conn.execute(qmark(DELETE_IMAGE_QUERY),
+                                    (filename,)).fetchall()
+                blob_name = rows[0].blob_name if rows else None
+                if blob_name:
+                    digest, _ = os.path.splitext(blob_name)
+                    rows = conn.execute(qmark(RELEASE_QUERY),
+                                        (digest,)).fetchall()
+                    if not rows or rows[0].refcount <= 0:
+                        conn.execute(qmark(DELETE_QUERY), (digest,))
+                        remove(blob_name)
+                    return True
+                found = remove(full_filename)
+                if not found:
+                    conn.rollback()
+                return found
+        except sqlite3.Error as e:
+            logger.error(f'Image not deleted: {e}')
+            return None
+
+    def changes(self) -> Iterator[None]:
+        conn = self.connection()
+        version = conn.execute('PRAGMA data_version;').fetchone()[0]
+        yield
+        while True:
+            time.sleep(POLL_INTERVAL)
+            current = conn.execute('PRAGMA data_version;').fetchone()[0]
+            if current != version:
+                version = current
+                yield
+
+    def close(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+
+METADATA_STORES = {
+    'postgres': PostgresStore,
+    'sqlite': SQLiteStore,
+}
+
+
+def metadata_store() -> MetadataStore:
+    """
+    Returns the metadata backend selected by ``METADATA_BACKEND``.
+
+    :return: The backend instance.
+    :rtype: MetadataStore
+    """
+    return METADATA_STORES[METADATA_BACKEND]()
+
+
+@lru_cache(maxsize=64)
+def qmark(query: str) -> str:
+    """
+    Converts the ``%s`` placeholders of a Postgres query to the ``?``
+    placeholders of SQLite.
+
+    :param query: The query.
+    :type query: str
+    :return: The query for SQLite.
+    :rtype: str
+    """
+    return query.replace('%s', '?')
+
+
+@lru_cache(maxsize=64)
+def _row_class(fields: tuple) -> type:
+    """
+    Returns the named tuple class of rows with the given columns.
+
+    :param fields: Names of the columns.
+    :type fields: tuple[str]
+    :return: The class.
+    :rtype: type
+    """
+    return namedtuple('Row', fields)
+
+
+def namedtuple_row(cursor: sqlite3.Cursor, row: tuple) -> tuple:
+    """
+    Row factory of the SQLite connections returning rows as named tuples,
+    like the Postgres connections do.
+
+    :param cursor: The cursor the row was read by.
+    :type cursor: sqlite3.Cursor
+    :param row: The values of the row.
+    :type row: tuple
+    :return: The row.
+    :rtype: NamedTuple
+    """
+    return _row_class(tuple(column[0] for column in cursor.description))(*row)
+
+
+sqlite3.register_converter(
+    'TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
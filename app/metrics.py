@@ -0,0 +1,286 @@
+"""
+Metrics Module
+
+This module collects request and database measurements and renders them
+in the Prometheus text exposition format for the ``GET /metrics`` route.
+
+Measurements are recorded without locks: every thread updates a shard of
+its own, and the shards are only summed when the metrics are rendered.
+A thread takes the registry lock once, when it records its first value.
+Every process keeps its own metrics, so with ``SERVER_MODE=prefork`` a
+scrape reports the worker that answered it.
+
+Key Features:
+- Counters, gauges and histograms with labels.
+- Per-thread aggregation, so recording does not contend under the
+  threaded server.
+- Metrics of the HTTP server, the admission control, the request bodies
+  and the database.
+
+Classes:
+----------
+- Metric:
+- Counter:
+- Gauge:
+- Histogram:
+
+Functions:
+----------
+- render:
+"""
+from bisect import bisect_left
+from threading import Lock, local
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+class Metric:
+    """
+    Base class of the metrics, holding one shard of values per thread.
+
+    :ivar name: Name of the metric.
+    :type name: str
+    :ivar documentation: Help text of the metric.
+    :type documentation: str
+    :ivar labelnames: Names of the labels, in the order values are given.
+    :type labelnames: tuple[str]
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = local()
+        self._shards = []
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def _shard(self) -> dict:
+        """
+        Returns the values recorded by the calling thread, keyed by the
+        label values.
+
+        :return: The shard of the calling thread.
+        :rtype: dict
+        """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _collect_shards(self) -> list:
+        """
+        Returns a snapshot of the values of every thread.
+
+        :return: The ``(labels, value)`` pairs of all shards.
+        :rtype: list[tuple]
+        """
+        with self._lock:
+            shards = list(self._shards)
+        return [item for shard in shards for item in list(shard.items())]
+
+    def _labels(self, labelvalues, extra='') -> str:
+        """
+        Formats the label set of a sample.
+
+        :param labelvalues: Values of the labels of the metric.
+        :type labelvalues: tuple
+        :param extra: An additional, already formatted label.
+        :type extra: str, optional
+        :return: The label set in braces, or an empty string.
+        :rtype: str
+        """
+        pairs = [f'{name}="{escape(value)}"'
+                 for name, value in zip(self.labelnames, labelvalues)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> list:
+        """
+        Renders the samples of the metric.
+
+        :return: The lines of the samples.
+        :rtype: list[str]
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """
+        Renders the metric with its HELP and TYPE lines.
+
+        :return: The metric in the text exposition format.
+        :rtype: str
+        """
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """
+    A value that only grows, such as a number of bytes received.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, *labelvalues) -> None:
+        """
+        Increments the counter.
+
+        :param amount: The increment.
+        :type amount: float, optional
+        :param labelvalues: Values of the labels.
+        :return: None
+        """
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    def samples(self) -> list:
+        totals = {}
+        for labelvalues, value in self._collect_shards():
+            totals[labelvalues] = totals.get(labelvalues, 0) + value
+        return [f'{self.name}{self._labels(labelvalues)} {value}'
+                for labelvalues, value in sorted(totals.items())]
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, such as a number of requests in flight.
+    Every thread keeps the sum of its own changes.
+    """
+    kind = 'gauge'
+
+    def dec(self, amount=1, *labelvalues) -> None:
+        """
+        Decrements the gauge.
+
+        :param amount: The decrement.
+        :type amount: float, optional
+        :param labelvalues: Values of the labels.
+        :return: None
+        """
+        self.inc(-amount, *labelvalues)
+
+
+class Histogram(Metric):
+    """
+    Counts observed values, such as durations, in cumulative buckets.
+
+    :ivar buckets: Upper bounds of the buckets, in increasing order.
+    :type buckets: tuple[float]
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues) -> None:
+        """
+        Records an observed value.
+
+        :param value: The observed value.
+        :type value: float
+        :param labelvalues: Values of the labels.
+        :return: None
+        """
+        shard = self._shard()
+        counts = shard.get(labelvalues)
+        if counts is None:
+            # One count per bucket, one for +Inf, then the sum.
+            counts = shard[labelvalues] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> list:
+        totals = {}
+        for labelvalues, counts in self._collect_shards():
+            total = totals.setdefault(labelvalues, [0] * len(counts))
+            for i, count in enumerate(counts):
+                total[i] += count
+
+        lines = []
+        for labelvalues, counts in sorted(totals.items()):
+            cumulative = 0
+            bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = self._labels(labelvalues, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = self._labels(labelvalues)
+            lines.append(f'{self.name}_sum{labels} {counts[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def escape(value) -> str:
+    """
+    Escapes a label value for the text exposition format.
+
+    :param value: The label value.
+    :return: The escaped value.
+    :rtype: str
+    """
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def render() -> str:
+    """
+    Renders every registered metric.
+
+    :return: The metrics in the Prometheus text exposition format.
+    :rtype: str
+    """
+    return ''.join(metric.render() for metric in REGISTRY)
+
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds',
+    'Time spent handling HTTP requests.',
+    ('route', 'method', 'status'))
+REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight',
+    'HTTP requests being handled.')
+ADMISSION_QUEUE_DEPTH = Gauge(
+    'http_admission_queue_depth',
+    'Requests waiting for an admission slot.',
+    ('route_class',))
+ADMISSION_IN_FLIGHT = Gauge(
+    'http_admission_in_flight',
+    'Requests holding an admission slot.',
+    ('route_class',))
+ADMISSION_WAIT = Histogram(
+    'http_admission_wait_seconds',
+    'Time requests over their admission limit spent queued.',
+    ('route_class',))
+ADMISSION_REJECTED = Counter(
+    'http_admission_rejected_total',
+    'Requests answered 503 by the admission control.',
+    ('route_class',))
+UPLOAD_BYTES = Counter(
+    'http_request_body_bytes_total',
+    'Bytes of request bodies received.')
+DB_QUERY_DURATION = Histogram(
+    'db_query_duration_seconds',
+    'Time spent executing database queries.',
+    ('operation',))
+DB_POOL_WAIT = Histogram(
+    'db_pool_wait_seconds',
+    'Time spent waiting for a pooled database connection.')
+DB_POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts_total',
+    'Requests for a pooled database connection that timed out.')
+LISTING_CACHE_REQUESTS = Counter(
+    'listing_cache_requests_total',
+    'Image listing requests answered from the cache or not.',
+    ('result',))
@@ -0,0 +1,200 @@
+"""
+Multipart Module
+
+This module implements a streaming parser of ``multipart/form-data``
+request bodies. The body is fed in chunks as it is received and the
+parser reports the parts as events, so files of any size pass through
+it without being held in memory.
+
+Key Features:
+- Incremental parsing: only a boundary's length of data is held back
+  between chunks.
+- Part headers are limited in size.
+- File names are read from ``Content-Disposition``, including the
+  RFC 2231 ``filename*`` form.
+
+Classes:
+----------
+- MultipartParser:
+
+Functions:
+----------
+- parse_boundary:
+"""
+from email.message import Message
+from typing import Optional
+
+from adv_http_request_handler import RequestBodyError
+
+PART_START = 'start'
+PART_DATA = 'data'
+PART_END = 'end'
+
+MAX_HEADER_SIZE = 16 * 1024
+
+
+def parse_boundary(content_type: str) -> Optional[bytes]:
+    """
+    Extracts the boundary of a ``multipart/form-data`` content type.
+
+    :param content_type: Value of the ``Content-Type`` request header.
+    :type content_type: str
+    :return: The boundary, or None if the body is not multipart form data.
+    :rtype: Optional[bytes]
+    """
+    message = Message()
+    message['Content-Type'] = content_type
+    if message.get_content_type() != 'multipart/form-data':
+        return None
+    boundary = message.get_param('boundary')
+    if not isinstance(boundary, str) or not 0 < len(boundary) <= 70:
+        return None
+    try:
+        return boundary.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+
+
+class MultipartParser:
+    """
+    Splits a ``multipart/form-data`` body into parts.
+
+    `feed` returns the events found in the data received so far:
+    ``(PART_START, (name, filename))`` when the headers of a part are
+    complete, ``(PART_DATA, bytes)`` for pieces of its content and
+    ``(PART_END, None)`` after its last byte.
+
+    :ivar boundary: The boundary separating the parts.
+    :type boundary: bytes
+    :ivar done: Whether the closing boundary has been seen.
+    :type done: bool
+    """
+    _PREAMBLE, _HEADERS, _BODY, _DELIMITER, _DONE = range(5)
+
+    def __init__(self, boundary: bytes) -> None:
+        self.boundary = boundary
+        self._delimiter = b'\r\n--' + boundary
+        self._buffer = bytearray()
+        self._state = self._PREAMBLE
+
+    @property
+    def done(self) -> bool:
+        return self._state == self._DONE
+
+    def feed(self, data: bytes) -> list:
+        """
+        Parses the next chunk of the body.
+
+        :param data: The chunk.
+        :type data: bytes
+        :return: The events completed by the chunk.
+        :rtype: list[tuple[str, object]]
+        :raises RequestBodyError: If the body is not valid multipart data.
+        """
+        if self._state == self._DONE:
+            return []
+        self._buffer += data
+        events = []
+        while self._step(events):
+            pass
+        return events
+
+    def close(self) -> None:
+        """
+        Checks that the body ended with the closing boundary.
+
+        :return: None
+        :raises RequestBodyError: If the body is truncated.
+        """
+        if self._state != self._DONE:
+            raise RequestBodyError('Multipart body is truncated')
+
+    def _step(self, events: list) -> bool:
+        """
+        Parses as much of the buffer as the current state allows.
+
+        :param events: Collects the parsed events.
+        :type events: list
+        :return: True if the state changed and parsing may continue.
+        :rtype: bool
+        """
+        buffer = self._buffer
+        if self._state == self._PREAMBLE:
+            # The first boundary may start the body without a line break.
+            start = bytes(buffer[:len(self._delimiter) - 2]) == \
+                self._delimiter[2:]
+            index = 0 if start else buffer.find(self._delimiter)
+            if index < 0:
+                del buffer[:max(0, len(buffer) - len(self._delimiter))]
+                return False
+            del buffer[:index + (len(self._delimiter) - 2 if start
+                                 else len(self._delimiter))]
+            self._state = self._DELIMITER
+            return True
+
+        if self._state == self._DELIMITER:
+            if len(buffer) < 2:
+                return False
+            if buffer[:2] == b'--':
+                self._state = self._DONE
+                buffer.clear()
+                return False
+            end = buffer.find(b'\r\n')
+            if end < 0:
+                if len(buffer) > MAX_HEADER_SIZE:
+                    raise RequestBodyError('Invalid multipart boundary')
+                return False
+            if buffer[:end].strip(b' \t'):
+                raise RequestBodyError('Invalid multipart boundary')
+            del buffer[:end + 2]
+            self._state = self._HEADERS
+            return True
+
+        if self._state == self._HEADERS:
+            end = buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(buffer) > MAX_HEADER_SIZE:
+                    raise RequestBodyError('Multipart headers are too large')
+                return False
+            events.append((PART_START, self._parse_headers(buffer[:end])))
+            del buffer[:end + 4]
+            self._state = self._BODY
+            return True
+
+        if self._state == self._BODY:
+            index = buffer.find(self._delimiter)
+            if index < 0:
+                keep = len(self._delimiter) - 1
+                if len(buffer) > keep:
+                    events.append((PART_DATA, bytes(buffer[:-keep])))
+                    del buffer[:-keep]
+                return False
+            if index:
+                events.append((PART_DATA, bytes(buffer[:index])))
+            events.append((PART_END, None))
+            del buffer[:index + len(self._delimiter)]
+            self._state = self._DELIMITER
+            return True
+        return False
+
+    @staticmethod
+    def _parse_headers(block: bytes) -> tuple[str, Optional[str]]:
+        """
+        Reads the field name and file name of a part from its headers.
+
+        :param block: The header lines of the part.
+        :type block: bytes
+        :return: The field name and the file name, None for a plain field.
+        :rtype: tuple[str, Optional[str]]
+        """
+        message = Message()
+        for line in block.decode('utf-8', 'replace').split('\r\n'):
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise RequestBodyError('Invalid multipart header')
+            message[name.strip()] = value.strip()
+        if message.get('Content-Disposition') is None:
+            raise RequestBodyError('Multipart part without '
+                                   'Content-Disposition')
+        name = message.get_param('name', '', header='content-disposition')
+        return str(name), message.get_filename()
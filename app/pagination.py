@@ -0,0 +1,51 @@
+"""
+Pagination Module
+
+This module implements the opaque cursors used for keyset pagination of the
+image listing. A cursor holds the ``(upload_time, id)`` pair of the last row
+a client has seen; the next page starts right after that pair, so the query
+walks the ``images_upload_time_id_idx`` index instead of skipping rows
+with ``OFFSET``.
+
+Functions:
+----------
+- encode_cursor:
+- decode_cursor:
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+
+def encode_cursor(upload_time: datetime, image_id: int) -> str:
+    """
+    Encodes the position of a row into an opaque, URL-safe cursor.
+
+    :param upload_time: Upload time of the last row of a page.
+    :type upload_time: datetime
+    :param image_id: ID of the last row of a page.
+    :type image_id: int
+    :return: The cursor pointing right after the given row.
+    :rtype: str
+    """
+    raw = f'{upload_time.isoformat()}|{image_id}'.encode('utf-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Decodes a cursor produced by ``encode_cursor``.
+
+    :param cursor: The cursor sent by the client.
+    :type cursor: str
+    :return: The upload time and ID of the row the cursor points after.
+    :rtype: tuple[datetime, int]
+    :raises ValueError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        upload_time, image_id = raw.split('|')
+        return datetime.fromisoformat(upload_time), int(image_id)
+    except (Base64Error, UnicodeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
@@ -0,0 +1,302 @@
+"""
+Storage Reconciler Module
+
+This module finds the mismatches between the files stored in IMAGES_PATH
+and the rows of the ``images`` and ``blobs`` tables. An upload inserts
+the row before writing the file and a deletion removes the file before
+the row, so a crash between the two leaves a row without a file or a
+file without a row.
+
+Both sides are read as streams sorted by stored file name and compared by
+a merge, so neither is loaded into memory: the database through a
+server-side cursor over an index in the "C" collation, the disk by a walk
+of the shard directories in name order. Only the files stored directly in
+IMAGES_PATH, as in the flat layout, are read with one scan of the
+directory per run, keeping just the names the run compares.
+
+A run compares at most ``RECONCILE_BATCH_SIZE`` names, at most
+``RECONCILE_RATE`` per second, and records the last one in a checkpoint
+file; the next run continues after it and the run reaching the end starts
+the next pass over. Scheduled regularly, the reconciler thus covers a
+store of any size without I/O spikes.
+
+Mismatches are reported, and repaired on request once they are older than
+``RECONCILE_GRACE`` seconds, so uploads and deletions in progress are
+left alone:
+
+- rows of images without a file are deleted;
+- files without a row are removed with their thumbnail;
+- blobs without a file are only reported, as their images cannot be
+  recovered.
+
+Functions:
+----------
+- iter_disk:
+- iter_rows:
+- reconcile:
+"""
+import heapq
+import itertools
+import os
+import time
+from collections import Counter
+from contextlib import closing
+from typing import Iterator
+
+from loguru import logger
+
+from DB_Manager import DBManager
+from bulk_delete import remove_image
+from settings import IMAGES_PATH, ALLOWED_EXTENSIONS, RECONCILE_BATCH_SIZE, \
+    RECONCILE_RATE, RECONCILE_GRACE
+from storage import SHARD_DIR, locate_image, read_checkpoint, \
+    write_checkpoint
+from thumbnails import THUMBNAIL_SUFFIX
+
+CHECKPOINT_FILE = '.reconcile-checkpoint'
+
+ROWS_QUERY = (
+    "SELECT name, id, kind FROM ("
+    "(SELECT (filename || COALESCE(file_type, '')) COLLATE \"C\" AS name,"
+    " id, 'image' AS kind FROM images WHERE blob_name IS NULL"
+    " AND (filename || COALESCE(file_type, '')) COLLATE \"C\" > %(after)s"
+    " ORDER BY 1 LIMIT %(limit)s)"
+    " UNION ALL "
+    "(SELECT (hash || file_type) COLLATE \"C\", NULL, 'blob' FROM blobs"
+    " WHERE (hash || file_type) COLLATE \"C\" > %(after)s"
+    " ORDER BY 1 LIMIT %(limit)s)) AS stored"
+    " ORDER BY name LIMIT %(limit)s;")
+IMAGE_EXISTS_QUERY = (
+    "SELECT 1 FROM images WHERE filename = %s AND file_type = %s"
+    " UNION ALL SELECT 1 FROM blobs WHERE hash || file_type = %s;")
+DELETE_ORPHANS_QUERY = (
+    "DELETE FROM images WHERE id = ANY(%s) AND blob_name IS NULL"
+    " AND upload_time < LOCALTIMESTAMP - make_interval(secs => %s);")
+
+
+def stored_name(name: str) -> bool:
+    """
+    Checks whether a file name is one of a stored image, rather than of a
+    thumbnail or a file being written.
+
+    :param name: The file name.
+    :type name: str
+    :return: True if the file is a stored image.
+    :rtype: bool
+    """
+    stem, ext = os.path.splitext(name)
+    return not name.startswith('.') and ext in ALLOWED_EXTENSIONS \
+        and not stem.endswith(THUMBNAIL_SUFFIX)
+
+
+def iter_disk(after: str, limit: int,
+              root: str = IMAGES_PATH) -> Iterator[tuple[str, str]]:
+    """
+    Iterates over the stored files in name order, starting after a name.
+
+    Files stored in both layouts during a migration are yielded once.
+
+    :param after: Name of the last file already compared.
+    :type after: str
+    :param limit: Number of files needed; more may be yielded.
+    :type limit: int
+    :param root: The images directory.
+    :type root: str, optional
+    :return: An iterator over the file names and paths.
+    :rtype: Iterator[tuple[str, str]]
+    """
+    flat = []
+    shards = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_file() and stored_name(entry.name) \
+                    and entry.name > after:
+                flat.append((entry.name, entry.path))
+                if len(flat) > 2 * limit:
+                    flat = heapq.nsmallest(limit, flat)
+            elif SHARD_DIR.fullmatch(entry.name) and entry.is_dir() \
+                    and entry.name >= after[:2]:
+                shards.append(entry.name)
+    flat = heapq.nsmallest(limit, flat)
+
+    files = heapq.merge(flat, _iter_shards(root, sorted(shards), after))
+    for name, group in itertools.groupby(files, key=lambda file: file[0]):
+        yield next(group)
+
+
+def _iter_shards(root: str, shards: list,
+                 after: str) -> Iterator[tuple[str, str]]:
+    """
+    Iterates over the files of the sharded layout in name order.
+
+    :param root: The images directory.
+    :type root: str
+    :param shards: Sorted names of the first level shard directories.
+    :type shards: list[str]
+    :param after: Name of the last file already compared.
+    :type after: str
+    :return: An iterator over the file names and paths.
+    :rtype: Iterator[tuple[str, str]]
+    """
+    for shard in shards:
+        with os.scandir(os.path.join(root, shard)) as entries:
+            subshards = sorted(
+                entry.name for entry in entries
+                if SHARD_DIR.fullmatch(entry.name) and entry.is_dir()
+                and shard + entry.name >= after[:4])
+        for subshard in subshards:
+            path = os.path.join(root, shard, subshard)
+            with os.scandir(path) as entries:
+                files = sorted((entry.name, entry.path) for entry in entries
+                               if entry.name > after and entry.is_file()
+                               and stored_name(entry.name))
+            yield from files
+
+
+def iter_rows(after: str, limit: int) -> Iterator:
+    """
+    Iterates over the stored file names of the database in name order,
+    starting after a name.
+
+    :param after: Name of the last file already compared.
+    :type after: str
+    :param limit: Maximum number of rows.
+    :type limit: int
+    :return: An iterator over rows of ``name``, ``id`` and ``kind``,
+             ``image`` or ``blob``.
+    :rtype: Iterator[NamedTuple]
+    """
+    batches = DBManager().stream(ROWS_QUERY, {'after': after, 'limit': limit})
+    with closing(batches):
+        for batch in batches:
+            yield from batch
+
+
+def merge(files: Iterator, rows: Iterator) -> Iterator[tuple]:
+    """
+    Pairs the stored files with the rows of the same name.
+
+    :param files: Stored files, as returned by `iter_disk`.
+    :type files: Iterator[tuple[str, str]]
+    :param rows: Rows, as returned by `iter_rows`.
+    :type rows: Iterator[NamedTuple]
+    :return: An iterator over pairs of a file and a row, either being None
+             if the other has no counterpart.
+    :rtype: Iterator[tuple]
+    """
+    file, row = next(files, None), next(rows, None)
+    while file is not None or row is not None:
+        if row is None or file is not None and file[0] < row.name:
+            yield file, None
+            file = next(files, None)
+        elif file is None or row.name < file[0]:
+            yield None, row
+            row = next(rows, None)
+        else:
+            yield file, row
+            file, row = next(files, None), next(rows, None)
+
+
+def reconcile(repair: bool = False, limit: int = RECONCILE_BATCH_SIZE,
+              checkpoint: str = None, restart: bool = False) -> Counter:
+    """
+    Compares the next ``limit`` stored file names of the disk and the
+    database, continuing after the checkpoint of the previous run.
+
+    :param repair: Whether to repair the mismatches found.
+    :type repair: bool, optional
+    :param limit: Maximum number of names compared.
+    :type limit: int, optional
+    :param checkpoint: Path of the checkpoint file; by default
+                       ``.reconcile-checkpoint`` in IMAGES_PATH.
+    :type checkpoint: str, optional
+    :param restart: Whether to start over from the first name.
+    :type restart: bool, optional
+    :return: Numbers of names ``checked``, of ``orphan_rows``,
+             ``orphan_files`` and ``missing_blobs`` found, of
+             ``rows_deleted`` and ``files_removed``, and ``done``, 1 when
+             the run reached the last name.
+    :rtype: collections.Counter
+    """
+    checkpoint = checkpoint or os.path.join(IMAGES_PATH, CHECKPOINT_FILE)
+    after = '' if restart else read_checkpoint(checkpoint).get('last') or ''
+    results = Counter()
+    orphan_rows = []
+    started = time.monotonic()
+    last = None
+
+    # One name more than compared tells whether the pass is complete.
+    pairs = merge(iter_disk(after, limit + 1), iter_rows(after, limit + 1))
+    with closing(pairs):
+        for file, row in itertools.islice(pairs, limit):
+            last = (file or row)[0]
+            results['checked'] += 1
+            if file is None and locate_image(row.name) is None:
+                if row.kind == 'blob':
+                    logger.error(f'Blob without a file: {row.name}')
+                    results['missing_blobs'] += 1
+                else:
+                    logger.warning(f'Image row without a file: {row.name}')
+                    results['orphan_rows'] += 1
+                    orphan_rows.append(row.id)
+            elif row is None and not registered(file[0]):
+                logger.warning(f'File without a row: {file[0]}')
+                results['orphan_files'] += 1
+                if repair and remove_orphan_file(*file):
+                    results['files_removed'] += 1
+            if RECONCILE_RATE:
+                delay = results['checked'] / RECONCILE_RATE - \
+                    (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        done = next(pairs, None) is None
+
+    if repair and orphan_rows:
+        with DBManager().connection() as conn:
+            results['rows_deleted'] = conn.execute(
+                DELETE_ORPHANS_QUERY, (orphan_rows, RECONCILE_GRACE),
+                prepare=True).rowcount
+    if done:
+        results['done'] = 1
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+    else:
+        write_checkpoint(checkpoint, {'last': last})
+    logger.info(f'Reconciled {results["checked"]} names after '
+                f'{after or "the start"}: {dict(results)} in '
+                f'{time.monotonic() - started:.1f}s')
+    return results
+
+
+def registered(name: str) -> bool:
+    """
+    Checks once more whether a file has a row, which may have been
+    committed since the rows were read.
+
+    :param name: File name of the image, with extension.
+    :type name: str
+    :return: True if an image or a blob is stored under the name.
+    :rtype: bool
+    """
+    stem, ext = os.path.splitext(name)
+    return bool(DBManager().fetch(IMAGE_EXISTS_QUERY, (stem, ext, name)))
+
+
+def remove_orphan_file(name: str, path: str) -> bool:
+    """
+    Removes a file without a row, unless it was modified within
+    ``RECONCILE_GRACE`` seconds.
+
+    :param name: File name of the image, with extension.
+    :type name: str
+    :param path: Path of the file.
+    :type path: str
+    :return: True if the file was removed.
+    :rtype: bool
+    """
+    try:
+        if os.stat(path).st_mtime > time.time() - RECONCILE_GRACE:
+            return False
+    except FileNotFoundError:
+        return False
+    return remove_image(name)
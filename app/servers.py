@@ -0,0 +1,443 @@
+"""
+Server Classes Module
+
+This module implements the HTTP server classes that ``app.run()`` chooses
+from according to ``SERVER_MODE``.
+
+Key Features:
+- Bounded thread pool server, so a slow upload does not block other clients.
+- Idle keep-alive connections wait in a selector instead of holding a pool
+  thread, so they never keep new connections from being accepted.
+- Pre-fork server running worker processes that share the listening port
+  through ``SO_REUSEPORT``.
+- Every worker opens its own database pool and thumbnail pool and shuts
+  down cleanly on SIGTERM or SIGINT.
+- The asyncio server of the ``async_server`` module is registered as the
+  ``asyncio`` mode.
+
+Classes:
+----------
+- IdleConnections:
+- ThreadPoolHTTPServer:
+- ReusePortHTTPServer:
+- PreforkHTTPServer:
+"""
+import os
+import selectors
+import signal
+import socket
+import time
+from collections import OrderedDict, deque
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+from threading import BoundedSemaphore, Lock, Thread
+
+from loguru import logger
+
+from async_server import AsyncHTTPServer
+from metadata_store import metadata_store
+from settings import SERVER_THREADS, SERVER_WORKERS, KEEPALIVE_TIMEOUT, \
+    KEEPALIVE_MAX_IDLE
+from thumbnails import ThumbnailQueue
+
+
+class IdleConnections:
+    """
+    Watches the idle keep-alive connections of a ``ThreadPoolHTTPServer``
+    from a single thread.
+
+    A parked connection is handed back to the server as soon as its next
+    request arrives and a pool thread is free; until then it waits in a
+    queue, so the watching thread never blocks. It is closed once it has
+    been idle for ``timeout`` seconds, or, oldest first, when more than
+    ``max_idle`` connections are parked.
+
+    :ivar server: The server the connections are handed back to.
+    :type server: ThreadPoolHTTPServer
+    :ivar timeout: Seconds a connection may stay idle.
+    :type timeout: float
+    :ivar max_idle: Maximum number of parked connections.
+    :type max_idle: int
+    """
+    def __init__(self, server, timeout=KEEPALIVE_TIMEOUT,
+                 max_idle=KEEPALIVE_MAX_IDLE) -> None:
+        self.server = server
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._selector = selectors.DefaultSelector()
+        self._parked = OrderedDict()
+        self._ready = deque()
+        self._incoming = []
+        self._lock = Lock()
+        self._closed = False
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._thread = Thread(target=self._run, name='http-idle',
+                              daemon=True)
+        self._thread.start()
+
+    def park(self, request, client_address) -> None:
+        """
+        Hands over a connection waiting for its next request.
+
+        :param request: The client socket.
+        :param client_address: The address of the client.
+        :return: None
+        """
+        with self._lock:
+            if self._closed:
+                self.server.shutdown_request(request)
+                return
+            self._incoming.append((request, client_address))
+        self.wake()
+
+    def wake(self) -> None:
+        """
+        Wakes the watching thread.
+
+        :return: None
+        """
+        with suppress(OSError):
+            self._waker.send(b'\0')
+
+    def thread_freed(self) -> None:
+        """
+        Tells the watching thread that a pool thread has become free, if
+        connections are queued for one.
+
+        :return: None
+        """
+        if self._ready:
+            self.wake()
+
+    def close(self) -> None:
+        """
+        Stops watching and closes every parked connection.
+
+        :return: None
+        """
+        with self._lock:
+            self._closed = True
+        self.wake()
+        self._thread.join()
+        for request in list(self._parked):
+            self._drop(request)
+        for request, _ in self._ready:
+            self.server.shutdown_request(request)
+        for request, _ in self._incoming:
+            self.server.shutdown_request(request)
+        self._selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+    def _run(self) -> None:
+        """
+        Hands back connections whose next request arrived and closes those
+        idle for too long, until closed.
+
+        :return: None
+        """
+        while not self._closed:
+            timeout = None
+            if self._parked:
+                deadline = next(iter(self._parked.values()))[0]
+                timeout = max(0.0, deadline - time.monotonic())
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj is self._wakeup:
+                    self._accept_incoming()
+                    continue
+                request = key.fileobj
+                self._selector.unregister(request)
+                _, client_address = self._parked.pop(request)
+                self._ready.append((request, client_address))
+            self._hand_back()
+
+            now = time.monotonic()
+            while self._parked and \
+                    next(iter(self._parked.values()))[0] <= now:
+                self._drop(next(iter(self._parked)))
+
+    def _hand_back(self) -> None:
+        """
+        Hands the queued connections back to the server while it has free
+        pool threads.
+
+        :return: None
+        """
+        while self._ready:
+            request, client_address = self._ready[0]
+            if not self.server.try_process_request(request, client_address):
+                return
+            self._ready.popleft()
+
+    def _accept_incoming(self) -> None:
+        """
+        Starts watching the connections handed over by `park`.
+
+        :return: None
+        """
+        with suppress(BlockingIOError):
+            while self._wakeup.recv(4096):
+                pass
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+        deadline = time.monotonic() + self.timeout
+        for request, client_address in incoming:
+            try:
+                self._selector.register(request, selectors.EVENT_READ)
+            except (OSError, ValueError):
+                self.server.shutdown_request(request)
+                continue
+            self._parked[request] = (deadline, client_address)
+        while len(self._parked) > self.max_idle:
+            self._drop(next(iter(self._parked)))
+
+    def _drop(self, request) -> None:
+        """
+        Closes a parked connection.
+
+        :param request: The client socket.
+        :return: None
+        """
+        self._selector.unregister(request)
+        del self._parked[request]
+        self.server.shutdown_request(request)
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    HTTP server handling every connection on a fixed-size pool of threads.
+
+    When all threads are busy the server stops accepting, so excess
+    connections wait in the kernel backlog instead of piling up in memory.
+    A thread is only held while a request is handled: a keep-alive
+    connection whose next request has not arrived is parked in
+    `IdleConnections` and handed back to the pool when it does.
+
+    :ivar threads: Number of threads handling requests.
+    :type threads: int
+    :ivar idle: The parked keep-alive connections.
+    :type idle: IdleConnections
+    """
+    def __init__(self, server_address, handler_class, threads=SERVER_THREADS,
+                 bind_and_activate=True) -> None:
+        self.threads = threads
+        self._slots = BoundedSemaphore(threads)
+        self._executor = ThreadPoolExecutor(max_workers=threads,
+                                            thread_name_prefix='http')
+        self.idle = IdleConnections(self)
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def process_request(self, request, client_address) -> None:
+        """
+        Hands the accepted connection over to the thread pool, waiting for
+        a free thread first.
+
+        :param request: The accepted client socket.
+        :param client_address: The address of the client.
+        :return: None
+        """
+        self._slots.acquire()
+        self._submit(request, client_address)
+
+    def try_process_request(self, request, client_address) -> bool:
+        """
+        Hands a connection over to the thread pool if a thread is free.
+
+        :param request: The client socket.
+        :param client_address: The address of the client.
+        :return: False if every thread is busy and the connection was kept.
+        :rtype: bool
+        """
+        if not self._slots.acquire(blocking=False):
+            return False
+        self._submit(request, client_address)
+        return True
+
+    def _submit(self, request, client_address) -> None:
+        """
+        Runs a connection on the thread pool once a thread slot is taken.
+
+        :param request: The client socket.
+        :param client_address: The address of the client.
+        :return: None
+        """
+        try:
+            self._executor.submit(self.process_request_thread,
+                                  request, client_address)
+        except RuntimeError:
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address) -> None:
+        """
+        Handles a connection inside a pool thread until it is closed or
+        waits idle for its next request, in which case it is parked.
+
+        :param request: The accepted client socket.
+        :param client_address: The address of the client.
+        :return: None
+        """
+        parked = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            parked = getattr(handler, 'parked', False)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if parked:
+                self.idle.park(request, client_address)
+            else:
+                self.shutdown_request(request)
+            self._slots.release()
+            self.idle.thread_freed()
+
+    def server_close(self) -> None:
+        """
+        Closes the listening socket, waits for in-flight requests and
+        closes the idle connections.
+
+        :return: None
+        """
+        super().server_close()
+        self._executor.shutdown(wait=True)
+        self.idle.close()
+
+
+class ReusePortHTTPServer(ThreadPoolHTTPServer):
+    """
+    Thread pool server whose socket may be bound by several processes,
+    letting the kernel balance connections between them.
+    """
+    allow_reuse_port = True
+
+
+class PreforkHTTPServer:
+    """
+    Supervises worker processes that each run a ``ReusePortHTTPServer``.
+
+    Workers are forked after the database pool of the parent is closed,
+    so every worker opens a pool of its own. A worker that dies is
+    replaced; SIGTERM or SIGINT stops all of them.
+
+    :ivar server_address: The address the workers listen on.
+    :type server_address: tuple
+    :ivar handler_class: The request handler class used by the workers.
+    :type handler_class: type
+    :ivar workers: Number of worker processes.
+    :type workers: int
+    :ivar pids: Process IDs of the running workers.
+    :type pids: set
+    """
+    respawn_delay = 1.0
+
+    def __init__(self, server_address, handler_class, workers=SERVER_WORKERS,
+                 server_class=ReusePortHTTPServer) -> None:
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.workers = workers
+        self.server_class = server_class
+        self.pids = set()
+        self._stopping = False
+
+    def serve_forever(self) -> None:
+        """
+        Starts the workers and restarts any that exit until stopped.
+
+        :return: None
+        """
+        metadata_store().close()
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        for _ in range(self.workers):
+            self.spawn()
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self.pids.discard(pid)
+            if self._stopping:
+                continue
+            logger.warning(f'Worker {pid} exited with status {status}, '
+                           f'restarting')
+            time.sleep(self.respawn_delay)
+            self.spawn()
+
+    def spawn(self) -> None:
+        """
+        Forks a new worker process.
+
+        :return: None
+        """
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return
+
+        status = 0
+        try:
+            self.run_worker()
+        except BaseException:
+            logger.exception('Worker crashed')
+            status = 1
+        finally:
+            os._exit(status)
+
+    def run_worker(self) -> None:
+        """
+        Serves requests in a worker process until SIGTERM or SIGINT.
+
+        :return: None
+        """
+        httpd = self.server_class(self.server_address, self.handler_class)
+
+        def shutdown(*_):
+            Thread(target=httpd.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        logger.info(f'Worker {os.getpid()} started')
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+            ThumbnailQueue().shutdown()
+            metadata_store().close()
+            logger.info(f'Worker {os.getpid()} stopped')
+
+    def stop(self) -> None:
+        """
+        Asks every worker to finish its in-flight requests and exit.
+
+        :return: None
+        """
+        self._stopping = True
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.pids.discard(pid)
+
+    def server_close(self) -> None:
+        """
+        Stops the workers and waits for them to exit.
+
+        :return: None
+        """
+        self.stop()
+        while self.pids:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            self.pids.discard(pid)
+
+
+SERVER_CLASSES = {
+    'single': HTTPServer,
+    'threaded': ThreadPoolHTTPServer,
+    'prefork': PreforkHTTPServer,
+    'asyncio': AsyncHTTPServer,
+}
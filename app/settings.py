@@ -6,12 +6,86 @@ listen on, the paths to the static files and uploaded images, and the
 maximum allowed file size.
 
 Attributes:
-    SERVER_ADDRESS (tuple): The address to listen on.
+    SERVER_ADDRESS (tuple): The address to listen on; the port is set by
+        ``SERVER_PORT``, 8000 by default.
+    SERVER_MODE (str): Concurrency mode of ``app.run()``: ``single``,
+        ``threaded`` (the default), ``prefork`` or ``asyncio``.
+    SERVER_THREADS (int): Size of the request thread pool of the threaded
+        server and of every pre-forked worker.
+    SERVER_WORKERS (int): Number of pre-forked worker processes.
+    KEEPALIVE_TIMEOUT (float): Seconds an idle persistent connection is
+        kept open.
+    KEEPALIVE_MAX_IDLE (int): Idle persistent connections kept open by the
+        threaded servers, in addition to those being served; the oldest
+        are closed beyond it.
+    ROUTER_ENGINE (str): Path matching engine of the router: ``trie`` or
+        ``regex``.
     STATIC_PATH (str): The path to the static files.
+    STATIC_CACHE_RELOAD_INTERVAL (float): Seconds between checks whether a
+        cached static file changed on disk; 0 disables reloading.
     IMAGES_PATH (str): The path to the uploaded images.
+    IMAGES_LAYOUT (str): Directory layout of IMAGES_PATH: ``flat``, or
+        ``sharded`` into ``ab/cd/`` subdirectories by file name prefix.
+    DEDUP_ENABLED (bool): Whether uploads with identical content share one
+        stored file, named after the SHA-256 digest of the content.
     ALLOWED_EXTENSIONS (list): The list of allowed file extensions.
     MAX_FILE_SIZE (int): The maximum allowed file size in bytes.
+    UPLOAD_CHUNK_SIZE (int): Size of the chunks uploads are streamed in.
+    MAX_BULK_UPLOAD_FILES (int): Maximum number of files in a bulk upload.
+    MAX_BULK_UPLOAD_SIZE (int): Maximum size of a bulk upload body in bytes.
+    BULK_DELETE_BATCH_SIZE (int): Images deleted per transaction by a bulk
+        delete.
+    BULK_DELETE_WORKERS (int): Threads unlinking the files of a bulk delete.
+    EXPORT_BATCH_SIZE (int): Rows fetched at a time by the metadata export.
+    LISTING_CACHE_SIZE (int): Image listing responses cached per process;
+        0 disables the cache.
+    LISTING_CACHE_TTL (float): Seconds a listing response is cached for.
+    RECONCILE_BATCH_SIZE (int): Stored file names compared by one run of
+        the storage reconciler.
+    RECONCILE_RATE (float): Names the reconciler compares per second; 0
+        disables throttling.
+    RECONCILE_GRACE (float): Seconds a mismatch must be old before the
+        reconciler repairs it.
+    ADMISSION_UPLOADS (int): Uploads handled at once per process, a
+        quarter of SERVER_THREADS by default; 0 lifts the limit.
+    ADMISSION_LISTINGS (int): Listings, counts and exports handled at once
+        per process, half of SERVER_THREADS by default; 0 lifts the limit.
+    ADMISSION_DELETES (int): Deletions handled at once per process, a
+        quarter of SERVER_THREADS by default; 0 lifts the limit.
+    ADMISSION_QUEUE_SIZE (int): Requests of a route class waiting for a
+        slot per process, a quarter of SERVER_THREADS by default; more are
+        answered 503 at once. Waiting requests hold a thread of the
+        threaded servers, so a limit plus the queue size should stay below
+        SERVER_THREADS.
+    ADMISSION_QUEUE_TIMEOUT (float): Seconds a request over its limit waits
+        for a slot before it is answered 503.
+    ADMISSION_RETRY_AFTER (int): Seconds sent in ``Retry-After`` with a
+        503 of the admission control.
+    THUMBNAIL_SIZE (int): Maximum width and height of thumbnails in pixels.
+    THUMBNAIL_WORKERS (int): Number of thumbnail worker processes.
+    THUMBNAIL_QUEUE_SIZE (int): Maximum number of queued thumbnail jobs.
     LOG_PATH (str): The path to the log files.
+    LOG_LEVEL (str): Minimum level of the logged lines.
+    LOG_MODE (str): ``sync`` to write log lines as they are logged, or
+        ``async`` to write them from a background thread in batches.
+    LOG_FORMAT (str): Format of the log file: ``text`` or ``json``.
+    LOG_BATCH_SIZE (int): Lines written at once in the ``async`` mode.
+    LOG_FLUSH_INTERVAL (float): Maximum seconds a line waits to be written
+        in the ``async`` mode.
+    LOG_SAMPLE_RATE (float): Fraction of the access lines of successful
+        requests that is logged.
+    LOG_SAMPLE_ROUTES (str): Sample rates of single routes, given as
+        ``handler_name=rate`` pairs separated by commas.
+    DB_POOL_ENABLED (bool): Whether DBManager shares a connection pool.
+    DB_POOL_MIN_SIZE (int): Connections kept open by the pool.
+    DB_POOL_MAX_SIZE (int): Upper bound of pooled connections.
+    DB_POOL_TIMEOUT (float): Seconds to wait for a pooled connection.
+    DB_POOL_MAX_IDLE (float): Seconds before an idle connection is closed.
+    DB_POOL_CHECK (bool): Whether to health-check connections on checkout.
+    DB_PREPARED_MAX (int): Prepared statements kept per connection.
+    METADATA_BACKEND (str): Store of the image metadata used by the
+        handlers: ``postgres``, or ``sqlite`` for an embedded database.
+    SQLITE_PATH (str): The path to the SQLite database file.
 """
 
 import os
@@ -19,13 +93,56 @@ import os
 import dotenv
 
 dotenv.load_dotenv('.env')
-SERVER_ADDRESS = ('0.0.0.0', 8000)
+SERVER_ADDRESS = ('0.0.0.0', int(os.getenv('SERVER_PORT') or 8000))
+SERVER_MODE = os.getenv('SERVER_MODE') or 'threaded'
+SERVER_THREADS = int(os.getenv('SERVER_THREADS') or 16)
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS') or os.cpu_count() or 1)
+KEEPALIVE_TIMEOUT = float(os.getenv('KEEPALIVE_TIMEOUT') or 15)
+KEEPALIVE_MAX_IDLE = int(os.getenv('KEEPALIVE_MAX_IDLE') or 1024)
+ROUTER_ENGINE = os.getenv('ROUTER_ENGINE') or 'trie'
 STATIC_PATH = 'static/'
+STATIC_CACHE_RELOAD_INTERVAL = float(
+    os.getenv('STATIC_CACHE_RELOAD_INTERVAL') or 5)
 IMAGES_PATH = 'images/'
+IMAGES_LAYOUT = os.getenv('IMAGES_LAYOUT') or 'flat'
+DEDUP_ENABLED = (os.getenv('DEDUP_ENABLED') or 'false').lower() == 'true'
 ALLOWED_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif']
 MAX_FILE_SIZE = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_BULK_UPLOAD_FILES = int(os.getenv('MAX_BULK_UPLOAD_FILES') or 1000)
+MAX_BULK_UPLOAD_SIZE = int(os.getenv('MAX_BULK_UPLOAD_SIZE')
+                           or 512 * 1024 * 1024)
+BULK_DELETE_BATCH_SIZE = int(os.getenv('BULK_DELETE_BATCH_SIZE') or 1000)
+BULK_DELETE_WORKERS = int(os.getenv('BULK_DELETE_WORKERS') or 8)
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE') or 1000)
+LISTING_CACHE_SIZE = int(os.getenv('LISTING_CACHE_SIZE') or 256)
+LISTING_CACHE_TTL = float(os.getenv('LISTING_CACHE_TTL') or 30)
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE') or 100000)
+RECONCILE_RATE = float(os.getenv('RECONCILE_RATE') or 1000)
+RECONCILE_GRACE = float(os.getenv('RECONCILE_GRACE') or 3600)
+ADMISSION_UPLOADS = int(os.getenv('ADMISSION_UPLOADS')
+                        or max(1, SERVER_THREADS // 4))
+ADMISSION_LISTINGS = int(os.getenv('ADMISSION_LISTINGS')
+                         or max(1, SERVER_THREADS // 2))
+ADMISSION_DELETES = int(os.getenv('ADMISSION_DELETES')
+                        or max(1, SERVER_THREADS // 4))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE')
+                           or max(1, SERVER_THREADS // 4))
+ADMISSION_QUEUE_TIMEOUT = float(
+    os.getenv('ADMISSION_QUEUE_TIMEOUT') or 1)
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER') or 1)
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE') or 128)
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS') or 2)
+THUMBNAIL_QUEUE_SIZE = int(os.getenv('THUMBNAIL_QUEUE_SIZE') or 100)
 LOG_PATH = 'logs/'
 LOG_FILE = 'app.log'
+LOG_LEVEL = os.getenv('LOG_LEVEL') or 'INFO'
+LOG_MODE = os.getenv('LOG_MODE') or 'sync'
+LOG_FORMAT = os.getenv('LOG_FORMAT') or 'text'
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE') or 256)
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL') or 1)
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE') or 1)
+LOG_SAMPLE_ROUTES = os.getenv('LOG_SAMPLE_ROUTES') or ''
 PAGE_LIMIT = 10
 ERROR_FILE = 'upload_failed.html'
 
@@ -33,4 +150,15 @@ DB_NAME = os.getenv('DB_NAME') or 'postgres'
 DB_USER = os.getenv('DB_USER') or 'postgres'
 DB_PASSWORD = os.getenv('DB_PASSWORD') or 'postgres'
 DB_HOST = os.getenv('DB_HOST') or 'db'
-DB_PORT = os.getenv('DB_PORT') or '5432'
\ No newline at end of file
+DB_PORT = os.getenv('DB_PORT') or '5432'
+
+DB_POOL_ENABLED = (os.getenv('DB_POOL_ENABLED') or 'true').lower() == 'true'
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE') or 1)
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE') or 10)
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT') or 5)
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE') or 600)
+DB_POOL_CHECK = (os.getenv('DB_POOL_CHECK') or 'true').lower() == 'true'
+DB_PREPARED_MAX = int(os.getenv('DB_PREPARED_MAX') or 100)
+
+METADATA_BACKEND = os.getenv('METADATA_BACKEND') or 'postgres'
+SQLITE_PATH = os.getenv('SQLITE_PATH') or 'db/images.sqlite3'
@@ -1,6 +1,10 @@
 """
-Provides a Singleton metaclass to implement the Singleton design pattern.
+Provides a Singleton metaclass to implement the Singleton design pattern,
+and its variant for abstract base classes.
 """
+from abc import ABCMeta
+from threading import RLock
+
 
 class SingletonMeta(type):
     """
@@ -13,18 +17,35 @@ class SingletonMeta(type):
     it returns the existing instance. Otherwise, it creates a new instance
     and stores it in an internal dictionary.
 
+    Instance creation is guarded by a lock, so concurrent request handlers
+    racing on the first call still share a single instance.
+
     :cvar _instances: Dictionary holding references to the single instances of
         each class using this metaclass.
     :type _instances: dict
+    :cvar _lock: Lock serializing the creation of new instances.
+    :type _lock: threading.RLock
     """
     _instances = {}
+    _lock = RLock()
 
     def __call__(cls, *args, **kwargs) -> None:
         """
         Possible changes to the value of the `__init__` argument do not affect
         the returned instance.
         """
-        if cls not in cls._instances:
-            instance = super().__call__(*args, **kwargs)
-            cls._instances[cls] = instance
-        return cls._instances[cls]
\ No newline at end of file
+        instance = cls._instances.get(cls)
+        if instance is None:
+            with cls._lock:
+                if cls not in cls._instances:
+                    cls._instances[cls] = super().__call__(*args, **kwargs)
+                instance = cls._instances[cls]
+        return instance
+
+
+class SingletonABCMeta(SingletonMeta, ABCMeta):
+    """
+    Metaclass of abstract base classes whose concrete subclasses are
+    singletons. Creating an instance of a class that does not implement
+    every abstract method raises TypeError.
+    """
@@ -0,0 +1,203 @@
+"""
+Static Asset Cache Module
+
+This module implements the `StaticCache` class, which keeps the HTML pages
+sent by the request handlers in memory, so that answering with an error or
+success page does not cost a disk read.
+
+Key Features:
+- Singleton class.
+- Loads the pages from STATIC_PATH at startup.
+- Keeps gzip and, if the ``brotli`` package is installed, brotli
+  precompressed variants of every asset.
+- Provides ETag and Last-Modified validators for conditional requests.
+- Reloads an asset when the modification time of its file changes.
+
+Classes:
+----------
+- StaticAsset:
+- StaticCache:
+
+Functions:
+----------
+- choose_coding:
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import time
+from email.utils import formatdate
+from threading import Lock
+from typing import Optional
+
+from loguru import logger
+
+from settings import STATIC_PATH, STATIC_CACHE_RELOAD_INTERVAL
+from singleton import SingletonMeta
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class StaticAsset:
+    """
+    An asset held in memory together with its precompressed variants.
+
+    :ivar path: Path of the file the asset was loaded from.
+    :type path: str
+    :ivar content_type: MIME type of the asset.
+    :type content_type: str
+    :ivar mtime: Modification time of the file when it was loaded.
+    :type mtime: float
+    :ivar etag: Strong entity tag of the uncompressed body.
+    :type etag: str
+    :ivar last_modified: The ``mtime`` formatted as an HTTP date.
+    :type last_modified: str
+    :ivar variants: Body of the asset for every content coding, with the
+                    uncompressed body stored under ``identity``.
+    :type variants: dict[str, bytes]
+    :ivar checked_at: Monotonic time the file was last checked for changes.
+    :type checked_at: float
+    """
+    __slots__ = ('path', 'content_type', 'mtime', 'etag', 'last_modified',
+                 'variants', 'checked_at')
+
+    def __init__(self, path: str, body: bytes, mtime: float) -> None:
+        self.path = path
+        self.content_type = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        self.mtime = mtime
+        self.etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        self.last_modified = formatdate(mtime, usegmt=True)
+        self.variants = {'identity': body}
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body)
+            if len(compressed) < len(body):
+                self.variants['br'] = compressed
+        self.checked_at = time.monotonic()
+
+    def variant_etag(self, coding: str) -> str:
+        """
+        Returns the entity tag of the given variant of the asset.
+
+        :param coding: The content coding of the variant.
+        :type coding: str
+        :return: The entity tag, distinct for every content coding.
+        :rtype: str
+        """
+        if coding == 'identity':
+            return self.etag
+        return f'{self.etag[:-1]}-{coding}"'
+
+
+class StaticCache(metaclass=SingletonMeta):
+    """
+    In-memory cache of static assets keyed by their file path.
+
+    :ivar reload_interval: Seconds between checks of the modification time
+                           of a cached file; 0 disables reloading.
+    :type reload_interval: float
+    :ivar assets: The cached assets keyed by file path.
+    :type assets: dict[str, StaticAsset]
+    """
+    def __init__(self, reload_interval=STATIC_CACHE_RELOAD_INTERVAL) -> None:
+        self.reload_interval = reload_interval
+        self.assets = {}
+        self._lock = Lock()
+
+    def preload(self, root=STATIC_PATH, extensions=('.html',)) -> None:
+        """
+        Loads every file with one of the given extensions found in ``root``.
+
+        :param root: Directory holding the assets.
+        :type root: str
+        :param extensions: Extensions of the files to load.
+        :type extensions: tuple[str]
+        :return: None
+        """
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(extensions):
+                    self.load(root + entry.name)
+        logger.info(f'Static cache holds {len(self.assets)} assets')
+
+    def load(self, path: str) -> StaticAsset:
+        """
+        Reads a file into the cache, replacing any older copy.
+
+        :param path: Path of the file.
+        :type path: str
+        :return: The loaded asset.
+        :rtype: StaticAsset
+        :raises OSError: If the file cannot be read.
+        """
+        with open(path, 'rb') as file:
+            mtime = os.fstat(file.fileno()).st_mtime
+            asset = StaticAsset(path, file.read(), mtime)
+        with self._lock:
+            self.assets[path] = asset
+        return asset
+
+    def get(self, path: str) -> StaticAsset:
+        """
+        Returns the cached asset for a file, loading it on first use and
+        reloading it if the file changed since it was cached.
+
+        A file that disappeared since it was cached is dropped from the
+        cache, and is then missing like one that was never cached.
+
+        :param path: Path of the file.
+        :type path: str
+        :return: The cached asset.
+        :rtype: StaticAsset
+        :raises OSError: If the file cannot be read.
+        """
+        asset = self.assets.get(path)
+        if asset is None:
+            return self.load(path)
+        if self.reload_interval and \
+                time.monotonic() - asset.checked_at > self.reload_interval:
+            asset.checked_at = time.monotonic()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                logger.warning(f'Cached asset {path} is gone')
+                with self._lock:
+                    self.assets.pop(path, None)
+                return self.load(path)
+            if mtime != asset.mtime:
+                logger.info(f'Reloading changed asset {path}')
+                return self.load(path)
+        return asset
+
+
+def choose_coding(asset: StaticAsset, accept_encoding: Optional[str]) -> str:
+    """
+    Picks the smallest variant of an asset the client accepts.
+
+    :param asset: The asset to send.
+    :type asset: StaticAsset
+    :param accept_encoding: Value of the ``Accept-Encoding`` request header.
+    :type accept_encoding: Optional[str]
+    :return: The content coding to send the asset with.
+    :rtype: str
+    """
+    if not accept_encoding:
+        return 'identity'
+    accepted = set()
+    for token in accept_encoding.split(','):
+        coding, _, params = token.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    for coding in ('br', 'gzip'):
+        if coding in asset.variants and \
+                (coding in accepted or '*' in accepted):
+            return coding
+    return 'identity'
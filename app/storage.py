@@ -0,0 +1,303 @@
+"""
+Storage Layout Module
+
+This module maps image file names to their location under IMAGES_PATH.
+
+Two layouts are supported and selected by ``IMAGES_LAYOUT``:
+
+- ``flat``: every file lives directly in IMAGES_PATH.
+- ``sharded``: files are fanned out into two levels of directories named
+  after the first four characters of the file name, e.g.
+  ``images/ab/cd/abcd1234-....png``. Uploads are named by random UUIDs, so
+  the prefix is uniformly distributed and nginx can derive the location
+  from the URL without any lookup. Names that do not start with four
+  lowercase hex digits stay in the flat layout.
+
+While files are being migrated between layouts, lookups check the
+configured layout first and the other one second, so the server keeps
+working during an online migration.
+
+``migrate_layout`` moves existing files to another layout. Every move is a
+rename within the same file system, so the migration can run while the
+server is serving, and an interrupted run is resumed by starting it again:
+files already in place are skipped.
+
+Functions:
+----------
+- relative_path:
+- image_path:
+- locate_image:
+- store_file:
+- remove_file:
+- iter_stored_files:
+- read_checkpoint:
+- write_checkpoint:
+- migrate_layout:
+"""
+import json
+import os
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import Iterator, Optional
+
+from loguru import logger
+
+from settings import IMAGES_PATH, IMAGES_LAYOUT
+
+LAYOUTS = ('flat', 'sharded')
+SHARD_PREFIX = re.compile(r'[0-9a-f]{4}')
+SHARD_DIR = re.compile(r'[0-9a-f]{2}')
+
+
+def relative_path(filename: str, layout: str = IMAGES_LAYOUT) -> str:
+    """
+    Returns the path of a file relative to IMAGES_PATH.
+
+    :param filename: File name of the image, with extension.
+    :type filename: str
+    :param layout: The storage layout, ``flat`` or ``sharded``.
+    :type layout: str, optional
+    :return: The relative path of the file in the given layout.
+    :rtype: str
+    """
+    if layout == 'sharded' and SHARD_PREFIX.match(filename):
+        return f'{filename[:2]}/{filename[2:4]}/{filename}'
+    return filename
+
+
+def image_path(filename: str, layout: str = IMAGES_LAYOUT) -> str:
+    """
+    Returns the path a file is stored at in the given layout.
+
+    :param filename: File name of the image, with extension.
+    :type filename: str
+    :param layout: The storage layout, ``flat`` or ``sharded``.
+    :type layout: str, optional
+    :return: The path of the file.
+    :rtype: str
+    """
+    return IMAGES_PATH + relative_path(filename, layout)
+
+
+def locate_image(filename: str) -> Optional[str]:
+    """
+    Finds a stored file, looking at the configured layout first.
+
+    :param filename: File name of the image, with extension.
+    :type filename: str
+    :return: The path of the file, or None if it is not stored.
+    :rtype: Optional[str]
+    """
+    layouts = (IMAGES_LAYOUT,) + tuple(
+        layout for layout in LAYOUTS if layout != IMAGES_LAYOUT)
+    for layout in layouts:
+        path = image_path(filename, layout)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def store_file(source: str, filename: str,
+               layout: str = IMAGES_LAYOUT) -> str:
+    """
+    Atomically moves a file to its location in the given layout, creating
+    the shard directories if needed.
+
+    :param source: Path of the file to move; it must be on the same file
+                   system as IMAGES_PATH.
+    :type source: str
+    :param filename: File name of the image, with extension.
+    :type filename: str
+    :param layout: The storage layout, ``flat`` or ``sharded``.
+    :type layout: str, optional
+    :return: The new path of the file.
+    :rtype: str
+    """
+    target = image_path(filename, layout)
+    try:
+        os.replace(source, target)
+    except FileNotFoundError:
+        if not os.path.exists(source):
+            raise
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+    return target
+
+
+def remove_file(filename: str) -> bool:
+    """
+    Removes a stored file from whichever layout holds it.
+
+    A file moved by a concurrent migration between the lookup and the
+    removal is looked up once more.
+
+    :param filename: File name of the image, with extension.
+    :type filename: str
+    :return: True if the file was removed, False if it was not stored.
+    :rtype: bool
+    """
+    for _ in range(2):
+        path = locate_image(filename)
+        if path is None:
+            return False
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            continue
+    return False
+
+
+def iter_stored_files(root: str = IMAGES_PATH) -> Iterator[os.DirEntry]:
+    """
+    Iterates over the files stored in both layouts.
+
+    Hidden files, such as uploads still being written, are skipped.
+
+    :param root: The images directory.
+    :type root: str, optional
+    :return: An iterator over the directory entries of the stored files.
+    :rtype: Iterator[os.DirEntry]
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_file():
+                yield entry
+            elif entry.is_dir() and SHARD_DIR.fullmatch(entry.name):
+                yield from _iter_shard(entry.path, depth=1)
+
+
+def _iter_shard(path: str, depth: int) -> Iterator[os.DirEntry]:
+    """
+    Iterates over the files of a shard directory.
+
+    :param path: Path of the shard directory.
+    :type path: str
+    :param depth: Level of the directory, 1 or 2.
+    :type depth: int
+    :return: An iterator over the directory entries of the stored files.
+    :rtype: Iterator[os.DirEntry]
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if depth == 2 and entry.is_file():
+                yield entry
+            elif depth == 1 and entry.is_dir() and \
+                    SHARD_DIR.fullmatch(entry.name):
+                yield from _iter_shard(entry.path, depth=2)
+
+
+def read_checkpoint(path: str) -> dict:
+    """
+    Reads the state recorded by `write_checkpoint`.
+
+    :param path: Path of the checkpoint file.
+    :type path: str
+    :return: The state, or an empty dict if there is no valid checkpoint.
+    :rtype: dict
+    """
+    try:
+        with open(path) as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def write_checkpoint(path: str, state: dict) -> None:
+    """
+    Atomically records the state of an interrupted job, so that it can be
+    resumed by the next run.
+
+    :param path: Path of the checkpoint file.
+    :type path: str
+    :param state: The state, serializable as JSON.
+    :type state: dict
+    :return: None
+    """
+    with open(path + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(path + '.tmp', path)
+
+
+def migrate_layout(layout: str, workers: int = 8,
+                   root: str = IMAGES_PATH) -> Counter:
+    """
+    Moves every stored file to its location in the given layout.
+
+    Files are moved by a pool of threads, with at most a few moves per
+    thread queued at a time, so memory use does not grow with the number
+    of files. Shard directories left empty are removed.
+
+    :param layout: The target layout, ``flat`` or ``sharded``.
+    :type layout: str
+    :param workers: Number of files moved in parallel.
+    :type workers: int, optional
+    :param root: The images directory.
+    :type root: str, optional
+    :return: Numbers of moved, skipped and failed files.
+    :rtype: Counter
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f'Unknown layout {layout!r}')
+
+    results = Counter()
+    lock = Lock()
+    slots = BoundedSemaphore(workers * 4)
+
+    def move(path: str, name: str) -> None:
+        try:
+            store_file(path, name, layout)
+            outcome = 'moved'
+        except FileNotFoundError:
+            outcome = 'skipped'
+        except OSError as e:
+            logger.error(f'Cannot move {path}: {e}')
+            outcome = 'failed'
+        finally:
+            slots.release()
+        with lock:
+            results[outcome] += 1
+            if results['moved'] and results['moved'] % 10000 == 0:
+                logger.info(f'Moved {results["moved"]} files')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry in iter_stored_files(root):
+            if entry.path == image_path(entry.name, layout):
+                with lock:
+                    results['skipped'] += 1
+                continue
+            slots.acquire()
+            executor.submit(move, entry.path, entry.name)
+
+    if layout == 'flat':
+        _remove_empty_shards(root)
+    logger.info(f'Layout migration to {layout}: {dict(results)}')
+    return results
+
+
+def _remove_empty_shards(root: str) -> None:
+    """
+    Removes shard directories that no longer hold any file.
+
+    :param root: The images directory.
+    :type root: str
+    :return: None
+    """
+    with os.scandir(root) as entries:
+        shards = [entry.path for entry in entries
+                  if entry.is_dir() and SHARD_DIR.fullmatch(entry.name)]
+    for shard in shards:
+        with os.scandir(shard) as entries:
+            subshards = [entry.path for entry in entries if entry.is_dir()]
+        for path in subshards + [shard]:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
@@ -0,0 +1,214 @@
+"""
+Thumbnails Module
+
+This module implements the `ThumbnailQueue` class, which generates small
+previews of uploaded images in a pool of worker processes, so that decoding
+large images neither blocks request handlers nor holds the GIL.
+
+Key Features:
+- Singleton class.
+- Thumbnails are stored next to the originals as ``<name>_thumb<ext>``.
+- Bounded job queue: uploads never wait for it, jobs beyond
+  ``THUMBNAIL_QUEUE_SIZE`` are dropped and left to the backfill command.
+- Reports the state of the queue.
+
+Classes:
+----------
+- ThumbnailQueue:
+
+Functions:
+----------
+- thumbnail_name:
+- make_thumbnail:
+"""
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+from PIL import Image
+from loguru import logger
+
+from settings import THUMBNAIL_SIZE, THUMBNAIL_WORKERS, THUMBNAIL_QUEUE_SIZE
+from singleton import SingletonMeta
+from storage import locate_image
+
+THUMBNAIL_SUFFIX = '_thumb'
+
+
+def thumbnail_name(filename: str) -> str:
+    """
+    Returns the file name of the thumbnail of an image.
+
+    :param filename: File name of the original image, with extension.
+    :type filename: str
+    :return: File name of the thumbnail.
+    :rtype: str
+    """
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}{THUMBNAIL_SUFFIX}{ext}'
+
+
+def make_thumbnail(source: str, target: str, size: int) -> None:
+    """
+    Writes a thumbnail of an image that fits into a ``size`` square.
+
+    Runs in a worker process. The thumbnail is written to a temporary file
+    first and renamed into place, so a half-written preview is never served.
+
+    :param source: Path of the original image.
+    :type source: str
+    :param target: Path of the thumbnail.
+    :type target: str
+    :param size: Maximum width and height of the thumbnail in pixels.
+    :type size: int
+    :return: None
+    """
+    directory, name = os.path.split(target)
+    temp_path = os.path.join(directory, f'.{name}.part')
+    with Image.open(source) as image:
+        image_format = image.format
+        image.thumbnail((size, size))
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(temp_path, format=image_format)
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, target)
+
+
+class ThumbnailQueue(metaclass=SingletonMeta):
+    """
+    Generates thumbnails in a process pool behind a bounded queue.
+
+    The pool is started on first use, so pre-forked workers each get their
+    own instead of inheriting one from the parent.
+
+    :ivar workers: Number of worker processes.
+    :type workers: int
+    :ivar queue_size: Maximum number of jobs queued or running.
+    :type queue_size: int
+    :ivar counters: Numbers of completed, failed and dropped jobs.
+    :type counters: dict[str, int]
+    """
+    def __init__(self, workers=THUMBNAIL_WORKERS,
+                 queue_size=THUMBNAIL_QUEUE_SIZE) -> None:
+        self.workers = workers
+        self.queue_size = queue_size
+        self.counters = {'completed': 0, 'failed': 0, 'dropped': 0}
+        self._pending = 0
+        self._slots = BoundedSemaphore(queue_size)
+        self._lock = Lock()
+        self._executor = None
+
+    def executor(self) -> ProcessPoolExecutor:
+        """
+        Returns the process pool, starting it on first use.
+
+        :return: The process pool running the jobs.
+        :rtype: ProcessPoolExecutor
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit(self, filename: str, block: bool = False,
+               source: str = None) -> bool:
+        """
+        Queues the generation of the thumbnail of an image. The thumbnail
+        is written to the directory holding the image.
+
+        :param filename: File name of the image, with extension.
+        :type filename: str
+        :param block: Whether to wait for room in a full queue instead of
+                      dropping the job.
+        :type block: bool, optional
+        :param source: Path of the image, looked up if not given.
+        :type source: str, optional
+        :return: True if the job was queued, False if it was dropped.
+        :rtype: bool
+        """
+        source = source or locate_image(filename)
+        if source is None:
+            logger.warning(f'Image {filename} not found for thumbnail')
+            return False
+        target = os.path.join(os.path.dirname(source),
+                              thumbnail_name(filename))
+
+        if not self._slots.acquire(blocking=block):
+            with self._lock:
+                self.counters['dropped'] += 1
+            logger.warning(f'Thumbnail queue is full, skipping {filename}')
+            return False
+
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self.executor().submit(
+                make_thumbnail, source, target, THUMBNAIL_SIZE)
+        except RuntimeError as e:
+            self._finish('failed')
+            logger.error(f'Thumbnail of {filename} not queued: {e}')
+            return False
+        future.add_done_callback(
+            lambda done: self._on_done(done, filename))
+        return True
+
+    def _on_done(self, future: Future, filename: str) -> None:
+        """
+        Records the outcome of a finished job.
+
+        :param future: The finished job.
+        :type future: Future
+        :param filename: File name of the image.
+        :type filename: str
+        :return: None
+        """
+        error = future.exception()
+        if error:
+            logger.error(f'Thumbnail of {filename} failed: {error}')
+        self._finish('failed' if error else 'completed')
+
+    def _finish(self, outcome: str) -> None:
+        """
+        Frees the queue slot of a job and counts its outcome.
+
+        :param outcome: Name of the counter to increment.
+        :type outcome: str
+        :return: None
+        """
+        with self._lock:
+            self._pending -= 1
+            self.counters[outcome] += 1
+        self._slots.release()
+
+    def state(self) -> dict:
+        """
+        Describes the current state of the queue.
+
+        :return: Queue capacity, number of queued or running jobs and the
+                 outcome counters.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'capacity': self.queue_size,
+                'pending': self._pending,
+                **self.counters,
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stops the process pool, finishing queued jobs if ``wait`` is set.
+
+        :param wait: Whether to wait for queued jobs.
+        :type wait: bool, optional
+        :return: None
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
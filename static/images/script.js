@@ -69,7 +69,7 @@ function setImages(images) {
         deleteButton.classList.add('delete-btn');
         tdDelete.appendChild(deleteButton);
 
-        tdPreview.innerHTML = `<img src="/images/${fullname}" 
+        tdPreview.innerHTML = `<img src="${image.thumbnail}" 
                                 width="42" height="100%">`;
 
         tdOrigName.innerHTML = image.original_name;
@@ -80,7 +80,7 @@ function setImages(images) {
 
         tdType.innerHTML = image.file_type;
 
-        tdName.innerHTML = `<a href="/images/${fullname}" 
+        tdName.innerHTML = `<a href="${image.url}" 
                               target="_blank">${image.filename}</a>`;
 
         tr.appendChild(tdPreview);